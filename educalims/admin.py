@@ -1,5 +1,14 @@
 from django.contrib import admin
-from .models import Cycle, Discipline, Niveau, Unite, Fichier, Produit, Abonnement, WebhookLog
+from django.contrib.admin.widgets import AdminFileWidget
+from django.db import models, transaction
+from django.urls import reverse
+from django.utils.html import format_html
+from django.utils import timezone
+from .models import (
+    Cycle, Discipline, Niveau, Unite, Fichier, Produit, Abonnement, AbonnementArchive, WebhookLog,
+    NotificationTelegram, UserDevice, Blob,
+)
+from .appareils import invalider_appareils
 
 
 @admin.register(Cycle)
@@ -58,15 +67,39 @@ class UniteAdmin(admin.ModelAdmin):
         return qs.select_related('niveau', 'discipline', 'unite_parent')
 
 
+class FichierProtege:
+    """Fichier affiche par le widget, avec l'URL de la vue protegee au lieu de /media/"""
+
+    def __init__(self, fichier):
+        self.fichier = fichier
+        self.url = reverse('educalims:fichier_telecharger', args=[fichier.instance.pk])
+
+    def __str__(self):
+        return str(self.fichier)
+
+
+class FichierProtegeWidget(AdminFileWidget):
+    """Lien "Actuellement" par fichier_telecharger : nginx ne sert plus /media/"""
+
+    def format_value(self, value):
+        value = super().format_value(value)
+        if value and getattr(value, 'instance', None) is not None and value.instance.pk:
+            return FichierProtege(value)
+        return value
+
+
 @admin.register(Fichier)
 class FichierAdmin(admin.ModelAdmin):
     """Admin pour Fichier"""
-    list_display = ['nom', 'unite', 'type_fichier', 'est_actif', 'telechargements', 'date_creation']
-    search_fields = ['nom', 'description']
+    list_display = ['nom', 'unite', 'type_fichier', 'est_actif', 'telechargements', 'traite_le', 'date_creation']
+    search_fields = ['nom', 'description', 'empreinte']
     list_filter = ['type_fichier', 'est_actif', 'unite__niveau__cycle', 'unite__discipline']
     list_editable = ['est_actif']
     ordering = ['-date_creation', 'nom']
-    readonly_fields = ['telechargements', 'date_creation', 'date_modification']
+    readonly_fields = ['telechargements', 'date_creation', 'date_modification', 'taille', 'empreinte', 'nb_pages',
+                       'metadonnees', 'lien_miniature', 'variantes', 'traite_le', 'erreur_traitement']
+    actions = ['retraiter']
+    formfield_overrides = {models.FileField: {'widget': FichierProtegeWidget}}
 
     fieldsets = (
         ('Informations générales', {
@@ -75,6 +108,11 @@ class FichierAdmin(admin.ModelAdmin):
         ('Contenu', {
             'fields': (('fichier', 'contenu_texte', 'url_lien'), 'duree', 'taille')
         }),
+        ('Traitement (process_media)', {
+            'fields': ('traite_le', 'erreur_traitement', 'empreinte', 'nb_pages', 'metadonnees', 'lien_miniature',
+                       'variantes'),
+            'classes': ('collapse',)
+        }),
         ('Statistiques', {
             'fields': ('telechargements', 'est_actif', 'date_creation', 'date_modification')
         }),
@@ -82,7 +120,27 @@ class FichierAdmin(admin.ModelAdmin):
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        return qs.select_related('unite__niveau', 'unite__discipline')
+        return qs.select_related('unite__niveau', 'unite__discipline', 'unite__unite_parent')
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == 'unite':
+            # Libelle "parent > unite" sans requete par option
+            kwargs['queryset'] = Unite.objects.select_related('unite_parent')
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+    @admin.display(description="Miniature")
+    def lien_miniature(self, obj):
+        if not obj.miniature:
+            return "-"
+        url = reverse('educalims:fichier_telecharger', args=[obj.pk])
+        return format_html('<a href="{}?format=miniature" target="_blank">{}</a>', url, obj.miniature)
+
+    @admin.action(description="Relancer le traitement des fichiers")
+    def retraiter(self, request, queryset):
+        nombre = queryset.exclude(fichier='').exclude(fichier__isnull=True).update(
+            traite_le=None, traitement_reserve_le=None
+        )
+        self.message_user(request, f"{nombre} fichier(s) remis en file de traitement.")
 
 
 # ==================== ADMIN ABONNEMENT ====================
@@ -124,27 +182,46 @@ class AbonnementAdmin(admin.ModelAdmin):
         return qs.select_related('user', 'niveau', 'niveau__cycle', 'produit')
 
 
+@admin.register(AbonnementArchive)
+class AbonnementArchiveAdmin(admin.ModelAdmin):
+    """Historique des abonnements termines (lecture seule, alimente par reap_abonnements)"""
+    list_display = ['id', 'user', 'niveau', 'statut', 'merchant_reference_id', 'date_creation', 'date_modification', 'montant_paye']
+    search_fields = ['user__username', 'reference_interne', 'merchant_reference_id']
+    list_filter = ['statut', 'methode_paiement', 'date_creation']
+    ordering = ['-date_creation']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('user', 'niveau')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(WebhookLog)
 class WebhookLogAdmin(admin.ModelAdmin):
     """Admin pour WebhookLog"""
     list_display = ['created_at', 'merchant_reference_id', 'status', 'amount', 'operator', 'phone_number', 'activation_succes', 'telegram_notification_sent', 'abonnement']
-    list_filter = ['status', 'operator', 'activation_succes', 'telegram_notification_sent', 'created_at']
+    list_filter = ['provider', 'status', 'rapprochement', 'operator', 'activation_succes', 'telegram_notification_sent', 'created_at']
     search_fields = ['merchant_reference_id', 'transaction_id', 'phone_number']
-    readonly_fields = ['created_at', 'raw_data']
+    readonly_fields = ['created_at', 'raw_data', 'traite_le', 'erreur_traitement', 'reponse', 'reponse_http', 'rapprochement', 'candidats']
     ordering = ['-created_at']
 
     fieldsets = (
         ('Informations générales', {
-            'fields': ('merchant_reference_id', 'status', 'code')
+            'fields': ('provider', 'merchant_reference_id', 'status', 'code')
         }),
         ('Détails de la transaction', {
             'fields': ('amount', 'operator', 'transaction_id', 'phone_number')
         }),
         ('Statut', {
-            'fields': ('activation_succes', 'telegram_notification_sent', 'abonnement')
+            'fields': ('rapprochement', 'candidats', 'activation_succes', 'telegram_notification_sent', 'abonnement',
+                       'traite_le', 'erreur_traitement')
         }),
         ('Données brutes', {
-            'fields': ('raw_data', 'created_at'),
+            'fields': ('raw_data', 'reponse', 'reponse_http', 'created_at'),
             'classes': ('collapse',)
         }),
     )
@@ -153,6 +230,82 @@ class WebhookLogAdmin(admin.ModelAdmin):
         qs = super().get_queryset(request)
         return qs.select_related('abonnement__user', 'abonnement__niveau')
 
+
+@admin.register(NotificationTelegram)
+class NotificationTelegramAdmin(admin.ModelAdmin):
+    """Admin pour la file des notifications Telegram"""
+    list_display = ['date_creation', 'categorie', 'statut', 'tentatives', 'prochaine_tentative', 'date_envoi', 'webhook_log']
+    list_filter = ['statut', 'categorie', 'date_creation']
+    search_fields = ['message', 'derniere_erreur']
+    readonly_fields = ['date_creation', 'date_envoi', 'tentatives', 'derniere_erreur']
+    raw_id_fields = ['webhook_log']
+    ordering = ['-date_creation']
+    actions = ['renvoyer']
+
+    @admin.action(description="Remettre en file d'attente")
+    def renvoyer(self, request, queryset):
+        nombre = queryset.exclude(statut='ENVOYEE').update(
+            statut='EN_ATTENTE', tentatives=0, prochaine_tentative=timezone.now()
+        )
+        self.message_user(request, f"{nombre} notification(s) remise(s) en file d'attente.")
+
+@admin.register(UserDevice)
+class UserDeviceAdmin(admin.ModelAdmin):
+    """Admin des appareils autorises : revocation et retablissement"""
+    list_display = ['user', 'device_court', 'date_ajout', 'dernier_acces', 'revoque_le', 'revoque_par_admin']
+    list_filter = [('revoque_le', admin.EmptyFieldListFilter), 'revoque_par_admin', 'date_ajout']
+    search_fields = ['user__username', 'user__email', 'device_id']
+    readonly_fields = ['user', 'device_id', 'date_ajout', 'dernier_acces', 'revoque_le', 'revoque_par_admin']
+    list_select_related = ['user']
+    ordering = ['-date_ajout']
+    actions = ['revoquer', 'retablir']
+
+    def has_add_permission(self, request):
+        return False
+
+    def device_court(self, obj):
+        return obj.device_id[:8] + '...'
+    device_court.short_description = 'Appareil'
+
+    def _modifier(self, queryset, revoque_le):
+        # update() ne declenche pas les signaux : invalidation des appareils en session ici
+        user_ids = list(queryset.values_list('user_id', flat=True).distinct())
+        nombre = queryset.update(revoque_le=revoque_le, revoque_par_admin=revoque_le is not None)
+        transaction.on_commit(lambda: invalider_appareils(*user_ids))
+        return nombre
+
+    @admin.action(description="Révoquer les appareils sélectionnés")
+    def revoquer(self, request, queryset):
+        # Appareils mis de cote par la limite compris : ils ne seront plus reactives
+        nombre = self._modifier(queryset.filter(revoque_par_admin=False), timezone.now())
+        self.message_user(request, f"{nombre} appareil(s) révoqué(s).")
+
+    @admin.action(description="Rétablir les appareils sélectionnés")
+    def retablir(self, request, queryset):
+        nombre = self._modifier(queryset.filter(revoque_le__isnull=False), None)
+        self.message_user(request, f"{nombre} appareil(s) rétabli(s).")
+
+@admin.register(Blob)
+class BlobAdmin(admin.ModelAdmin):
+    """Blobs du stockage par contenu (lecture seule : references tenues par les signaux)"""
+    list_display = ['empreinte_courte', 'taille', 'nb_references', 'date_creation']
+    list_filter = ['date_creation']
+    search_fields = ['empreinte', 'nom']
+    readonly_fields = ['nom', 'empreinte', 'taille', 'nb_references', 'date_creation']
+    ordering = ['-date_creation']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        # Suppression des blobs : manage.py gc_media
+        return False
+
+    def empreinte_courte(self, obj):
+        return obj.empreinte[:12] + '...'
+    empreinte_courte.short_description = 'Empreinte'
+
+
 # ==================== ADMIN USER PROFILE ====================
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
@@ -167,9 +320,20 @@ class UserProfileInline(admin.StackedInline):
     fields = ('recommande_par', 'telephone')
 
 
+class UserDeviceInline(admin.TabularInline):
+    model = UserDevice
+    extra = 0
+    verbose_name_plural = 'Appareils (révocation : menu Appareils)'
+    fields = ('device_id', 'date_ajout', 'dernier_acces', 'revoque_le', 'revoque_par_admin')
+    readonly_fields = fields
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 class CustomUserAdmin(UserAdmin):
     list_display = ('username', 'email', 'first_name', 'last_name', 'is_staff', 'get_recommande_par', 'get_telephone')
-    inlines = (UserProfileInline,)
+    inlines = (UserProfileInline, UserDeviceInline)
     
     def get_recommande_par(self, obj):
         profile = UserProfile.objects.filter(user=obj).first()
@@ -1,38 +1,85 @@
 """Admin dashboard pour voir les paiements en temps reel"""
 from django.contrib import admin
+from django.db.models import Count
+from django.http import HttpRequest, HttpResponseForbidden, JsonResponse
 from django.shortcuts import render
-from django.http import HttpRequest
 from .models import Abonnement
+from .statistiques import PERIODES, classement_recommandations, resume_statistiques
 
 
-@admin.site.register_view
 def payment_dashboard(request: HttpRequest):
     """Dashboard pour voir les paiements recus"""
-    # Derniers abonnements (tous statuts)
-    derniers_abonnements = Abonnement.objects.all()[:20]
+    if not request.user.is_superuser:
+        return HttpResponseForbidden("Accès réservé aux administrateurs")
 
-    # Abonnements en attente
-    abonnements_attente = Abonnement.objects.filter(statut='EN_ATTENTE').order_by('-date_creation')[:10]
+    # Totaux par statut en une seule requete GROUP BY
+    totaux = dict(
+        Abonnement.objects.order_by().values_list('statut').annotate(nombre=Count('id'))
+    )
 
-    # Abonnements actifs
-    abonnements_actifs = Abonnement.objects.filter(statut='ACTIF').order_by('-date_debut')[:10]
+    statistiques = resume_statistiques(jours=30)
+    tableaux_statistiques = [
+        (titre, [{**ligne, 'libelle': ligne[champ]} for ligne in statistiques[cle]])
+        for titre, cle, champ in [
+            ('Opérateur', 'par_operateur', 'operateur'),
+            ('Niveau', 'par_niveau', 'niveau__nom'),
+            ('Recommandé par', 'par_recommandation', 'recommande_par'),
+        ]
+    ]
 
-    # Abonnements echoues
-    abonnements_echoues = Abonnement.objects.filter(statut='ECHOUE').order_by('-date_creation')[:10]
+    # Listes : utilisateur et niveau charges par jointure
+    abonnements = Abonnement.objects.select_related('user', 'niveau')
 
     context = {
+        **admin.site.each_context(request),
         'title': 'Dashboard Paiements',
-        'derniers_abonnements': derniers_abonnements,
-        'abonnements_attente': abonnements_attente,
-        'abonnements_actifs': abonnements_actifs,
-        'abonnements_echoues': abonnements_echoues,
-        'total_attente': Abonnement.objects.filter(statut='EN_ATTENTE').count(),
-        'total_actifs': Abonnement.objects.filter(statut='ACTIF').count(),
-        'total_echoues': Abonnement.objects.filter(statut='ECHOUE').count(),
+        # Derniers abonnements (tous statuts)
+        'derniers_abonnements': abonnements.order_by('-date_creation')[:20],
+        'abonnements_attente': abonnements.filter(statut='EN_ATTENTE').order_by('-date_creation')[:10],
+        'abonnements_actifs': abonnements.filter(statut='ACTIF').order_by('-date_debut')[:10],
+        'abonnements_echoues': abonnements.filter(statut='ECHOUE').order_by('-date_creation')[:10],
+        'total_attente': totaux.get('EN_ATTENTE', 0),
+        'total_actifs': totaux.get('ACTIF', 0),
+        'total_echoues': totaux.get('ECHOUE', 0),
+        # Agregats des 30 derniers jours (table StatistiquePaiement)
+        'statistiques': statistiques,
+        'tableaux_statistiques': tableaux_statistiques,
     }
 
     return render(request, 'admin/educalims/payment_dashboard.html', context)
 
 
+def _periode(request):
+    periode = request.GET.get('periode', 'jour')
+    return periode if periode in PERIODES else 'jour'
+
+
+def referral_leaderboard(request: HttpRequest):
+    """Classement des codes de recommandation (jour, semaine, saison), depuis les agregats"""
+    if not request.user.is_superuser:
+        return HttpResponseForbidden("Accès réservé aux administrateurs")
+
+    classements = {periode: classement_recommandations(periode) for periode in PERIODES}
+    context = {
+        **admin.site.each_context(request),
+        'title': 'Classement des recommandations',
+        'classements': [
+            (periode, libelle, classements[periode])
+            for periode, libelle in [('jour', "Aujourd'hui"), ('semaine', 'Cette semaine'), ('saison', 'Saison')]
+        ],
+    }
+    return render(request, 'admin/educalims/referral_leaderboard.html', context)
+
+
+def api_referral_leaderboard(request: HttpRequest):
+    """API JSON du classement : ?periode=jour|semaine|saison"""
+    if not request.user.is_superuser:
+        return JsonResponse({'error': 'Accès réservé aux administrateurs'}, status=403)
+
+    resultat = classement_recommandations(_periode(request))
+    resultat['debut'] = resultat['debut'].isoformat()
+    return JsonResponse(resultat)
+
+
 # Extension du template admin
 admin.site.index_title = "Educalims - Gestion des abonnements"
@@ -0,0 +1,141 @@
+"""
+Analyse d'un fichier uploade, executee dans les processus du pool de process_media : fonctions
+sans ORM ni settings (taille, empreinte, pages et metadonnees PDF, duree video, miniature et
+variantes d'image). Pillow, pypdf, pdftoppm (poppler-utils) et ffprobe sont optionnels :
+sans eux l'etape correspondante est sautee.
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+
+BLOC = 1024 * 1024
+# Commandes externes : une page ou un en-tete, jamais le fichier entier
+COMMANDE_TIMEOUT = 120
+
+
+def _empreinte(chemin):
+    contenu = hashlib.sha256()
+    with open(chemin, 'rb') as fichier:
+        for bloc in iter(lambda: fichier.read(BLOC), b''):
+            contenu.update(bloc)
+    return contenu.hexdigest()
+
+
+def _analyser_pdf(chemin):
+    """(nombre de pages, metadonnees du document)"""
+    lecteur = PdfReader(chemin)
+    if lecteur.is_encrypted:
+        # Protection sans mot de passe d'ouverture (droits d'impression, de copie...)
+        lecteur.decrypt('')
+    metadonnees = {
+        cle.lstrip('/').lower(): str(valeur)
+        for cle, valeur in (lecteur.metadata or {}).items()
+        if valeur
+    }
+    return len(lecteur.pages), metadonnees
+
+
+def _miniature_pdf(chemin, destination, largeur):
+    """Premiere page en PNG de `largeur` pixels ; faux si pdftoppm est absent"""
+    pdftoppm = shutil.which('pdftoppm')
+    if pdftoppm is None:
+        return False
+    with tempfile.TemporaryDirectory() as dossier:
+        sortie = os.path.join(dossier, 'page')
+        subprocess.run(
+            [pdftoppm, '-f', '1', '-l', '1', '-singlefile', '-png', '-scale-to-x', str(largeur),
+             '-scale-to-y', '-1', chemin, sortie],
+            check=True, capture_output=True, timeout=COMMANDE_TIMEOUT,
+        )
+        shutil.move(sortie + '.png', destination)
+    return True
+
+
+def _duree_video(chemin):
+    """Duree en secondes lue par ffprobe, None s'il est absent"""
+    ffprobe = shutil.which('ffprobe')
+    if ffprobe is None:
+        return None
+    resultat = subprocess.run(
+        [ffprobe, '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=nw=1:nk=1', chemin],
+        check=True, capture_output=True, text=True, timeout=COMMANDE_TIMEOUT,
+    )
+    return round(float(resultat.stdout.strip()))
+
+
+def _reduire(image, largeur, destination_sans_extension):
+    """Copie de `largeur` pixels (proportions gardees) ; PNG si transparence, JPEG sinon"""
+    copie = image.copy()
+    copie.thumbnail((largeur, largeur * 100))
+    if copie.mode in ('RGBA', 'LA', 'P') and (copie.mode != 'P' or 'transparency' in copie.info):
+        destination = destination_sans_extension + '.png'
+        copie.save(destination, 'PNG', optimize=True)
+    else:
+        destination = destination_sans_extension + '.jpg'
+        copie.convert('RGB').save(destination, 'JPEG', quality=85, optimize=True, progressive=True)
+    return destination
+
+
+def analyser(chemin, type_fichier, racine, prefixe, largeur_miniature, largeurs_variantes):
+    """
+    Analyse le fichier `chemin`. Les fichiers generes sont ecrits sous racine/prefixe (vide au
+    prealable) et retournes par nom relatif a `racine`, comme les noms d'un FileField.
+    Retourne les valeurs a enregistrer sur le Fichier.
+    """
+    resultat = {
+        'taille': os.path.getsize(chemin),
+        'empreinte': _empreinte(chemin),
+        'nb_pages': None,
+        'metadonnees': {},
+        'miniature': None,
+        'variantes': {},
+    }
+    dossier = os.path.join(racine, prefixe)
+    shutil.rmtree(dossier, ignore_errors=True)
+    os.makedirs(dossier, exist_ok=True)
+
+    def relatif(destination):
+        return os.path.relpath(destination, racine).replace(os.sep, '/')
+
+    if type_fichier == 'PDF':
+        if PdfReader is not None:
+            resultat['nb_pages'], resultat['metadonnees'] = _analyser_pdf(chemin)
+        destination = os.path.join(dossier, 'miniature.png')
+        if _miniature_pdf(chemin, destination, largeur_miniature):
+            resultat['miniature'] = relatif(destination)
+
+    elif type_fichier == 'VID':
+        duree = _duree_video(chemin)
+        if duree is not None:
+            resultat['duree'] = duree
+
+    elif type_fichier == 'IMG' and Image is not None:
+        with Image.open(chemin) as image:
+            image.load()
+            resultat['metadonnees'] = {
+                'largeur': image.width, 'hauteur': image.height, 'format': image.format, 'mode': image.mode,
+            }
+            resultat['miniature'] = relatif(
+                _reduire(image, min(largeur_miniature, image.width), os.path.join(dossier, 'miniature'))
+            )
+            # Variantes responsives (srcset) : seulement plus petites que l'original
+            for largeur in largeurs_variantes:
+                if largeur < image.width:
+                    resultat['variantes'][str(largeur)] = relatif(
+                        _reduire(image, largeur, os.path.join(dossier, str(largeur)))
+                    )
+
+    return resultat
@@ -0,0 +1,134 @@
+"""
+Appareils autorises par utilisateur (UserDevice) : au plus APPAREILS_MAX appareils actifs,
+ensemble lu depuis la session (version en cache) et derniers acces ecrits par lots
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import UserDevice
+from .tampons import TamponEcritures
+
+
+APPAREILS_MAX = getattr(settings, 'APPAREILS_MAX', 3)
+# Intervalle d'ecriture des derniers acces (secondes)
+APPAREILS_ACCES_INTERVALLE = getattr(settings, 'APPAREILS_ACCES_INTERVALLE', 60)
+# Cle de session : appareils actifs de l'utilisateur et version du cache a laquelle ils ont ete lus
+SESSION_APPAREILS = 'appareils_enregistres'
+
+
+# ==================== ENSEMBLE DES APPAREILS ACTIFS ====================
+
+def _appareils_version_key(user_id):
+    return f"appareils:version:user:{user_id}"
+
+
+def appareils_version(user_id):
+    """Version des appareils de l'utilisateur, changee a chaque ajout ou revocation"""
+    cle = _appareils_version_key(user_id)
+    version = cache.get(cle)
+    if version is None:
+        # Cache vide ou evince : nouvelle version, les sessions reliront la base une fois
+        cache.add(cle, time.time_ns(), None)
+        version = cache.get(cle)
+    return version
+
+
+def invalider_appareils(*user_ids):
+    cles = [_appareils_version_key(user_id) for user_id in set(user_ids) if user_id]
+    if cles:
+        cache.delete_many(cles)
+
+
+def charger_appareils(user_id):
+    return frozenset(
+        UserDevice.objects.filter(user_id=user_id, revoque_le__isnull=True).values_list('device_id', flat=True)
+    )
+
+
+def appareils_enregistres(request):
+    """
+    Ensemble des device_id actifs de l'utilisateur connecte, lu dans la session tant que la
+    version en cache n'a pas change : pas de requete en regime normal, test d'appartenance O(1).
+    Les donnees de session sont cote serveur ou signees, le client ne peut pas les modifier.
+    """
+    appareils = getattr(request, '_appareils', None)
+    if appareils is not None:
+        return appareils
+
+    version = appareils_version(request.user.pk)
+    claim = request.session.get(SESSION_APPAREILS)
+    if claim and claim.get('user_id') == request.user.pk and claim.get('version') == version:
+        appareils = frozenset(claim['appareils'])
+    else:
+        appareils = charger_appareils(request.user.pk)
+        request.session[SESSION_APPAREILS] = {
+            'user_id': request.user.pk, 'version': version, 'appareils': sorted(appareils),
+        }
+    request._appareils = appareils
+    return appareils
+
+
+def enregistrer_appareil(user, device_id):
+    """
+    Autorise l'appareil pour l'utilisateur. Au-dela de APPAREILS_MAX appareils actifs, le
+    moins recemment utilise est mis de cote ; il est reactive s'il se reconnecte (retour a
+    un ancien telephone). Un appareil revoque par l'admin n'est pas reactive, un appareil
+    deja lie a un autre compte n'est pas autorise (pas de partage de compte sur un appareil).
+    Retourne vrai si l'appareil est autorise.
+    """
+    with transaction.atomic():
+        actifs = list(
+            UserDevice.objects.select_for_update()
+            .filter(user=user, revoque_le__isnull=True)
+            .order_by('dernier_acces', 'date_ajout')
+        )
+        if any(appareil.device_id == device_id for appareil in actifs):
+            return True
+        if UserDevice.objects.filter(device_id=device_id).exclude(user=user).exists():
+            return False
+        try:
+            appareil, cree = UserDevice.objects.select_for_update().get_or_create(user=user, device_id=device_id)
+        except IntegrityError:
+            # Enregistre au meme instant pour un autre compte (contrainte appareil_device_unique)
+            return False
+        if not cree:
+            if appareil.revoque_par_admin:
+                return False
+            # Mis de cote par la limite : reactive comme appareil le plus recent
+            appareil.revoque_le = None
+            appareil.dernier_acces = timezone.now()
+            appareil.save(update_fields=['revoque_le', 'dernier_acces'])
+        # Appareils jamais vus (dernier_acces NULL) tries en premier
+        for ancien in actifs[:max(0, len(actifs) + 1 - APPAREILS_MAX)]:
+            ancien.revoque_le = timezone.now()
+            ancien.save(update_fields=['revoque_le'])
+    return True
+
+
+# ==================== DERNIERS ACCES (ECRITURE DIFFEREE) ====================
+
+def _ecrire_acces(acces):
+    """Un UPDATE par appareil vu depuis le dernier vidage"""
+    with transaction.atomic():
+        for (user_id, device_id), date in acces.items():
+            UserDevice.objects.filter(user_id=user_id, device_id=device_id).filter(
+                Q(dernier_acces__isnull=True) | Q(dernier_acces__lt=date)
+            ).update(dernier_acces=date)
+
+
+_acces = TamponEcritures('acces appareils', _ecrire_acces, APPAREILS_ACCES_INTERVALLE, fusionner=max)
+
+
+def noter_acces(user_id, device_id):
+    """Memorise l'acces en memoire ; les derniers acces sont ecrits au plus tard apres l'intervalle"""
+    _acces.ajouter((user_id, device_id), timezone.now())
+
+
+def vider_acces():
+    """Ecrit les derniers acces memorises ; retourne le nombre d'appareils mis a jour"""
+    return len(_acces.vider())
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class EducalimsConfig(AppConfig):
     name = 'educalims'
+
+    def ready(self):
+        from . import signals  # noqa: F401
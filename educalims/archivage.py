@@ -0,0 +1,38 @@
+"""Archivage des abonnements termines : deplaces d'Abonnement vers AbonnementArchive par lots"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Abonnement, AbonnementArchive
+
+
+STATUTS_ARCHIVES = ('ANNULE', 'ECHOUE', 'EXPIRE')
+# Anciennete (derniere modification) au-dela de laquelle un abonnement termine est archive
+ARCHIVAGE_MOIS = getattr(settings, 'ABONNEMENT_ARCHIVAGE_MOIS', 6)
+ARCHIVAGE_LOT = 1000
+
+
+def archiver_lot(taille=ARCHIVAGE_LOT, mois=ARCHIVAGE_MOIS):
+    """
+    Copie au plus `taille` abonnements termines depuis plus de `mois` mois dans
+    AbonnementArchive et les supprime d'Abonnement, dans la meme transaction.
+    Les WebhookLog lies perdent leur lien (SET_NULL) mais gardent la reference marchand.
+    Retourne le nombre archive.
+    """
+    limite = timezone.now() - timedelta(days=30 * mois)
+    with transaction.atomic():
+        lignes = list(
+            Abonnement.objects.filter(statut__in=STATUTS_ARCHIVES, date_modification__lt=limite)
+            .select_for_update(skip_locked=True)
+            .order_by('date_modification', 'id')
+            .values(*AbonnementArchive.CHAMPS_COPIES)[:taille]
+        )
+        if not lignes:
+            return 0
+        AbonnementArchive.objects.bulk_create(
+            [AbonnementArchive(**ligne) for ligne in lignes], ignore_conflicts=True
+        )
+        Abonnement.objects.filter(pk__in=[ligne['id'] for ligne in lignes]).delete()
+    return len(lignes)
@@ -0,0 +1,83 @@
+"""Compteurs denormalises du catalogue (niveaux enfants, chapitres, fichiers actifs)"""
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Cycle, Discipline, Niveau, Unite, Fichier
+
+
+def _compte(queryset, champ):
+    """Sous-requete correlee COUNT(*) des lignes de `queryset` dont `champ` vaut la ligne externe"""
+    sous_requete = (
+        queryset.filter(**{champ: OuterRef('pk')})
+        .order_by()
+        .values(champ)
+        .annotate(total=Count('*'))
+        .values('total')[:1]
+    )
+    return Coalesce(Subquery(sous_requete, output_field=IntegerField()), 0)
+
+
+def _chapitres():
+    """Chapitres = unites finales (sans unite enfant)"""
+    return Unite.objects.filter(unites_enfants__isnull=True)
+
+
+def _fichiers_actifs():
+    return Fichier.objects.filter(est_actif=True)
+
+
+def _mettre_a_jour(modele, ids, **expressions):
+    """UPDATE ensembliste des compteurs, limite aux `ids` donnes (tous si None)"""
+    queryset = modele.objects.all()
+    if ids is not None:
+        ids = {pk for pk in ids if pk}
+        if not ids:
+            return 0
+        queryset = queryset.filter(pk__in=ids)
+    return queryset.update(**expressions)
+
+
+def rafraichir_cycles(ids=None):
+    return _mettre_a_jour(
+        Cycle, ids,
+        nb_disciplines=_compte(Discipline.objects.all(), 'cycles'),
+        nb_niveaux_enfants=_compte(Niveau.objects.filter(est_niveau_enfant=True), 'cycle'),
+        nb_chapitres=_compte(_chapitres(), 'niveau__cycle'),
+        nb_fichiers_actifs=_compte(_fichiers_actifs(), 'unite__niveau__cycle'),
+    )
+
+
+def rafraichir_disciplines(ids=None):
+    return _mettre_a_jour(
+        Discipline, ids,
+        nb_niveaux_enfants=_compte(Niveau.objects.filter(est_niveau_enfant=True), 'disciplines'),
+        nb_chapitres=_compte(_chapitres(), 'discipline'),
+        nb_fichiers_actifs=_compte(_fichiers_actifs(), 'unite__discipline'),
+    )
+
+
+def rafraichir_niveaux(ids=None):
+    return _mettre_a_jour(
+        Niveau, ids,
+        nb_niveaux_enfants=_compte(Niveau.objects.all(), 'niveau_parent'),
+        nb_chapitres=_compte(_chapitres(), 'niveau'),
+        nb_fichiers_actifs=_compte(_fichiers_actifs(), 'unite__niveau'),
+    )
+
+
+def rafraichir_unites(ids=None):
+    return _mettre_a_jour(
+        Unite, ids,
+        nb_unites_enfants=_compte(Unite.objects.all(), 'unite_parent'),
+        nb_fichiers_actifs=_compte(_fichiers_actifs(), 'unite'),
+    )
+
+
+def rafraichir_tout():
+    """Recalcule tous les compteurs : un UPDATE ensembliste par table"""
+    return {
+        'unites': rafraichir_unites(),
+        'niveaux': rafraichir_niveaux(),
+        'disciplines': rafraichir_disciplines(),
+        'cycles': rafraichir_cycles(),
+    }
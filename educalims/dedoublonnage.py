@@ -0,0 +1,188 @@
+"""
+References des blobs du stockage par contenu (stockage.py) : comptage, recomptage, collecte des
+blobs orphelins (manage.py gc_media) et migration des fichiers existants (manage.py dedupe_media)
+"""
+import hashlib
+import os
+import shutil
+import time
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Blob, Fichier
+from .stockage import DOSSIER_BLOBS, DOSSIER_TEMPORAIRE, empreinte_du_nom, nom_blob
+
+
+# Un blob non reference n'est supprime qu'apres ce delai (upload en cours d'enregistrement)
+GC_DELAI = 24 * 60 * 60
+DEDOUBLONNAGE_LOT = 100
+
+
+def stockage():
+    return Fichier._meta.get_field('fichier').storage
+
+
+def _taille(nom):
+    try:
+        return stockage().size(nom)
+    except OSError:
+        return 0
+
+
+def referencer(nom, delta):
+    """Ajoute `delta` references au blob `nom`, cree a sa premiere reference ; ignore les autres noms"""
+    empreinte = empreinte_du_nom(nom)
+    if not empreinte or not delta:
+        return
+    if delta < 0:
+        Blob.objects.filter(nom=nom, nb_references__gte=-delta).update(nb_references=F('nb_references') + delta)
+        return
+    if Blob.objects.filter(nom=nom).update(nb_references=F('nb_references') + delta):
+        return
+    try:
+        with transaction.atomic():
+            Blob.objects.create(nom=nom, empreinte=empreinte, taille=_taille(nom), nb_references=delta)
+    except IntegrityError:
+        # Cree entre-temps par un autre upload du meme contenu
+        Blob.objects.filter(nom=nom).update(nb_references=F('nb_references') + delta)
+
+
+# ==================== RECOMPTAGE ET COLLECTE ====================
+
+def recompter_references():
+    """
+    Recalcule nb_references depuis les Fichier (bulk updates, suppressions SQL...) et cree les
+    Blob manquants. Retourne le nombre de blobs crees.
+    """
+    references = (
+        Fichier.objects.filter(fichier=OuterRef('nom')).order_by().values('fichier')
+        .annotate(total=Count('*')).values('total')[:1]
+    )
+    Blob.objects.update(nb_references=Coalesce(Subquery(references, output_field=IntegerField()), 0))
+
+    connus = set(Blob.objects.values_list('nom', flat=True))
+    manquants = (
+        Fichier.objects.filter(fichier__startswith=f'{DOSSIER_BLOBS}/').exclude(fichier__in=connus)
+        .order_by().values('fichier').annotate(total=Count('*')).values_list('fichier', 'total')
+    )
+    crees = [
+        Blob(nom=nom, empreinte=empreinte_du_nom(nom), taille=_taille(nom), nb_references=total)
+        for nom, total in manquants if empreinte_du_nom(nom)
+    ]
+    Blob.objects.bulk_create(crees, ignore_conflicts=True)
+    return len(crees)
+
+
+def _ancien(chemin, delai):
+    try:
+        return os.path.getmtime(chemin) < time.time() - delai
+    except FileNotFoundError:
+        return False
+
+
+def collecter(delai=GC_DELAI, simulation=False):
+    """
+    Supprime les blobs sans reference depuis plus de `delai` secondes, les fichiers de blobs/
+    inconnus de la table Blob (uploads interrompus) et les fichiers temporaires abandonnes.
+    Retourne (fichiers supprimes, octets liberes).
+    """
+    recompter_references()
+    racine = stockage().path(DOSSIER_BLOBS)
+    supprimes = liberes = 0
+
+    def supprimer(chemin):
+        nonlocal supprimes, liberes
+        liberes += os.path.getsize(chemin)
+        supprimes += 1
+        if not simulation:
+            os.remove(chemin)
+
+    orphelins = Blob.objects.filter(nb_references=0)
+    for blob in orphelins.iterator():
+        chemin = stockage().path(blob.nom)
+        if not os.path.exists(chemin):
+            if not simulation:
+                blob.delete()
+            continue
+        if not _ancien(chemin, delai):
+            continue
+        with transaction.atomic():
+            # Reference ajoutee depuis le recomptage : le blob est garde
+            verrouille = Blob.objects.select_for_update().filter(pk=blob.pk, nb_references=0).exists()
+            if verrouille and not Fichier.objects.filter(fichier=blob.nom).exists():
+                supprimer(chemin)
+                if not simulation:
+                    blob.delete()
+
+    connus = set(Blob.objects.values_list('nom', flat=True))
+    for dossier, _, noms in os.walk(racine):
+        for nom in noms:
+            chemin = os.path.join(dossier, nom)
+            relatif = os.path.relpath(chemin, stockage().location).replace(os.sep, '/')
+            temporaire = relatif.startswith(f'{DOSSIER_TEMPORAIRE}/')
+            if (temporaire or relatif not in connus) and _ancien(chemin, delai):
+                if not temporaire and Fichier.objects.filter(fichier=relatif).exists():
+                    continue
+                supprimer(chemin)
+    return supprimes, liberes
+
+
+# ==================== MIGRATION DES FICHIERS EXISTANTS ====================
+
+def _empreinte(chemin):
+    contenu = hashlib.sha256()
+    with open(chemin, 'rb') as fichier:
+        for bloc in iter(lambda: fichier.read(1024 * 1024), b''):
+            contenu.update(bloc)
+    return contenu.hexdigest()
+
+
+def dedoublonner_lot(apres_pk=0, taille=DEDOUBLONNAGE_LOT, simulation=False, empreintes_vues=None):
+    """
+    Deplace vers leur blob les fichiers anterieurs au stockage par contenu, par lot de pk
+    croissants apres `apres_pk` : le premier exemplaire d'un contenu devient le blob (lien dur),
+    les copies suivantes sont supprimees. `empreintes_vues` (simulation) garde les contenus
+    deja comptes d'un lot a l'autre.
+    Retourne (dernier pk du lot, fichiers traites, octets liberes) ; dernier pk None a la fin.
+    """
+    lot = list(
+        Fichier.objects.filter(pk__gt=apres_pk)
+        .exclude(Q(fichier='') | Q(fichier__isnull=True) | Q(fichier__startswith=f'{DOSSIER_BLOBS}/'))
+        .order_by('pk').values_list('pk', 'fichier')[:taille]
+    )
+    if not lot:
+        return None, 0, 0
+    empreintes_vues = set() if empreintes_vues is None else empreintes_vues
+    liberes = 0
+    for pk, ancien in lot:
+        chemin = stockage().path(ancien)
+        if not os.path.exists(chemin):
+            continue
+        empreinte = _empreinte(chemin)
+        nom = nom_blob(empreinte, os.path.splitext(ancien)[1])
+        destination = stockage().path(nom)
+        existait = os.path.exists(destination) or (simulation and nom in empreintes_vues)
+        if simulation:
+            empreintes_vues.add(nom)
+            liberes += os.path.getsize(chemin) if existait else 0
+            continue
+
+        if not existait:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            try:
+                # Meme systeme de fichiers : le blob partage les octets de l'original
+                os.link(chemin, destination)
+            except OSError:
+                shutil.copy2(chemin, destination)
+        with transaction.atomic():
+            # update() : ni date_modification, ni retraitement par process_media (meme contenu)
+            Fichier.objects.filter(pk=pk, fichier=ancien).update(fichier=nom, empreinte=empreinte)
+            referencer(nom, 1)
+        # Ancien chemin eventuellement partage par d'autres Fichier : supprime au dernier
+        if not Fichier.objects.filter(fichier=ancien).exists():
+            if not os.path.samefile(chemin, destination):
+                liberes += os.path.getsize(chemin)
+            os.remove(chemin)
+    return lot[-1][0], len(lot), liberes
@@ -0,0 +1,79 @@
+"""Droits d'acces des utilisateurs aux niveaux, mis en cache par utilisateur"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Abonnement
+
+
+DROITS_CACHE_VERSION = 1
+# Duree maximale de mise en cache ; bornee en plus par la premiere date_fin
+DROITS_CACHE_TIMEOUT = getattr(settings, 'DROITS_CACHE_TIMEOUT', 15 * 60)
+
+
+def droits_cache_key(user_id):
+    return f"droits:v{DROITS_CACHE_VERSION}:user:{user_id}"
+
+
+def charger_droits(user_id):
+    """
+    Charge en une requete les niveaux actuellement accessibles a l'utilisateur :
+    {niveau_id: (abonnement_id, timestamp de date_fin ou None)}
+    """
+    lignes = (
+        Abonnement.objects.filter(user_id=user_id, statut='ACTIF')
+        .filter(Q(date_fin__isnull=True) | Q(date_fin__gt=timezone.now()))
+        .values_list('niveau_id', 'id', 'date_fin')
+    )
+    return {
+        niveau_id: (abonnement_id, date_fin.timestamp() if date_fin else None)
+        for niveau_id, abonnement_id, date_fin in lignes
+    }
+
+
+def _timeout(droits):
+    """Le cache expire au plus tard a la premiere date_fin des abonnements charges"""
+    fins = [fin for _, fin in droits.values() if fin is not None]
+    timeout = DROITS_CACHE_TIMEOUT
+    if fins:
+        timeout = min(timeout, max(1, int(min(fins) - time.time())))
+    return timeout
+
+
+def get_droits(user):
+    """Droits valides de l'utilisateur, depuis le cache partage (memorises aussi sur l'objet user)"""
+    droits = getattr(user, '_droits_niveaux', None)
+    if droits is None:
+        cle = droits_cache_key(user.pk)
+        droits = cache.get(cle)
+        if droits is None:
+            droits = charger_droits(user.pk)
+            cache.set(cle, droits, _timeout(droits))
+        user._droits_niveaux = droits
+
+    maintenant = time.time()
+    return {
+        niveau_id: droit for niveau_id, droit in droits.items()
+        if droit[1] is None or droit[1] > maintenant
+    }
+
+
+def abonnement_valide(user, niveau_id):
+    """Retourne (abonnement_id, timestamp date_fin) si l'utilisateur a acces au niveau, sinon None"""
+    if not user.is_authenticated:
+        return None
+    return get_droits(user).get(int(niveau_id))
+
+
+def a_acces(user, niveau_id):
+    """Vrai si l'utilisateur a un abonnement actif et non expire pour ce niveau"""
+    return abonnement_valide(user, niveau_id) is not None
+
+
+def invalider_droits(*user_ids):
+    cles = [droits_cache_key(user_id) for user_id in set(user_ids) if user_id]
+    if cles:
+        cache.delete_many(cles)
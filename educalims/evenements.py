@@ -0,0 +1,116 @@
+"""
+Changements de statut des abonnements diffuses en temps reel (page de paiement).
+
+Les activations et echecs publient un NOTIFY Postgres sur le canal CANAL_STATUT.
+Dans chaque processus ASGI, un seul `Ecouteur` fait LISTEN sur une connexion dediee
+et reveille les clients SSE qui attendent l'abonnement concerne.
+"""
+import asyncio
+import json
+import logging
+from collections import defaultdict
+
+from django.db import connection, connections
+
+logger = logging.getLogger(__name__)
+
+CANAL_STATUT = 'abonnement_statut'
+# Cle d'abonnement recevant les changements de tous les abonnements (flux de l'admin)
+TOUS = '*'
+# Delai avant reconnexion apres la perte de la connexion LISTEN
+RECONNEXION_DELAI = 2
+
+
+def publier_statut(abonnement_id, statut):
+    """
+    Publie le nouveau statut d'un abonnement. NOTIFY est transactionnel :
+    le message part au COMMIT et disparait en cas de ROLLBACK.
+    """
+    if connection.vendor != 'postgresql':
+        return
+    payload = json.dumps({'id': abonnement_id, 'statut': statut})
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_notify(%s, %s)", [CANAL_STATUT, payload])
+
+
+class Ecouteur:
+    """Une connexion LISTEN par processus, diffusee a toutes les files des clients en attente"""
+
+    def __init__(self, canal=CANAL_STATUT):
+        self.canal = canal
+        self.abonnes = defaultdict(set)
+        self._tache = None
+
+    def abonner(self, abonnement_id):
+        """File recevant les statuts publies pour cet abonnement (a liberer avec desabonner)"""
+        file = asyncio.Queue()
+        self.abonnes[abonnement_id].add(file)
+        if connections['default'].vendor == 'postgresql' and (self._tache is None or self._tache.done()):
+            self._tache = asyncio.get_running_loop().create_task(self._ecouter())
+        return file
+
+    def desabonner(self, abonnement_id, file):
+        files = self.abonnes.get(abonnement_id)
+        if files is not None:
+            files.discard(file)
+            if not files:
+                del self.abonnes[abonnement_id]
+
+    def _diffuser(self, abonnement_id, message):
+        for file in list(self.abonnes.get(abonnement_id, ())):
+            file.put_nowait(message)
+
+    def _resynchroniser(self):
+        """Des NOTIFY ont pu etre emis avant le LISTEN : chaque client relit la base"""
+        for abonnement_id in list(self.abonnes):
+            self._diffuser(abonnement_id, None)
+
+    def _connecter(self):
+        import psycopg2
+        import psycopg2.extensions
+
+        params = connections['default'].get_connection_params()
+        params.pop('cursor_factory', None)
+        conn = psycopg2.connect(**params)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cursor:
+            cursor.execute(f'LISTEN "{self.canal}"')
+        return conn
+
+    async def _ecouter(self):
+        loop = asyncio.get_running_loop()
+        while self.abonnes:
+            conn = None
+            try:
+                conn = await asyncio.to_thread(self._connecter)
+                self._resynchroniser()
+                lisible = asyncio.Event()
+                loop.add_reader(conn.fileno(), lisible.set)
+                try:
+                    # Plus personne n'attend : on libere la connexion
+                    while self.abonnes:
+                        try:
+                            await asyncio.wait_for(lisible.wait(), timeout=30)
+                        except asyncio.TimeoutError:
+                            continue
+                        lisible.clear()
+                        conn.poll()
+                        while conn.notifies:
+                            notification = conn.notifies.pop(0)
+                            try:
+                                message = json.loads(notification.payload)
+                            except ValueError:
+                                continue
+                            self._diffuser(message.get('id'), message)
+                            self._diffuser(TOUS, message)
+                finally:
+                    loop.remove_reader(conn.fileno())
+            except Exception as e:
+                logger.warning(f"Connexion LISTEN {self.canal} perdue: {e}")
+                await asyncio.sleep(RECONNEXION_DELAI)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+ecouteur = Ecouteur()
@@ -0,0 +1,101 @@
+"""
+Balayages des abonnements par lots : expiration (ACTIF -> EXPIRE une fois date_fin depassee)
+et annulation des paiements abandonnes (EN_ATTENTE trop ancien -> ANNULE)
+"""
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .entitlements import invalider_droits
+from .evenements import publier_statut
+from .models import Abonnement
+from .statistiques import COMPTEURS, incrementer, modifier_en_attente
+
+
+EXPIRATION_LOT = 1000
+# Age au-dela duquel un abonnement EN_ATTENTE est annule (superieur a la fenetre de rapprochement)
+ATTENTE_DUREE_MAX = getattr(settings, 'ABONNEMENT_ATTENTE_DUREE', 24 * 60 * 60)
+
+
+def par_lots(traiter, taille, rapporter=None):
+    """
+    Appelle traiter() (un lot, retourne le nombre de lignes traitees) jusqu'a un lot vide ou
+    incomplet. `rapporter(numero, nombre, duree en secondes)` est appele apres chaque lot.
+    Retourne (total, nombre de lots).
+    """
+    total = lots = 0
+    while True:
+        debut = time.monotonic()
+        nombre = traiter()
+        if not nombre:
+            break
+        lots += 1
+        total += nombre
+        if rapporter:
+            rapporter(lots, nombre, time.monotonic() - debut)
+        if nombre < taille:
+            break
+    return total, lots
+
+
+def _changer_statut_lot(queryset, statut, taille):
+    """
+    Passe au plus `taille` abonnements du queryset au `statut`, en un UPDATE.
+    Les lignes sont verrouillees avec SKIP LOCKED : plusieurs balayages peuvent tourner
+    en meme temps sans se bloquer. Le bulk update ne declenche pas les signaux : droits en
+    cache, statistiques et flux de l'admin sont mis a jour ici. Retourne le nombre modifie.
+    """
+    with transaction.atomic():
+        lignes = list(
+            queryset.select_for_update(skip_locked=True, of=('self',))
+            .values_list(
+                'id', 'user_id', 'niveau_id', 'methode_paiement', 'statut', 'date_creation',
+                Coalesce('user__profile__recommande_par', Value('aucun')),
+            )[:taille]
+        )
+        if not lignes:
+            return 0
+
+        Abonnement.objects.filter(pk__in=[ligne[0] for ligne in lignes]).update(
+            statut=statut, date_modification=timezone.now()
+        )
+
+        jour = timezone.localdate()
+        groupes = Counter((operateur, niveau_id, ref) for _, _, niveau_id, operateur, _, _, ref in lignes)
+        for (operateur, niveau_id, ref), nombre in groupes.items():
+            incrementer(jour, operateur, niveau_id, ref, **{COMPTEURS[statut]: nombre})
+        attentes = Counter(
+            (timezone.localdate(creation), ref)
+            for _, _, _, _, ancien, creation, ref in lignes if ancien == 'EN_ATTENTE'
+        )
+        for (jour_creation, ref), nombre in attentes.items():
+            modifier_en_attente(jour_creation, ref, -nombre)
+
+        # Un seul NOTIFY par lot : reveille le widget des paiements recents de l'admin
+        publier_statut(None, statut)
+        user_ids = {ligne[1] for ligne in lignes}
+        transaction.on_commit(lambda: invalider_droits(*user_ids))
+    return len(lignes)
+
+
+def expirer_lot(taille=EXPIRATION_LOT, maintenant=None):
+    """Expire au plus `taille` abonnements ACTIF dont date_fin est depassee (index statut, date_fin)"""
+    maintenant = maintenant or timezone.now()
+    queryset = Abonnement.objects.filter(statut='ACTIF', date_fin__lte=maintenant).order_by('date_fin', 'id')
+    return _changer_statut_lot(queryset, 'EXPIRE', taille)
+
+
+def annuler_attentes_lot(taille=EXPIRATION_LOT, age=ATTENTE_DUREE_MAX):
+    """Annule au plus `taille` abonnements EN_ATTENTE crees il y a plus de `age` secondes"""
+    limite = timezone.now() - timedelta(seconds=age)
+    queryset = (
+        Abonnement.objects.filter(statut='EN_ATTENTE', date_creation__lt=limite)
+        .order_by('date_creation', 'id')
+    )
+    return _changer_statut_lot(queryset, 'ANNULE', taille)
@@ -0,0 +1,34 @@
+"""Reconstruction du chemin materialise de la hierarchie des unites"""
+from django.db.models import CharField, OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Concat
+
+
+def reconstruire_chemins(Unite=None):
+    """
+    Recalcule chemin et profondeur de toutes les unites, niveau par niveau :
+    un UPDATE ensembliste par profondeur de l'arbre.
+    `Unite` permet de passer le modele historique depuis une migration.
+    Retourne le nombre d'unites mises a jour par profondeur.
+    """
+    if Unite is None:
+        from .models import Unite
+
+    racines = Unite.objects.filter(unite_parent__isnull=True)
+    ids_niveau = list(racines.values_list('pk', flat=True))
+    racines.update(chemin=Concat(Cast('pk', CharField()), Value('/')), profondeur=0)
+    comptes = [len(ids_niveau)]
+
+    profondeur = 0
+    while ids_niveau:
+        profondeur += 1
+        enfants = Unite.objects.filter(unite_parent_id__in=ids_niveau)
+        ids_niveau = list(enfants.values_list('pk', flat=True))
+        if not ids_niveau:
+            break
+        chemin_parent = Unite.objects.filter(pk=OuterRef('unite_parent_id')).values('chemin')[:1]
+        Unite.objects.filter(pk__in=ids_niveau).update(
+            chemin=Concat(Subquery(chemin_parent), Cast('pk', CharField()), Value('/'), output_field=CharField()),
+            profondeur=profondeur,
+        )
+        comptes.append(len(ids_niveau))
+    return comptes
@@ -0,0 +1,216 @@
+import re
+import time
+from datetime import date, timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from educalims.models import Abonnement, Cycle, Niveau, Produit, WebhookLog
+
+
+class Rollback(Exception):
+    pass
+
+
+DUREE_EXECUTION = re.compile(r'Execution Time: ([\d.]+) ms')
+
+
+def _inserer_serie(modele, debut, nombre, expressions, jointure=''):
+    """
+    INSERT ... SELECT sur generate_series(debut, debut + nombre - 1) AS i : `expressions`
+    donne le SQL de certaines colonnes, les autres recoivent leur valeur par defaut Django.
+    Retourne la duree en secondes.
+    """
+    colonnes, valeurs, params = [], [], []
+    for champ in modele._meta.concrete_fields:
+        if champ.primary_key:
+            continue
+        colonnes.append(connection.ops.quote_name(champ.column))
+        if champ.column in expressions:
+            valeurs.append(expressions[champ.column])
+        else:
+            valeurs.append('%s')
+            params.append(champ.get_db_prep_save(champ.get_default(), connection))
+    sql = (
+        f"INSERT INTO {connection.ops.quote_name(modele._meta.db_table)} ({', '.join(colonnes)}) "
+        f"SELECT {', '.join(valeurs)} FROM generate_series(%s, %s) AS i {jointure}"
+    )
+    debut_insertion = time.perf_counter()
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params + [debut, debut + nombre - 1])
+    return time.perf_counter() - debut_insertion
+
+
+class Command(BaseCommand):
+    help = (
+        "Genere des abonnements et webhooks synthetiques puis compare (EXPLAIN ANALYZE) les requetes "
+        "frequentes avec et sans les index d'Abonnement et WebhookLog, ainsi que le cout en ecriture. "
+        "Postgres uniquement ; toutes les ecritures sont annulees a la fin."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lignes', type=int, default=1_000_000, help="Abonnements synthetiques")
+        parser.add_argument('--webhooks', type=int, default=None, help="Webhooks synthetiques (defaut: --lignes)")
+        parser.add_argument('--ecritures', type=int, default=10_000,
+                            help="Abonnements inseres pour mesurer le cout des index en ecriture")
+        parser.add_argument('--repetitions', type=int, default=3, help="Executions par requete (meilleur temps)")
+
+    # ---------- Donnees synthetiques ----------
+
+    def preparer(self, lignes, webhooks, ecritures):
+        cycle = Cycle.objects.create(nom=f"BENCH-{time.time_ns()}")
+        self.niveau = Niveau.objects.create(nom='BENCH', cycle=cycle)
+        self.produit = Produit.objects.create(nom='BENCH', prix=1000, date_expiration=date.today() + timedelta(days=365))
+
+        # Aussi les utilisateurs des abonnements inseres pour la mesure en ecriture
+        utilisateurs = (lignes + ecritures) // 10 + 1
+        duree = _inserer_serie(User, 0, utilisateurs, {
+            'username': "'bench_' || i",
+            'date_joined': "now() - (i % 365) * interval '1 day'",
+        })
+        self.stdout.write(f"{utilisateurs} utilisateurs generes en {duree:.1f}s")
+        duree = self.generer_abonnements(0, lignes)
+        self.stdout.write(f"{lignes} abonnements generes en {duree:.1f}s")
+
+        operateurs = "(ARRAY['airtel_money', 'moov_money'])[i % 2 + 1]"
+        duree = _inserer_serie(WebhookLog, 0, webhooks, {
+            'merchant_reference_id': "'BENCH-' || i",
+            'transaction_id': "'BENCH-TX-' || i",
+            'status': "CASE WHEN i % 5 = 0 THEN 'FAILED' ELSE 'SUCCESS' END",
+            'code': "CASE WHEN i % 5 = 0 THEN 402 ELSE 200 END",
+            'operator': operateurs,
+            'amount': '1000',
+            'created_at': "now() - (i % 525600) * interval '1 minute'",
+            # Quelques webhooks encore a traiter par le worker
+            'traite_le': "CASE WHEN i % 1000 = 0 THEN NULL ELSE now() END",
+        })
+        self.stdout.write(f"{webhooks} webhooks generes en {duree:.1f}s")
+
+        with connection.cursor() as cursor:
+            # Verifie maintenant les cles etrangeres differees : Postgres refuse DROP INDEX
+            # sur une table ayant des evenements de trigger en attente
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            for modele in (User, Abonnement, WebhookLog):
+                cursor.execute(f"ANALYZE {connection.ops.quote_name(modele._meta.db_table)}")
+
+        # Utilisateur du milieu de la serie pour les requetes par utilisateur
+        self.user_id = User.objects.get(username=f"bench_{lignes // 20}").pk
+
+    def generer_abonnements(self, debut, nombre):
+        """Dix abonnements par utilisateur, dont un seul ACTIF (contrainte unique par niveau)"""
+        statut = (
+            "CASE i % 10 WHEN 0 THEN 'ACTIF' WHEN 1 THEN 'EN_ATTENTE' WHEN 2 THEN 'ECHOUE' "
+            "WHEN 3 THEN 'ECHOUE' WHEN 4 THEN 'ANNULE' WHEN 5 THEN 'ANNULE' ELSE 'EXPIRE' END"
+        )
+        creation = "now() - (i % 525600) * interval '1 minute'"
+        return _inserer_serie(Abonnement, debut, nombre, {
+            'user_id': 'u.id',
+            'niveau_id': str(self.niveau.pk),
+            'produit_id': str(self.produit.pk),
+            'statut': statut,
+            'reference_interne': "'BENCH-SUB-' || i",
+            'merchant_reference_id': "'BENCH-' || i",
+            'methode_paiement': "(ARRAY['airtel_money', 'moov_money'])[i % 2 + 1]",
+            'montant_paye': '1000',
+            'date_debut': creation,
+            'date_fin': f"{creation} + interval '180 days'",
+            'date_creation': creation,
+            'date_modification': f"{creation} + interval '1 hour'",
+        }, jointure=f"JOIN {User._meta.db_table} u ON u.username = 'bench_' || (i / 10)")
+
+    # ---------- Mesures ----------
+
+    def requetes(self):
+        maintenant = timezone.now()
+        user_id, niveau_id = self.user_id, self.niveau.pk
+        return [
+            ("droits (user, ACTIF, date_fin)", lambda: Abonnement.objects.filter(user_id=user_id, statut='ACTIF')
+                .filter(Q(date_fin__isnull=True) | Q(date_fin__gt=maintenant))),
+            ("acces (user, niveau, statut)", lambda: Abonnement.objects.filter(
+                user_id=user_id, niveau_id=niveau_id, statut='ACTIF')),
+            ("mes abonnements", lambda: Abonnement.objects.filter(user_id=user_id).order_by('-date_creation')),
+            ("dashboard en attente", lambda: Abonnement.objects.filter(statut='EN_ATTENTE')
+                .order_by('-date_creation')[:10]),
+            ("paiements recents", lambda: Abonnement.objects.filter(
+                date_modification__gte=maintenant - timedelta(minutes=10)).order_by('-date_modification', '-pk')[:20]),
+            ("reference marchand", lambda: Abonnement.objects.filter(merchant_reference_id='BENCH-12345')),
+            ("expiration (ACTIF, date_fin)", lambda: Abonnement.objects.filter(
+                statut='ACTIF', date_fin__lte=maintenant).order_by('date_fin', 'id')[:1000]),
+            ("webhooks admin", lambda: WebhookLog.objects.order_by('-created_at')[:100]),
+            ("webhooks par statut", lambda: WebhookLog.objects.filter(status='FAILED').order_by('-created_at')[:100]),
+            ("webhooks par operateur", lambda: WebhookLog.objects.filter(operator='moov_money')
+                .order_by('-created_at')[:100]),
+            ("webhooks a traiter", lambda: WebhookLog.objects.filter(provider='cyberschool', traite_le__isnull=True)
+                .order_by('created_at')[:50]),
+        ]
+
+    def mesurer_requetes(self, repetitions):
+        durees = {}
+        for libelle, queryset in self.requetes():
+            mesures = []
+            for _ in range(repetitions):
+                plan = queryset().explain(analyze=True)
+                trouve = DUREE_EXECUTION.search(plan)
+                mesures.append(float(trouve.group(1)) if trouve else float('nan'))
+            durees[libelle] = min(mesures)
+        return durees
+
+    def mesurer_ecriture(self, debut, nombre):
+        """Duree d'insertion de `nombre` abonnements, annulee aussitot"""
+        try:
+            with transaction.atomic():
+                duree = self.generer_abonnements(debut, nombre)
+                raise Rollback
+        except Rollback:
+            pass
+        return duree
+
+    def supprimer_index(self):
+        """Supprime les index et contraintes declares des deux modeles (dans la transaction courante)"""
+        noms = []
+        with connection.schema_editor(atomic=False) as schema_editor:
+            for modele in (Abonnement, WebhookLog):
+                for index in modele._meta.indexes:
+                    schema_editor.remove_index(modele, index)
+                    noms.append(index.name)
+                for contrainte in modele._meta.constraints:
+                    schema_editor.remove_constraint(modele, contrainte)
+                    noms.append(contrainte.name)
+        return noms
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("Benchmark reserve a Postgres (EXPLAIN ANALYZE, generate_series)")
+        lignes = options['lignes']
+        webhooks = options['webhooks'] if options['webhooks'] is not None else lignes
+        ecritures = options['ecritures']
+
+        try:
+            with transaction.atomic():
+                self.preparer(lignes, webhooks, ecritures)
+                avec = self.mesurer_requetes(options['repetitions'])
+                ecriture_avec = self.mesurer_ecriture(lignes, ecritures)
+                try:
+                    with transaction.atomic():
+                        noms = self.supprimer_index()
+                        self.stdout.write(f"Index retires pour la mesure 'sans' : {', '.join(noms)}")
+                        sans = self.mesurer_requetes(options['repetitions'])
+                        ecriture_sans = self.mesurer_ecriture(lignes, ecritures)
+                        raise Rollback
+                except Rollback:
+                    pass
+                raise Rollback
+        except Rollback:
+            pass
+
+        self.stdout.write(f"\n{'requete':<32} {'sans index':>12} {'avec index':>12} {'gain':>8}")
+        for libelle, duree in avec.items():
+            gain = sans[libelle] / duree if duree else float('inf')
+            self.stdout.write(f"{libelle:<32} {sans[libelle]:>10.2f}ms {duree:>10.2f}ms {gain:>7.1f}x")
+        self.stdout.write(
+            f"{f'insertion de {ecritures} abonnements':<32} {ecriture_sans * 1000:>10.0f}ms "
+            f"{ecriture_avec * 1000:>10.0f}ms {ecriture_avec / ecriture_sans if ecriture_sans else 0:>6.2f}x cout"
+        )
@@ -0,0 +1,82 @@
+import json
+import logging
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from educalims.webhooks import traiter_webhooks_en_attente
+
+
+class Rollback(Exception):
+    pass
+
+
+def _centile(valeurs, p):
+    valeurs = sorted(valeurs)
+    return valeurs[min(len(valeurs) - 1, int(round(p / 100 * (len(valeurs) - 1))))]
+
+
+class Command(BaseCommand):
+    help = ("Mesure la latence du webhook Cyberschool (p50/p95/p99) en mode synchrone et differe. "
+            "Toutes les ecritures sont annulees a la fin.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requetes', type=int, default=200, help="Webhooks simules par mode")
+
+    def payload(self, i):
+        return json.dumps({
+            'merchantReferenceId': f'BENCH-{i}',
+            'code': 200 if i % 5 else 402,
+            'status': 'SUCCESS' if i % 5 else 'FAILED',
+            'amount': 1000,
+            'operator': 'AIRTEL',
+            'transactionId': f'BENCH-TX-{i}',
+            'numero_tel': f'07{i:07d}',
+        })
+
+    def mesurer(self, client, url, n):
+        durees = []
+        for i in range(n):
+            debut = time.perf_counter()
+            reponse = client.post(url, self.payload(i), content_type='application/json')
+            durees.append((time.perf_counter() - debut) * 1000)
+            if reponse.status_code != 200:
+                self.stderr.write(f"Reponse inattendue {reponse.status_code}: {reponse.content[:200]}")
+        return durees
+
+    def afficher(self, mode, durees):
+        self.stdout.write(
+            f"{mode:<10} n={len(durees)}  p50={_centile(durees, 50):.1f}ms  "
+            f"p95={_centile(durees, 95):.1f}ms  p99={_centile(durees, 99):.1f}ms  "
+            f"max={max(durees):.1f}ms  moy={statistics.mean(durees):.1f}ms"
+        )
+
+    def handle(self, *args, **options):
+        n = options['requetes']
+        url = reverse('educalims:webhook_cyberschool_simple')
+        client = Client()
+        # Les logs par webhook fausseraient la lecture des resultats
+        logging.disable(logging.WARNING)
+
+        for mode, differe in (('synchrone', False), ('differe', True)):
+            try:
+                with transaction.atomic(), override_settings(WEBHOOK_TRAITEMENT_DIFFERE=differe):
+                    self.afficher(mode, self.mesurer(client, url, n))
+                    if differe:
+                        debut = time.perf_counter()
+                        traites = 0
+                        while lot := traiter_webhooks_en_attente(limite=50):
+                            traites += lot
+                        duree = time.perf_counter() - debut
+                        self.stdout.write(
+                            f"{'worker':<10} {traites} webhooks traites en {duree:.2f}s "
+                            f"({traites / duree if duree else 0:.0f}/s)"
+                        )
+                    raise Rollback
+            except Rollback:
+                pass
+        logging.disable(logging.NOTSET)
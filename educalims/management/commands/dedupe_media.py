@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+
+from educalims.dedoublonnage import DEDOUBLONNAGE_LOT, dedoublonner_lot, recompter_references
+
+
+class Command(BaseCommand):
+    help = "Deplace les fichiers existants vers le stockage par contenu (un blob par contenu distinct)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lot', type=int, default=DEDOUBLONNAGE_LOT, help="Fichiers traites par lot")
+        parser.add_argument('--simulation', action='store_true',
+                            help="Compte les doublons et l'espace recuperable sans rien modifier")
+
+    def handle(self, *args, **options):
+        debut = time.monotonic()
+        dernier_pk, total, liberes = 0, 0, 0
+        empreintes_vues = set()
+        while True:
+            lot_debut = time.monotonic()
+            dernier_pk, traites, octets = dedoublonner_lot(
+                dernier_pk, options['lot'], options['simulation'], empreintes_vues
+            )
+            if dernier_pk is None:
+                break
+            total += traites
+            liberes += octets
+            self.stdout.write(
+                f"{traites} fichier(s) jusqu'au pk {dernier_pk}, {filesizeformat(octets)} "
+                f"en {time.monotonic() - lot_debut:.2f}s"
+            )
+
+        if not options['simulation']:
+            recompter_references()
+        verbe = "recuperables" if options['simulation'] else "liberes"
+        self.stdout.write(self.style.SUCCESS(
+            f"{total} fichier(s) traite(s), {filesizeformat(liberes)} {verbe} "
+            f"en {time.monotonic() - debut:.2f}s"
+        ))
@@ -0,0 +1,44 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from educalims.expiration import EXPIRATION_LOT, expirer_lot, par_lots
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Passe a EXPIRE les abonnements ACTIF dont la date de fin est depassee, par lots"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lot', type=int, default=EXPIRATION_LOT, help="Abonnements expires par UPDATE")
+        parser.add_argument('--boucle', action='store_true',
+                            help="Tourne en continu (planificateur) au lieu de s'arreter une fois tout expire")
+        parser.add_argument('--intervalle', type=float, default=300,
+                            help="Pause en secondes entre deux balayages en mode --boucle")
+
+    def balayer(self, taille):
+        """Expire par lots jusqu'a epuisement ; retourne le total"""
+        debut = time.monotonic()
+        total, lots = par_lots(lambda: expirer_lot(taille), taille, lambda numero, nombre, duree: self.stdout.write(
+            f"Lot {numero}: {nombre} abonnement(s) expire(s) en {duree * 1000:.0f} ms"
+        ))
+        if total:
+            self.stdout.write(self.style.SUCCESS(
+                f"{total} abonnement(s) expire(s) en {lots} lot(s), {time.monotonic() - debut:.2f}s"
+            ))
+        return total
+
+    def handle(self, *args, **options):
+        if not options['boucle']:
+            self.balayer(options['lot'])
+            return
+
+        self.stdout.write("Balayage des expirations demarre")
+        while True:
+            try:
+                self.balayer(options['lot'])
+            except Exception as e:
+                logger.error(f"Erreur du balayage des expirations: {e}", exc_info=True)
+            time.sleep(options['intervalle'])
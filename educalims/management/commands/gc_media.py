@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+
+from educalims.dedoublonnage import GC_DELAI, collecter
+
+
+class Command(BaseCommand):
+    help = "Supprime les blobs du stockage par contenu qui ne sont plus references par aucun Fichier"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delai', type=float, default=GC_DELAI / 3600,
+                            help="Age minimal en heures d'un blob non reference avant suppression (defaut: 24)")
+        parser.add_argument('--simulation', action='store_true', help="Affiche ce qui serait supprime sans rien supprimer")
+
+    def handle(self, *args, **options):
+        debut = time.monotonic()
+        supprimes, liberes = collecter(delai=options['delai'] * 3600, simulation=options['simulation'])
+        duree = time.monotonic() - debut
+
+        verbe = "a supprimer" if options['simulation'] else "supprime(s)"
+        self.stdout.write(self.style.SUCCESS(
+            f"{supprimes} fichier(s) {verbe}, {filesizeformat(liberes)} en {duree:.2f}s"
+        ))
@@ -0,0 +1,49 @@
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from educalims.traitement_medias import traiter_lot
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Traite les fichiers uploades (taille, empreinte, pages et metadonnees PDF, miniatures, "
+        "variantes d'image) dans un pool de processus"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processus', type=int, default=os.cpu_count() or 1,
+                            help="Processus d'analyse (defaut: nombre de coeurs)")
+        parser.add_argument('--lot', type=int, default=None,
+                            help="Fichiers traites par lot (defaut: 4 par processus)")
+        parser.add_argument('--intervalle', type=float, default=10.0,
+                            help="Pause en secondes quand il n'y a rien a traiter")
+        parser.add_argument('--une-fois', action='store_true', help="Traite les fichiers en attente puis s'arrete")
+
+    def handle(self, *args, **options):
+        processus = max(1, options['processus'])
+        taille = options['lot'] or 4 * processus
+        # spawn : pas de connexion a la base ni d'etat Django herites dans les processus d'analyse
+        contexte = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=processus, mp_context=contexte) as executeur:
+            self.stdout.write(f"Worker medias demarre ({processus} processus)")
+            while True:
+                debut = time.monotonic()
+                try:
+                    traites = traiter_lot(executeur, taille)
+                except Exception as e:
+                    logger.error(f"Erreur du worker medias: {e}", exc_info=True)
+                    traites = 0
+                if traites:
+                    self.stdout.write(f"{traites} fichier(s) traite(s) en {time.monotonic() - debut:.2f}s")
+
+                if options['une_fois'] and traites < taille:
+                    break
+                if not traites:
+                    time.sleep(options['intervalle'])
@@ -0,0 +1,32 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from educalims.webhooks import traiter_webhooks_en_attente
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Traite les webhooks Cyberschool enregistres (rapprochement, activation, notifications)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lot', type=int, default=50, help="Webhooks traites par lot")
+        parser.add_argument('--intervalle', type=float, default=1.0,
+                            help="Pause en secondes quand il n'y a rien a traiter")
+        parser.add_argument('--une-fois', action='store_true', help="Traite les webhooks en attente puis s'arrete")
+
+    def handle(self, *args, **options):
+        self.stdout.write("Worker webhooks demarre")
+        while True:
+            try:
+                traites = traiter_webhooks_en_attente(limite=options['lot'])
+            except Exception as e:
+                logger.error(f"Erreur du worker webhooks: {e}", exc_info=True)
+                traites = 0
+
+            if options['une_fois'] and traites < options['lot']:
+                break
+            if not traites:
+                time.sleep(options['intervalle'])
@@ -0,0 +1,59 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from educalims.archivage import ARCHIVAGE_LOT, ARCHIVAGE_MOIS, archiver_lot
+from educalims.expiration import ATTENTE_DUREE_MAX, annuler_attentes_lot, par_lots
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Annule les abonnements en attente abandonnes puis archive les abonnements termines "
+        "(ANNULE, ECHOUE, EXPIRE) anciens dans AbonnementArchive, par lots"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lot', type=int, default=ARCHIVAGE_LOT, help="Abonnements traites par lot")
+        parser.add_argument('--age-attente', type=int, default=ATTENTE_DUREE_MAX,
+                            help="Age en secondes au-dela duquel un abonnement en attente est annule")
+        parser.add_argument('--mois', type=int, default=ARCHIVAGE_MOIS,
+                            help="Anciennete en mois des abonnements termines a archiver")
+        parser.add_argument('--sans-archivage', action='store_true', help="Annule seulement, sans archiver")
+        parser.add_argument('--boucle', action='store_true',
+                            help="Tourne en continu (planificateur) au lieu de s'arreter une fois tout traite")
+        parser.add_argument('--intervalle', type=float, default=3600,
+                            help="Pause en secondes entre deux passages en mode --boucle")
+
+    def par_lots(self, libelle, traiter, taille):
+        """Appelle traiter() jusqu'a epuisement en affichant la duree de chaque lot ; retourne le total"""
+        debut = time.monotonic()
+        total, lots = par_lots(traiter, taille, lambda numero, nombre, duree: self.stdout.write(
+            f"{libelle} lot {numero}: {nombre} abonnement(s) en {duree * 1000:.0f} ms"
+        ))
+        if total:
+            self.stdout.write(self.style.SUCCESS(
+                f"{libelle}: {total} abonnement(s) en {lots} lot(s), {time.monotonic() - debut:.2f}s"
+            ))
+        return total
+
+    def passage(self, options):
+        taille = options['lot']
+        self.par_lots('Annulation', lambda: annuler_attentes_lot(taille, options['age_attente']), taille)
+        if not options['sans_archivage']:
+            self.par_lots('Archivage', lambda: archiver_lot(taille, options['mois']), taille)
+
+    def handle(self, *args, **options):
+        if not options['boucle']:
+            self.passage(options)
+            return
+
+        self.stdout.write("Nettoyage des abonnements demarre")
+        while True:
+            try:
+                self.passage(options)
+            except Exception as e:
+                logger.error(f"Erreur du nettoyage des abonnements: {e}", exc_info=True)
+            time.sleep(options['intervalle'])
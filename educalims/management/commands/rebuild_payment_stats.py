@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from educalims.statistiques import reconstruire_statistiques
+
+
+class Command(BaseCommand):
+    help = "Recalcule la table d'agregats StatistiquePaiement depuis les abonnements"
+
+    def handle(self, *args, **options):
+        lignes = reconstruire_statistiques()
+        self.stdout.write(self.style.SUCCESS(f"{lignes} ligne(s) d'agregat recalculee(s)"))
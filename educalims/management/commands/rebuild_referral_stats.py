@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from educalims.statistiques import reconstruire_recommandations, reconstruire_statistiques
+
+
+class Command(BaseCommand):
+    help = (
+        "Recalcule les agregats du classement des recommandations : inscriptions et abonnements "
+        "en attente, puis paiements et revenus (StatistiquePaiement)"
+    )
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Recommandations: {reconstruire_recommandations()} ligne(s) recalculee(s)")
+        self.stdout.write(f"Paiements: {reconstruire_statistiques()} ligne(s) recalculee(s)")
+        self.stdout.write(self.style.SUCCESS("Classement des recommandations reconstruit"))
@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from educalims.hierarchie import reconstruire_chemins
+
+
+class Command(BaseCommand):
+    help = "Recalcule le chemin materialise (chemin, profondeur) de toutes les unites"
+
+    def handle(self, *args, **options):
+        debut = time.monotonic()
+        with transaction.atomic():
+            comptes = reconstruire_chemins()
+        duree = time.monotonic() - debut
+
+        for profondeur, nombre in enumerate(comptes):
+            self.stdout.write(f"Profondeur {profondeur}: {nombre} unite(s)")
+        self.stdout.write(self.style.SUCCESS(f"{sum(comptes)} chemin(s) recalcule(s) en {duree:.2f}s"))
@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from educalims.compteurs import rafraichir_tout
+
+
+class Command(BaseCommand):
+    help = "Recalcule les compteurs denormalises du catalogue (cycles, disciplines, niveaux, unites)"
+
+    def handle(self, *args, **options):
+        debut = time.monotonic()
+        with transaction.atomic():
+            resultats = rafraichir_tout()
+        duree = time.monotonic() - debut
+
+        for table, lignes in resultats.items():
+            self.stdout.write(f"{table}: {lignes} ligne(s) recalculee(s)")
+        self.stdout.write(self.style.SUCCESS(f"Compteurs reconcilies en {duree:.2f}s"))
@@ -0,0 +1,33 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from educalims.telegram import traiter_notifications
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Vide la file des notifications Telegram (retries avec backoff exponentiel)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lot', type=int, default=20, help="Notifications traitees par lot")
+        parser.add_argument('--intervalle', type=float, default=2.0,
+                            help="Pause en secondes quand la file est vide")
+        parser.add_argument('--une-fois', action='store_true', help="Traite la file puis s'arrete")
+
+    def handle(self, *args, **options):
+        self.stdout.write("Notifier Telegram demarre")
+        while True:
+            try:
+                traitees = traiter_notifications(limite=options['lot'])
+            except Exception as e:
+                # Base indisponible, etc. : on reessaie au prochain tour
+                logger.error(f"Erreur du notifier Telegram: {e}", exc_info=True)
+                traitees = 0
+
+            if options['une_fois'] and traitees < options['lot']:
+                break
+            if not traitees:
+                time.sleep(options['intervalle'])
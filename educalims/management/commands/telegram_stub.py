@@ -0,0 +1,56 @@
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ("Serveur HTTP local imitant l'API Telegram sendMessage "
+            "(a utiliser avec TELEGRAM_API_URL=http://127.0.0.1:<port>)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8099)
+        parser.add_argument('--taux-echec', type=float, default=0.0,
+                            help="Proportion de requetes repondues en erreur 500 (0 a 1)")
+        parser.add_argument('--delai', type=float, default=0.0, help="Latence simulee en secondes")
+        parser.add_argument('--taux-429', type=float, default=0.0,
+                            help="Proportion de requetes repondues 429 Too Many Requests (retry_after=1)")
+
+    def handle(self, *args, **options):
+        stdout = self.stdout
+        taux_echec = options['taux_echec']
+        delai = options['delai']
+        taux_429 = options['taux_429']
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if delai:
+                    time.sleep(delai)
+                longueur = int(self.headers.get('Content-Length', 0))
+                data = parse_qs(self.rfile.read(longueur).decode())
+                if random.random() < taux_429:
+                    code, corps = 429, {'ok': False, 'error_code': 429,
+                                        'description': 'Too Many Requests: retry after 1',
+                                        'parameters': {'retry_after': 1}}
+                elif random.random() < taux_echec:
+                    code, corps = 500, {'ok': False, 'error_code': 500, 'description': 'Erreur simulee'}
+                else:
+                    code, corps = 200, {'ok': True, 'result': {'message_id': random.randint(1, 10 ** 6)}}
+                    stdout.write(f"[stub] {self.path} -> {data.get('text', [''])[0][:80]!r}")
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps(corps).encode())
+
+            def log_message(self, format, *args):
+                pass
+
+        serveur = ThreadingHTTPServer(('127.0.0.1', options['port']), Handler)
+        stdout.write(f"Stub Telegram sur http://127.0.0.1:{options['port']}")
+        try:
+            serveur.serve_forever()
+        except KeyboardInterrupt:
+            serveur.server_close()
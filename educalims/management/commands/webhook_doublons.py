@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from educalims.webhooks import doublons_par_heure
+
+
+class Command(BaseCommand):
+    help = "Affiche le nombre de webhooks recus en double par heure"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--heures', type=int, default=24, help="Nombre d'heures a afficher (48 max)")
+
+    def handle(self, *args, **options):
+        total = 0
+        for heure, nombre in doublons_par_heure(min(options['heures'], 48)):
+            total += nombre
+            self.stdout.write(f"{timezone.localtime(heure):%d/%m %H}h  {nombre}")
+        self.stdout.write(f"Total: {total}")
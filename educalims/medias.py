@@ -0,0 +1,222 @@
+"""
+Livraison des fichiers pedagogiques apres controle des droits : nginx envoie le fichier
+(X-Accel-Redirect vers une location interne, sendfile) ou, sans nginx, Django en repli
+(requetes Range simples et multiples, ETag, Last-Modified, If-Range)
+"""
+import hashlib
+import mimetypes
+import os
+import re
+import secrets
+import sys
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.fields.files import FieldFile
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe, quote_etag
+
+from .stockage import empreinte_du_nom
+
+
+# Vrai derriere nginx : la location interne MEDIAS_INTERNE sert MEDIA_ROOT (voir nginx.conf)
+MEDIAS_X_ACCEL = getattr(settings, 'MEDIAS_X_ACCEL', False)
+MEDIAS_INTERNE = getattr(settings, 'MEDIAS_INTERNE', '/media-protege/')
+# Taille des blocs lus sur le disque : le fichier n'est jamais charge en memoire
+MEDIAS_BLOC = 64 * 1024
+# Au-dela, l'en-tete Range est ignore (reponse complete) plutot que de servir des centaines de parties
+PLAGES_MAX = 16
+EMPREINTE_CACHE_TIMEOUT = 30 * 24 * 60 * 60
+
+PLAGE = re.compile(r'^(\d*)-(\d*)$')
+
+
+def type_contenu(nom):
+    return mimetypes.guess_type(nom)[0] or 'application/octet-stream'
+
+
+# ==================== PLAGES (RANGE) ====================
+
+def plages_demandees(entete, taille):
+    """
+    Plages (debut, fin) inclusives de l'en-tete Range, dans l'ordre demande. None si l'en-tete
+    est absent, invalide ou trop fragmente (reponse complete), [] si aucune plage n'est dans le
+    fichier (416).
+    """
+    if not entete:
+        return None
+    unite, _, specification = entete.partition('=')
+    if unite.strip().lower() != 'bytes':
+        return None
+    plages = []
+    for partie in specification.split(','):
+        plage = PLAGE.match(partie.strip())
+        if plage is None:
+            return None
+        debut, fin = plage.groups()
+        if not debut and not fin:
+            return None
+        if not debut:
+            # bytes=-N : les N derniers octets
+            longueur = int(fin)
+            if longueur and taille:
+                plages.append((max(0, taille - longueur), taille - 1))
+            continue
+        debut = int(debut)
+        if fin and int(fin) < debut:
+            return None
+        if debut < taille:
+            plages.append((debut, min(int(fin), taille - 1) if fin else taille - 1))
+    if len(plages) > PLAGES_MAX:
+        return None
+    return plages
+
+
+def premier_octet(request):
+    """Vrai si la requete lit le fichier depuis le debut (pas une reprise ni un saut dans une video)"""
+    plages = plages_demandees(request.headers.get('Range'), sys.maxsize)
+    return not plages or plages[0][0] == 0
+
+
+def _morceaux(champ, segments):
+    """Itere par blocs sur `segments` : octets tels quels ou plages (debut, fin) lues dans le fichier"""
+    with champ.open('rb') as fichier:
+        for segment in segments:
+            if isinstance(segment, bytes):
+                yield segment
+                continue
+            debut, fin = segment
+            fichier.seek(debut)
+            reste = fin - debut + 1
+            while reste > 0:
+                donnees = fichier.read(min(MEDIAS_BLOC, reste))
+                if not donnees:
+                    break
+                reste -= len(donnees)
+                yield donnees
+
+
+# ==================== VALIDATEURS (ETAG, LAST-MODIFIED) ====================
+
+def empreinte(champ, taille, modification):
+    """sha256 du contenu, calcule une fois par version du fichier (nom, taille, date) puis lu en cache"""
+    # Blob du stockage par contenu : l'empreinte est dans le nom
+    valeur = empreinte_du_nom(champ.name)
+    if valeur:
+        return valeur
+    version = f"{champ.name}:{taille}:{modification.timestamp()}"
+    cle = f"medias:empreinte:{hashlib.sha1(version.encode()).hexdigest()}"
+    valeur = cache.get(cle)
+    if valeur is None:
+        contenu = hashlib.sha256()
+        with champ.open('rb') as fichier:
+            for bloc in fichier.chunks(MEDIAS_BLOC):
+                contenu.update(bloc)
+        valeur = contenu.hexdigest()
+        cache.set(cle, valeur, EMPREINTE_CACHE_TIMEOUT)
+    return valeur
+
+
+def _if_range_valide(request, etag, derniere_modification):
+    """If-Range : la reprise n'est acceptee que si le fichier n'a pas change depuis la premiere lecture"""
+    valeur = request.headers.get('If-Range')
+    if not valeur:
+        return True
+    if valeur.startswith(('"', 'W/')):
+        # Comparaison forte : un ETag faible ne valide jamais une plage
+        return valeur == etag
+    return parse_http_date_safe(valeur) == derniere_modification
+
+
+# ==================== REPONSES ====================
+
+def _reponse_django(request, champ, nom):
+    taille = champ.size
+    modification = champ.storage.get_modified_time(champ.name)
+    derniere_modification = int(modification.timestamp())
+    etag = quote_etag(empreinte(champ, taille, modification)[:32])
+
+    # If-None-Match / If-Modified-Since (304), If-Match / If-Unmodified-Since (412)
+    response = get_conditional_response(request, etag=etag, last_modified=derniere_modification)
+    if response is None:
+        plages = plages_demandees(request.headers.get('Range'), taille)
+        if plages is not None and not _if_range_valide(request, etag, derniere_modification):
+            plages = None
+        response = _reponse_plages(champ, nom, taille, plages)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(derniere_modification)
+    return response
+
+
+def _reponse_plages(champ, nom, taille, plages):
+    contenu = type_contenu(nom)
+    if plages is None:
+        # Fichier complet : FileResponse passe le fichier a wsgi.file_wrapper (sendfile si disponible)
+        response = FileResponse(champ.open('rb'), content_type=contenu)
+    elif not plages:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{taille}'
+    elif len(plages) == 1:
+        debut, fin = plages[0]
+        response = StreamingHttpResponse(_morceaux(champ, plages), status=206, content_type=contenu)
+        response['Content-Range'] = f'bytes {debut}-{fin}/{taille}'
+        response['Content-Length'] = str(fin - debut + 1)
+    else:
+        frontiere = secrets.token_hex(16)
+        segments = []
+        for debut, fin in plages:
+            segments.append((
+                f"--{frontiere}\r\nContent-Type: {contenu}\r\n"
+                f"Content-Range: bytes {debut}-{fin}/{taille}\r\n\r\n"
+            ).encode())
+            segments.append((debut, fin))
+            segments.append(b'\r\n')
+        segments.append(f"--{frontiere}--\r\n".encode())
+        longueur = sum(len(s) if isinstance(s, bytes) else s[1] - s[0] + 1 for s in segments)
+        response = StreamingHttpResponse(
+            _morceaux(champ, segments), status=206, content_type=f'multipart/byteranges; boundary={frontiere}'
+        )
+        response['Content-Length'] = str(longueur)
+    response['Content-Disposition'] = content_disposition_header(False, nom)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _reponse_nginx(champ, nom):
+    # Corps vide : nginx remplace la reponse par le fichier interne et gere lui-meme
+    # Range, If-Range et les validateurs (ETag, Last-Modified)
+    response = HttpResponse(content_type=type_contenu(nom))
+    response['X-Accel-Redirect'] = MEDIAS_INTERNE + quote(champ.name)
+    response['Content-Disposition'] = content_disposition_header(False, nom)
+    return response
+
+
+def apercu(fichier, format_):
+    """Miniature ('miniature') ou variante d'image (largeur en pixels) generee par process_media, None sinon"""
+    if format_ == 'miniature':
+        return fichier.miniature or None
+    nom = fichier.variantes.get(format_)
+    return FieldFile(fichier, fichier.fichier.field, nom) if nom else None
+
+
+def reponse_fichier(request, fichier, champ=None):
+    """
+    Reponse qui envoie le fichier uploade de `fichier`, ou `champ` (apercu), droits deja
+    verifies par l'appelant
+    """
+    if champ is None:
+        champ = fichier.fichier
+        # Nom du blob = empreinte : le fichier telecharge porte le nom du Fichier
+        extension = os.path.splitext(champ.name)[1]
+        nom = fichier.nom if fichier.nom.lower().endswith(extension.lower()) else f"{fichier.nom}{extension}"
+    else:
+        nom = champ.name.rsplit('/', 1)[-1]
+    if MEDIAS_X_ACCEL:
+        response = _reponse_nginx(champ, nom)
+    else:
+        response = _reponse_django(request, champ, nom)
+    # Contenu payant : jamais dans un cache partage
+    patch_cache_control(response, private=True)
+    return response
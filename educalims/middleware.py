@@ -1,11 +1,52 @@
 import hashlib
+import time
 import jwt
 from django.conf import settings
 from django.http import JsonResponse
 from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
 from datetime import datetime, timedelta
-from functools import wraps
-from .models import UserProfile
+from functools import lru_cache, wraps
+from .appareils import appareils_enregistres, noter_acces
+
+
+# Chemins sans controle d'appareil : webhooks, callbacks, API de suivi et fichiers statiques
+DEVICE_CHEMINS_EXCLUS = getattr(settings, 'DEVICE_CHEMINS_EXCLUS', (
+    '/api/paiement/callback/',
+    '/webhook/',
+    '/api/abonnement/',
+    '/api/paiements-recents/',
+))
+# Nombre de tokens JWT verifies gardes en memoire par processus
+DEVICE_TOKENS_CACHE = 4096
+
+
+def _prefixe(url):
+    """Prefixe de chemin d'une URL de settings ('static/' -> '/static/'), None si URL absolue"""
+    if not url or '://' in url:
+        return None
+    return '/' + url.lstrip('/')
+
+
+@lru_cache(maxsize=DEVICE_TOKENS_CACHE)
+def _decoder_device_token(token):
+    """(device_id, expiration) d'un token valide, None sinon ; memorise par processus"""
+    try:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
+    except jwt.InvalidTokenError:
+        return None
+    return payload.get('device_id'), payload.get('exp')
+
+
+def _device_id_du_token(token):
+    decode = _decoder_device_token(token)
+    if decode is None:
+        return None
+    device_id, expiration = decode
+    # Le resultat memorise peut avoir expire depuis le decodage
+    if expiration is not None and expiration <= time.time():
+        return None
+    return device_id
 
 
 class DeviceIdMiddleware:
@@ -13,10 +54,17 @@ class DeviceIdMiddleware:
 
     def __init__(self, get_response):
         self.get_response = get_response
+        self.chemins_exclus = tuple(
+            chemin for chemin in (*DEVICE_CHEMINS_EXCLUS, _prefixe(settings.STATIC_URL), _prefixe(settings.MEDIA_URL))
+            if chemin
+        )
 
     def __call__(self, request):
-        device_id = self._get_or_create_device_id(request)
-        request.device_id = device_id
+        if request.path.startswith(self.chemins_exclus):
+            request.device_id = None
+        else:
+            # Calcule seulement si une vue l'utilise (device_required, s_abonner)
+            request.device_id = SimpleLazyObject(lambda: self._get_or_create_device_id(request))
         response = self.get_response(request)
         return response
 
@@ -26,15 +74,9 @@ class DeviceIdMiddleware:
         device_token = request.COOKIES.get(cookie_name)
         
         if device_token:
-            try:
-                payload = jwt.decode(
-                    device_token,
-                    settings.SECRET_KEY,
-                    algorithms=['HS256']
-                )
-                return payload.get('device_id')
-            except (jwt.DecodeError, jwt.ExpiredSignatureError):
-                pass
+            device_id = _device_id_du_token(device_token)
+            if device_id:
+                return device_id
         
         device_id = self._generate_device_fingerprint(request)
         return device_id
@@ -70,15 +112,25 @@ class DeviceIdMiddleware:
     @staticmethod
     def verify_device_token(token):
         """Verifie et retourne le device_id depuis un token JWT."""
-        try:
-            payload = jwt.decode(
-                token,
-                settings.SECRET_KEY,
-                algorithms=['HS256']
-            )
-            return payload.get('device_id')
-        except (jwt.DecodeError, jwt.ExpiredSignatureError):
-            return None
+        return _device_id_du_token(token)
+
+
+def poser_cookie_appareil(response, device_id):
+    """Cookie JWT du device_id : l'appareil garde le meme identifiant d'une connexion a l'autre"""
+    response.set_cookie(
+        'device_token',
+        DeviceIdMiddleware.create_device_token(device_id),
+        max_age=365 * 24 * 60 * 60,  # 1 an
+        httponly=True,
+        secure=False,  # True en production avec HTTPS
+        samesite='Lax'
+    )
+
+
+def get_device_id(request):
+    """device_id de la requete sous forme de chaine, None pour les chemins exclus"""
+    device_id = getattr(request, 'device_id', None)
+    return str(device_id) if device_id else None
 
 
 def device_required(view_func):
@@ -87,26 +139,21 @@ def device_required(view_func):
     def _wrapped_view(request, *args, **kwargs):
         if not request.user.is_authenticated:
             return view_func(request, *args, **kwargs)
-        
-        request_device_id = getattr(request, 'device_id', None)
-        
-        try:
-            profile = request.user.profile
-            registered_device_id = profile.device_id
-            
-            if registered_device_id and request_device_id != registered_device_id:
+
+        appareils = appareils_enregistres(request)
+        if appareils:
+            request_device_id = get_device_id(request) or ''
+            if request_device_id not in appareils:
                 # Device different - afficher une page d'erreur friendly
                 from django.shortcuts import render
                 return render(request, 'educalims/device_not_authorized.html', {
                     'title': 'Appareil non autorise',
                     'message': 'Cet abonnement est lie a un autre appareil.',
-                    'registered_device': registered_device_id[:8] + '...',
+                    'registered_device': ', '.join(device_id[:8] + '...' for device_id in sorted(appareils)),
                     'current_device': request_device_id[:8] + '...'
                 }, status=403)
-            
-        except UserProfile.DoesNotExist:
-            pass
-        
+            noter_acces(request.user.pk, request_device_id)
+
         return view_func(request, *args, **kwargs)
-    
+
     return _wrapped_view
@@ -0,0 +1,120 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:11
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def _compte(queryset, champ):
+    sous_requete = (
+        queryset.filter(**{champ: OuterRef('pk')})
+        .order_by()
+        .values(champ)
+        .annotate(total=Count('*'))
+        .values('total')[:1]
+    )
+    return Coalesce(Subquery(sous_requete, output_field=IntegerField()), 0)
+
+
+def initialiser_compteurs(apps, schema_editor):
+    Cycle = apps.get_model('educalims', 'Cycle')
+    Discipline = apps.get_model('educalims', 'Discipline')
+    Niveau = apps.get_model('educalims', 'Niveau')
+    Unite = apps.get_model('educalims', 'Unite')
+    Fichier = apps.get_model('educalims', 'Fichier')
+
+    chapitres = Unite.objects.filter(unites_enfants__isnull=True)
+    fichiers_actifs = Fichier.objects.filter(est_actif=True)
+    niveaux_enfants = Niveau.objects.filter(est_niveau_enfant=True)
+
+    Unite.objects.update(
+        nb_unites_enfants=_compte(Unite.objects.all(), 'unite_parent'),
+        nb_fichiers_actifs=_compte(fichiers_actifs, 'unite'),
+    )
+    Niveau.objects.update(
+        nb_niveaux_enfants=_compte(Niveau.objects.all(), 'niveau_parent'),
+        nb_chapitres=_compte(chapitres, 'niveau'),
+        nb_fichiers_actifs=_compte(fichiers_actifs, 'unite__niveau'),
+    )
+    Discipline.objects.update(
+        nb_niveaux_enfants=_compte(niveaux_enfants, 'disciplines'),
+        nb_chapitres=_compte(chapitres, 'discipline'),
+        nb_fichiers_actifs=_compte(fichiers_actifs, 'unite__discipline'),
+    )
+    Cycle.objects.update(
+        nb_disciplines=_compte(Discipline.objects.all(), 'cycles'),
+        nb_niveaux_enfants=_compte(niveaux_enfants, 'cycle'),
+        nb_chapitres=_compte(chapitres, 'niveau__cycle'),
+        nb_fichiers_actifs=_compte(fichiers_actifs, 'unite__niveau__cycle'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0007_userprofile_device_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cycle',
+            name='nb_chapitres',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Nombre de chapitres (unites finales)'),
+        ),
+        migrations.AddField(
+            model_name='cycle',
+            name='nb_disciplines',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Nombre de disciplines'),
+        ),
+        migrations.AddField(
+            model_name='cycle',
+            name='nb_fichiers_actifs',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Nombre de fichiers actifs'),
+        ),
+        migrations.AddField(
+            model_name='cycle',
+            name='nb_niveaux_enfants',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Nombre de niveaux enfants'),
+        ),
+        migrations.AddField(
+            model_name='discipline',
+            name='nb_chapitres',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Nombre de chapitres (unites finales)'),
+        ),
+        migrations.AddField(
+            model_name='discipline',
+            name='nb_fichiers_actifs',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Nombre de fichiers actifs'),
+        ),
+        migrations.AddField(
+            model_name='discipline',
+            name='nb_niveaux_enfants',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Nombre de niveaux enfants'),
+        ),
+        migrations.AddField(
+            model_name='niveau',
+            name='nb_chapitres',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Nombre de chapitres (unites finales)'),
+        ),
+        migrations.AddField(
+            model_name='niveau',
+            name='nb_fichiers_actifs',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Nombre de fichiers actifs'),
+        ),
+        migrations.AddField(
+            model_name='niveau',
+            name='nb_niveaux_enfants',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Nombre de niveaux enfants'),
+        ),
+        migrations.AddField(
+            model_name='unite',
+            name='nb_fichiers_actifs',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Nombre de fichiers actifs'),
+        ),
+        migrations.AddField(
+            model_name='unite',
+            name='nb_unites_enfants',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text="Nombre d'unites enfants"),
+        ),
+        migrations.RunPython(initialiser_compteurs, migrations.RunPython.noop),
+    ]
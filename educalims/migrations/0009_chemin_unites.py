@@ -0,0 +1,34 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:13
+
+from django.db import migrations, models
+
+from educalims.hierarchie import reconstruire_chemins
+
+
+def initialiser_chemins(apps, schema_editor):
+    reconstruire_chemins(apps.get_model('educalims', 'Unite'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0008_compteurs_catalogue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='unite',
+            name='chemin',
+            field=models.CharField(blank=True, default='', editable=False, help_text='Chemin materialise des ancetres (ex: 3/17/42/)', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='unite',
+            name='profondeur',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, help_text='Profondeur dans la hierarchie (0 = racine)'),
+        ),
+        migrations.AddIndex(
+            model_name='unite',
+            index=models.Index(fields=['chemin'], name='unite_chemin_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.RunPython(initialiser_chemins, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:16
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0009_chemin_unites'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='webhooklog',
+            name='telegram_notification_sent',
+            field=models.BooleanField(default=False, verbose_name='Notif Telegram envoyée'),
+        ),
+        migrations.CreateModel(
+            name='NotificationTelegram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message', models.TextField(verbose_name='Message')),
+                ('statut', models.CharField(choices=[('EN_ATTENTE', 'En attente'), ('ENVOYEE', 'Envoyée'), ('ECHEC', 'Échec définitif')], default='EN_ATTENTE', max_length=20, verbose_name='Statut')),
+                ('tentatives', models.PositiveSmallIntegerField(default=0, verbose_name='Tentatives')),
+                ('prochaine_tentative', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Prochaine tentative')),
+                ('derniere_erreur', models.TextField(blank=True, default='', verbose_name='Dernière erreur')),
+                ('date_creation', models.DateTimeField(auto_now_add=True, verbose_name='Date de création')),
+                ('date_envoi', models.DateTimeField(blank=True, null=True, verbose_name="Date d'envoi")),
+                ('webhook_log', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='notifications', to='educalims.webhooklog', verbose_name='Webhook')),
+            ],
+            options={
+                'verbose_name': 'Notification Telegram',
+                'verbose_name_plural': 'Notifications Telegram',
+                'ordering': ['-date_creation'],
+                'indexes': [models.Index(condition=models.Q(('statut', 'EN_ATTENTE')), fields=['prochaine_tentative'], name='notif_telegram_a_envoyer_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0010_notifications_telegram'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationtelegram',
+            name='categorie',
+            field=models.CharField(blank=True, choices=[('NOUVEL_ABONNEMENT', 'Nouvel abonnement'), ('WEBHOOK_RECU', 'Webhook reçu'), ('PAIEMENT_SUCCES', 'Paiement réussi'), ('PAIEMENT_ECHEC', 'Paiement échoué'), ('PAIEMENT_NON_TROUVE', 'Paiement sans abonnement')], default='', help_text='Vide = toujours envoyée individuellement', max_length=30, verbose_name='Catégorie'),
+        ),
+        migrations.AddField(
+            model_name='notificationtelegram',
+            name='montant',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Montant'),
+        ),
+        migrations.AddField(
+            model_name='notificationtelegram',
+            name='operateur',
+            field=models.CharField(blank=True, default='', max_length=50, verbose_name='Opérateur'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 6.0.1 on 2026-10-18 10:00
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def marquer_webhooks_traites(apps, schema_editor):
+    """Les webhooks deja recus ont ete traites de facon synchrone"""
+    WebhookLog = apps.get_model('educalims', 'WebhookLog')
+    WebhookLog.objects.filter(traite_le__isnull=True).update(traite_le=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0011_notifications_resume'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhooklog',
+            name='erreur_traitement',
+            field=models.TextField(blank=True, default='', verbose_name='Erreur de traitement'),
+        ),
+        migrations.AddField(
+            model_name='webhooklog',
+            name='traite_le',
+            field=models.DateTimeField(blank=True, help_text='Vide = en attente de manage.py process_webhooks', null=True, verbose_name='Traité le'),
+        ),
+        migrations.RunPython(marquer_webhooks_traites, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='webhooklog',
+            index=models.Index(condition=models.Q(('traite_le__isnull', True)), fields=['created_at'], name='webhook_a_traiter_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:21
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def dedoublonner_transactions(apps, schema_editor):
+    """Seul le premier journal d'une transaction garde son transaction_id (conserve dans raw_data)"""
+    WebhookLog = apps.get_model('educalims', 'WebhookLog')
+    doublons = (
+        WebhookLog.objects.exclude(transaction_id__isnull=True).exclude(transaction_id='')
+        .values('transaction_id').annotate(nb=Count('id'), premier=Min('id')).filter(nb__gt=1)
+    )
+    for doublon in doublons:
+        WebhookLog.objects.filter(transaction_id=doublon['transaction_id']).exclude(
+            pk=doublon['premier']
+        ).update(transaction_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0012_webhooks_differes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhooklog',
+            name='provider',
+            field=models.CharField(default='cyberschool', help_text="Point d'entrée ayant reçu la notification", max_length=30, verbose_name='Fournisseur'),
+        ),
+        migrations.AddField(
+            model_name='webhooklog',
+            name='reponse',
+            field=models.JSONField(blank=True, help_text='Rejouée telle quelle si la même transaction est reçue à nouveau', null=True, verbose_name='Réponse renvoyée'),
+        ),
+        migrations.AddField(
+            model_name='webhooklog',
+            name='reponse_http',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='Code HTTP renvoyé'),
+        ),
+        migrations.RunPython(dedoublonner_transactions, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='webhooklog',
+            constraint=models.UniqueConstraint(condition=models.Q(('transaction_id__isnull', False), models.Q(('transaction_id', ''), _negated=True)), fields=('provider', 'transaction_id'), name='webhook_transaction_unique'),
+        ),
+    ]
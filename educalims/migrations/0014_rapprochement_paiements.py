@@ -0,0 +1,49 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+from educalims.rapprochement import normaliser_telephone
+
+
+def normaliser_telephones(apps, schema_editor):
+    UserProfile = apps.get_model('educalims', 'UserProfile')
+    profils = list(UserProfile.objects.exclude(telephone__isnull=True).exclude(telephone=''))
+    for profil in profils:
+        profil.telephone_normalise = normaliser_telephone(profil.telephone)
+    UserProfile.objects.bulk_update(profils, ['telephone_normalise'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0013_webhooks_idempotence'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='telephone_normalise',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, help_text='Telephone sans indicatif ni zero initial, pour le rapprochement des paiements', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='webhooklog',
+            name='candidats',
+            field=models.JSONField(blank=True, default=list, help_text='Identifiants des abonnements possibles quand le rapprochement est ambigu', verbose_name='Abonnements candidats'),
+        ),
+        migrations.AddField(
+            model_name='webhooklog',
+            name='rapprochement',
+            field=models.CharField(blank=True, choices=[('REFERENCE', 'Par référence marchand'), ('TELEPHONE', 'Par téléphone et montant'), ('AMBIGU', 'Ambigu (plusieurs abonnements possibles)'), ('AUCUN', 'Aucun abonnement')], default='', max_length=20, verbose_name='Rapprochement'),
+        ),
+        migrations.AddIndex(
+            model_name='abonnement',
+            index=models.Index(fields=['merchant_reference_id'], name='abonnement_merchant_ref_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='abonnement',
+            index=models.Index(condition=models.Q(('statut', 'EN_ATTENTE')), fields=['user', 'date_creation'], name='abonnement_en_attente_idx'),
+        ),
+        migrations.RunPython(normaliser_telephones, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:26
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0014_rapprochement_paiements'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='abonnement',
+            index=models.Index(fields=['date_modification', 'id'], name='abonnement_modification_idx'),
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 6.0.1 on 2026-10-18 14:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+from educalims.statistiques import reconstruire_statistiques
+
+
+def remplir_statistiques(apps, schema_editor):
+    reconstruire_statistiques(
+        apps.get_model('educalims', 'Abonnement'),
+        apps.get_model('educalims', 'StatistiquePaiement'),
+        AbonnementArchive=None,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0015_abonnement_modification_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatistiquePaiement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('jour', models.DateField(verbose_name='Jour')),
+                ('operateur', models.CharField(blank=True, default='', max_length=20, verbose_name='Opérateur')),
+                ('recommande_par', models.CharField(default='aucun', max_length=20, verbose_name='Recommandé par')),
+                ('nb_crees', models.PositiveIntegerField(default=0, verbose_name='Abonnements créés')),
+                ('nb_actives', models.PositiveIntegerField(default=0, verbose_name='Paiements réussis')),
+                ('nb_echoues', models.PositiveIntegerField(default=0, verbose_name='Paiements échoués')),
+                ('nb_annules', models.PositiveIntegerField(default=0, verbose_name='Annulés')),
+                ('nb_expires', models.PositiveIntegerField(default=0, verbose_name='Expirés')),
+                ('montant_total', models.PositiveBigIntegerField(default=0, verbose_name='Revenu (FCFA)')),
+            ],
+            options={
+                'verbose_name': 'Statistique de paiement',
+                'verbose_name_plural': 'Statistiques de paiement',
+                'ordering': ['-jour'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='abonnement',
+            index=models.Index(fields=['statut', 'date_creation'], name='abonnement_statut_creation_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='abonnement',
+            index=models.Index(fields=['statut', 'date_debut'], name='abonnement_statut_debut_idx'),
+        ),
+        migrations.AddField(
+            model_name='statistiquepaiement',
+            name='niveau',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='statistiques_paiement', to='educalims.niveau', verbose_name='Niveau'),
+        ),
+        migrations.AddConstraint(
+            model_name='statistiquepaiement',
+            constraint=models.UniqueConstraint(fields=('jour', 'operateur', 'niveau', 'recommande_par'), name='statistique_paiement_unique'),
+        ),
+        migrations.RunPython(remplir_statistiques, migrations.RunPython.noop),
+    ]
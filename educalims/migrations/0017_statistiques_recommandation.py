@@ -0,0 +1,40 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:32
+
+from django.db import migrations, models
+
+from educalims.statistiques import reconstruire_recommandations
+
+
+def remplir_recommandations(apps, schema_editor):
+    reconstruire_recommandations(
+        apps.get_model('educalims', 'UserProfile'),
+        apps.get_model('educalims', 'Abonnement'),
+        apps.get_model('educalims', 'StatistiqueRecommandation'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0016_statistiques_paiement'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatistiqueRecommandation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('jour', models.DateField(verbose_name='Jour')),
+                ('recommande_par', models.CharField(default='aucun', max_length=20, verbose_name='Recommandé par')),
+                ('nb_inscrits', models.PositiveIntegerField(default=0, verbose_name='Inscriptions')),
+                ('nb_en_attente', models.PositiveIntegerField(default=0, verbose_name='Abonnements en attente')),
+            ],
+            options={
+                'verbose_name': 'Statistique de recommandation',
+                'verbose_name_plural': 'Statistiques de recommandation',
+                'ordering': ['-jour'],
+                'constraints': [models.UniqueConstraint(fields=('jour', 'recommande_par'), name='statistique_recommandation_unique')],
+            },
+        ),
+        migrations.RunPython(remplir_recommandations, migrations.RunPython.noop),
+    ]
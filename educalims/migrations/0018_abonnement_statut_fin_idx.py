@@ -0,0 +1,19 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:32
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0017_statistiques_recommandation'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='abonnement',
+            index=models.Index(fields=['statut', 'date_fin'], name='abonnement_statut_fin_idx'),
+        ),
+    ]
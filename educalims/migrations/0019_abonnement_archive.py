@@ -0,0 +1,42 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:34
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0018_abonnement_statut_fin_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AbonnementArchive',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('statut', models.CharField(choices=[('EN_ATTENTE', 'En attente de paiement'), ('ACTIF', 'Actif'), ('EXPIRE', 'Expiré'), ('ANNULE', 'Annulé'), ('ECHOUE', 'Échec du paiement')], max_length=20)),
+                ('reference_interne', models.CharField(blank=True, max_length=200, null=True)),
+                ('merchant_reference_id', models.CharField(blank=True, db_index=True, max_length=200, null=True)),
+                ('code_paiement', models.CharField(blank=True, max_length=10, null=True)),
+                ('methode_paiement', models.CharField(blank=True, max_length=20, null=True)),
+                ('montant_paye', models.PositiveIntegerField(blank=True, null=True)),
+                ('date_debut', models.DateTimeField(blank=True, null=True)),
+                ('date_fin', models.DateTimeField(blank=True, null=True)),
+                ('date_creation', models.DateTimeField()),
+                ('date_modification', models.DateTimeField()),
+                ('date_archivage', models.DateTimeField(auto_now_add=True)),
+                ('niveau', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='abonnements_archives', to='educalims.niveau')),
+                ('produit', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='abonnements_archives', to='educalims.produit')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='abonnements_archives', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Abonnement archivé',
+                'verbose_name_plural': 'Abonnements archivés',
+                'ordering': ['-date_creation'],
+                'indexes': [models.Index(fields=['user', 'date_creation'], name='archive_user_creation_idx')],
+            },
+        ),
+    ]
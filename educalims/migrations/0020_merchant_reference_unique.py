@@ -0,0 +1,59 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:36
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+from educalims.references import allouer_reference, creer_sequence
+
+
+def creer_sequence_references(apps, schema_editor):
+    creer_sequence(schema_editor)
+
+
+def dedoublonner_references(apps, schema_editor):
+    """
+    References aleatoires en double : l'abonnement qu'un paiement rapprocherait (actif, sinon
+    le plus recent) garde la sienne, les autres recoivent une reference de l'allocateur.
+    """
+    Abonnement = apps.get_model('educalims', 'Abonnement')
+    AbonnementArchive = apps.get_model('educalims', 'AbonnementArchive')
+    Abonnement.objects.filter(merchant_reference_id='').update(merchant_reference_id=None)
+
+    doublons = (
+        Abonnement.objects.exclude(merchant_reference_id__isnull=True).order_by()
+        .values('merchant_reference_id').annotate(nombre=Count('id')).filter(nombre__gt=1)
+        .values_list('merchant_reference_id', flat=True)
+    )
+    for reference in list(doublons):
+        abonnements = sorted(
+            Abonnement.objects.filter(merchant_reference_id=reference),
+            key=lambda a: (a.statut != 'ACTIF', -a.date_creation.timestamp()),
+        )
+        for abonnement in abonnements[1:]:
+            abonnement.merchant_reference_id = allouer_reference(
+                schema_editor.connection, Abonnement=Abonnement, AbonnementArchive=AbonnementArchive
+            )
+            abonnement.save(update_fields=['merchant_reference_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0019_abonnement_archive'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(creer_sequence_references, migrations.RunPython.noop),
+        migrations.RunPython(dedoublonner_references, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='abonnement',
+            constraint=models.UniqueConstraint(fields=('merchant_reference_id',), name='abonnement_merchant_ref_unique'),
+        ),
+        # Redondant avec l'index de la contrainte unique
+        migrations.RemoveIndex(
+            model_name='abonnement',
+            name='abonnement_merchant_ref_idx',
+        ),
+    ]
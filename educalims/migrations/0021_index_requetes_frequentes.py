@@ -0,0 +1,55 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:38
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+INDEX = [
+    ('abonnement', models.Index(fields=['user', 'niveau', 'statut'], name='abonnement_user_niveau_idx')),
+    ('abonnement', models.Index(fields=['user', '-date_creation'], name='abonnement_user_creation_idx')),
+    ('webhooklog', models.Index(fields=['-created_at'], name='webhook_created_idx')),
+    ('webhooklog', models.Index(fields=['status', '-created_at'], name='webhook_status_created_idx')),
+    ('webhooklog', models.Index(fields=['operator', '-created_at'], name='webhook_operator_created_idx')),
+]
+
+
+def creer_index(apps, schema_editor):
+    # Postgres : CREATE INDEX CONCURRENTLY, sans verrou bloquant les ecritures ; ailleurs (tests) index ordinaire
+    concurrent = schema_editor.connection.vendor == 'postgresql'
+    for model_name, index in INDEX:
+        model = apps.get_model('educalims', model_name)
+        if concurrent:
+            schema_editor.add_index(model, index.clone(), concurrently=True)
+        else:
+            schema_editor.add_index(model, index.clone())
+
+
+def supprimer_index(apps, schema_editor):
+    concurrent = schema_editor.connection.vendor == 'postgresql'
+    for model_name, index in INDEX:
+        model = apps.get_model('educalims', model_name)
+        if concurrent:
+            schema_editor.remove_index(model, index.clone(), concurrently=True)
+        else:
+            schema_editor.remove_index(model, index.clone())
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY ne peut pas s'executer dans une transaction
+    atomic = False
+
+    dependencies = [
+        ('educalims', '0020_merchant_reference_unique'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(model_name=model_name, index=index.clone()) for model_name, index in INDEX
+            ],
+            database_operations=[
+                migrations.RunPython(creer_index, supprimer_index),
+            ],
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:43
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def copier_appareils(apps, schema_editor):
+    """L'appareil unique de chaque profil devient son premier UserDevice"""
+    UserProfile = apps.get_model('educalims', 'UserProfile')
+    UserDevice = apps.get_model('educalims', 'UserDevice')
+    profils = (
+        UserProfile.objects.exclude(device_id__isnull=True).exclude(device_id='')
+        .values_list('user_id', 'device_id')
+    )
+    UserDevice.objects.bulk_create(
+        (UserDevice(user_id=user_id, device_id=device_id) for user_id, device_id in profils.iterator()),
+        batch_size=1000, ignore_conflicts=True,
+    )
+
+
+def restaurer_appareils(apps, schema_editor):
+    """Retour arriere : l'appareil actif le plus recent de chaque utilisateur, s'il n'est pas deja pris"""
+    UserProfile = apps.get_model('educalims', 'UserProfile')
+    UserDevice = apps.get_model('educalims', 'UserDevice')
+    pris = set()
+    for appareil in UserDevice.objects.filter(revoque_le__isnull=True).order_by('user_id', '-date_ajout'):
+        if appareil.device_id in pris:
+            continue
+        if UserProfile.objects.filter(user_id=appareil.user_id, device_id__isnull=True).update(
+            device_id=appareil.device_id
+        ):
+            pris.add(appareil.device_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0021_index_requetes_frequentes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserDevice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device_id', models.CharField(max_length=255, verbose_name="Identifiant de l'appareil")),
+                ('date_ajout', models.DateTimeField(auto_now_add=True, verbose_name="Date d'ajout")),
+                ('dernier_acces', models.DateTimeField(blank=True, null=True, verbose_name='Dernier accès')),
+                ('revoque_le', models.DateTimeField(blank=True, null=True, verbose_name='Révoqué le')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='appareils', to=settings.AUTH_USER_MODEL, verbose_name='Utilisateur')),
+            ],
+            options={
+                'verbose_name': 'Appareil',
+                'verbose_name_plural': 'Appareils',
+                'ordering': ['-date_ajout'],
+                'constraints': [models.UniqueConstraint(fields=('user', 'device_id'), name='appareil_user_device_unique')],
+            },
+        ),
+        migrations.RunPython(copier_appareils, restaurer_appareils),
+        migrations.RemoveField(
+            model_name='userprofile',
+            name='device_id',
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0022_appareils'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fichier',
+            name='empreinte',
+            field=models.CharField(blank=True, default='', editable=False, help_text='SHA-256 du contenu', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='fichier',
+            name='erreur_traitement',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='fichier',
+            name='metadonnees',
+            field=models.JSONField(blank=True, default=dict, editable=False, help_text="Métadonnées du document ou de l'image"),
+        ),
+        migrations.AddField(
+            model_name='fichier',
+            name='miniature',
+            field=models.FileField(blank=True, editable=False, help_text='Première page (PDF) ou image réduite', null=True, upload_to='apercus/'),
+        ),
+        migrations.AddField(
+            model_name='fichier',
+            name='nb_pages',
+            field=models.PositiveIntegerField(blank=True, editable=False, help_text='Pages (PDF)', null=True),
+        ),
+        migrations.AddField(
+            model_name='fichier',
+            name='traite_le',
+            field=models.DateTimeField(blank=True, editable=False, help_text="Vide tant que le fichier uploadé n'a pas été analysé", null=True),
+        ),
+        migrations.AddField(
+            model_name='fichier',
+            name='variantes',
+            field=models.JSONField(blank=True, default=dict, editable=False, help_text='Images réduites par largeur en pixels (IMG)'),
+        ),
+    ]
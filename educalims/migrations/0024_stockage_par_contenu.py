@@ -0,0 +1,35 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:54
+
+import educalims.stockage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0023_traitement_medias'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nom', models.CharField(max_length=255, unique=True, verbose_name='Nom dans le stockage')),
+                ('empreinte', models.CharField(db_index=True, max_length=64, verbose_name='SHA-256')),
+                ('taille', models.BigIntegerField(default=0, verbose_name='Taille (octets)')),
+                ('nb_references', models.PositiveIntegerField(default=0, verbose_name='Fichiers qui le référencent')),
+                ('date_creation', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Contenu stocké',
+                'verbose_name_plural': 'Contenus stockés',
+                'ordering': ['-date_creation'],
+            },
+        ),
+        migrations.AlterField(
+            model_name='fichier',
+            name='fichier',
+            field=models.FileField(blank=True, help_text='Fichier uploadé (pour PDF, images, etc.)', null=True, storage=educalims.stockage.stockage_fichiers, upload_to='fichiers/%Y/%m/'),
+        ),
+    ]
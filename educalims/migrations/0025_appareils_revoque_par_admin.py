@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0024_stockage_par_contenu'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userdevice',
+            name='revoque_par_admin',
+            field=models.BooleanField(default=False, verbose_name="Révoqué par l'admin"),
+        ),
+    ]
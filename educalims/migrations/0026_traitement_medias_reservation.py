@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-18 13:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0025_appareils_revoque_par_admin'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fichier',
+            name='traitement_reserve_le',
+            field=models.DateTimeField(blank=True, editable=False, help_text='Analyse en cours par un worker process_media', null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 6.0.1 on 2026-10-18 13:14
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+def garder_un_compte_par_appareil(apps, schema_editor):
+    """Appareil enregistre pour plusieurs comptes : garde le plus recemment utilise"""
+    UserDevice = apps.get_model('educalims', 'UserDevice')
+    doublons = (
+        UserDevice.objects.order_by().values('device_id').annotate(nombre=models.Count('id'))
+        .filter(nombre__gt=1).values_list('device_id', flat=True)
+    )
+    for device_id in list(doublons):
+        appareils = UserDevice.objects.filter(device_id=device_id).order_by(
+            F('revoque_le').asc(nulls_first=True), F('dernier_acces').desc(nulls_last=True), '-date_ajout'
+        )
+        UserDevice.objects.filter(pk__in=list(appareils.values_list('pk', flat=True)[1:])).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('educalims', '0026_traitement_medias_reservation'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(garder_un_compte_par_appareil, migrations.RunPython.noop),
+        migrations.RemoveConstraint(
+            model_name='userdevice',
+            name='appareil_user_device_unique',
+        ),
+        migrations.AddConstraint(
+            model_name='userdevice',
+            constraint=models.UniqueConstraint(fields=('device_id',), name='appareil_device_unique'),
+        ),
+    ]
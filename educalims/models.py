@@ -1,15 +1,42 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 import uuid
 from datetime import date
+from .stockage import stockage_fichiers
 
 
 
-class Cycle(models.Model):
+class CompteursDenormalises(models.Model):
+    """
+    Compteurs ecrits uniquement par compteurs.py (UPDATE en base) : un save() complet d'une
+    instance chargee plus tot ne reecrit pas leurs valeurs perimees
+    """
+    COMPTEURS = ('nb_disciplines', 'nb_niveaux_enfants', 'nb_chapitres', 'nb_unites_enfants', 'nb_fichiers_actifs')
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        existant = self.pk is not None and not self._state.adding and not kwargs.get('force_insert')
+        if existant and not args and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                champ.name for champ in self._meta.concrete_fields
+                if not champ.primary_key and champ.name not in self.COMPTEURS
+            ]
+        super().save(*args, **kwargs)
+
+
+class Cycle(CompteursDenormalises):
     """Cycle éducatif (Collège, Lycée)"""
     nom = models.CharField(max_length=100, unique=True)
     description = models.TextField(blank=True, null=True)
     ordre = models.PositiveIntegerField(default=0, help_text="Ordre d'affichage")
+    # Compteurs denormalises (voir compteurs.py et manage.py reconcile_counters)
+    nb_disciplines = models.PositiveIntegerField(default=0, editable=False, help_text="Nombre de disciplines")
+    nb_niveaux_enfants = models.PositiveIntegerField(default=0, editable=False, help_text="Nombre de niveaux enfants")
+    nb_chapitres = models.PositiveIntegerField(default=0, editable=False, help_text="Nombre de chapitres (unites finales)")
+    nb_fichiers_actifs = models.PositiveIntegerField(default=0, editable=False, help_text="Nombre de fichiers actifs")
     date_creation = models.DateTimeField(auto_now_add=True)
     date_modification = models.DateTimeField(auto_now=True)
 
@@ -22,7 +49,7 @@ class Cycle(models.Model):
         return self.nom
 
 
-class Discipline(models.Model):
+class Discipline(CompteursDenormalises):
     """Discipline (SVT, Mathématiques, etc.)"""
     nom = models.CharField(max_length=200, unique=True)
     description = models.TextField(blank=True, null=True)
@@ -30,6 +57,10 @@ class Discipline(models.Model):
     couleur = models.CharField(max_length=7, default='#667eea', help_text="Code hexadécimal de la couleur")
     icone = models.CharField(max_length=50, blank=True, help_text="Nom de l'icône (FontAwesome, etc.)")
     ordre = models.PositiveIntegerField(default=0, help_text="Ordre d'affichage")
+    # Compteurs denormalises (voir compteurs.py et manage.py reconcile_counters)
+    nb_niveaux_enfants = models.PositiveIntegerField(default=0, editable=False, help_text="Nombre de niveaux enfants")
+    nb_chapitres = models.PositiveIntegerField(default=0, editable=False, help_text="Nombre de chapitres (unites finales)")
+    nb_fichiers_actifs = models.PositiveIntegerField(default=0, editable=False, help_text="Nombre de fichiers actifs")
     date_creation = models.DateTimeField(auto_now_add=True)
     date_modification = models.DateTimeField(auto_now=True)
 
@@ -42,7 +73,7 @@ class Discipline(models.Model):
         return self.nom
 
 
-class Niveau(models.Model):
+class Niveau(CompteursDenormalises):
     """Niveau (ex: Terminale -> Terminale C, Terminale D)"""
     SPECIALITE_CHOICES = [
         ('L', 'Littéraire'),
@@ -75,6 +106,10 @@ class Niveau(models.Model):
         default=False,
         help_text="True si ce niveau a un niveau parent (ex: Terminale C)"
     )
+    # Compteurs denormalises (voir compteurs.py et manage.py reconcile_counters)
+    nb_niveaux_enfants = models.PositiveIntegerField(default=0, editable=False, help_text="Nombre de niveaux enfants")
+    nb_chapitres = models.PositiveIntegerField(default=0, editable=False, help_text="Nombre de chapitres (unites finales)")
+    nb_fichiers_actifs = models.PositiveIntegerField(default=0, editable=False, help_text="Nombre de fichiers actifs")
     date_creation = models.DateTimeField(auto_now_add=True)
     date_modification = models.DateTimeField(auto_now=True)
 
@@ -101,7 +136,7 @@ class Niveau(models.Model):
         super().save(*args, **kwargs)
 
 
-class Unite(models.Model):
+class Unite(CompteursDenormalises):
     """Unité d'enseignement (chapitre, partie, etc.)"""
     TYPE_UNITE_CHOICES = [
         ('C', 'Chapitre'),
@@ -130,6 +165,14 @@ class Unite(models.Model):
     )
     description = models.TextField(blank=True, null=True)
     ordre = models.PositiveIntegerField(default=0, help_text="Ordre d'affichage")
+    # Compteurs denormalises (voir compteurs.py et manage.py reconcile_counters)
+    nb_unites_enfants = models.PositiveIntegerField(default=0, editable=False, help_text="Nombre d'unites enfants")
+    nb_fichiers_actifs = models.PositiveIntegerField(default=0, editable=False, help_text="Nombre de fichiers actifs")
+    # Chemin materialise "id_racine/.../id/" maintenu par save() (voir manage.py rebuild_unite_paths)
+    chemin = models.CharField(max_length=255, blank=True, default='', editable=False,
+                              help_text="Chemin materialise des ancetres (ex: 3/17/42/)")
+    profondeur = models.PositiveSmallIntegerField(default=0, editable=False,
+                                                  help_text="Profondeur dans la hierarchie (0 = racine)")
     date_creation = models.DateTimeField(auto_now_add=True)
     date_modification = models.DateTimeField(auto_now=True)
 
@@ -137,13 +180,83 @@ class Unite(models.Model):
         ordering = ['ordre', 'nom']
         verbose_name = "Unité"
         verbose_name_plural = "Unités"
+        indexes = [
+            # varchar_pattern_ops : les recherches chemin LIKE 'x/y/%' utilisent l'index
+            models.Index(fields=['chemin'], name='unite_chemin_idx', opclasses=['varchar_pattern_ops']),
+        ]
 
     def __str__(self):
         prefixe = f"[{self.get_type_unite_display()}] "
-        if self.unite_parent:
+        # Nom du parent seulement s'il est deja charge (select_related) : pas de requete par unite
+        if self.unite_parent_id and Unite.unite_parent.is_cached(self):
             return f"{prefixe}{self.unite_parent.nom} > {self.nom}"
         return f"{prefixe}{self.nom}"
 
+    def clean(self):
+        from django.core.exceptions import ValidationError
+        if self.pk and self.unite_parent_id:
+            chemin_parent = Unite.objects.filter(pk=self.unite_parent_id).values_list('chemin', flat=True).first() or ''
+            if self.unite_parent_id == self.pk or f"/{self.pk}/" in f"/{chemin_parent}":
+                raise ValidationError({'unite_parent': "Une unité ne peut pas être placée sous elle-même ou sous une de ses sous-unités."})
+
+    def save(self, *args, **kwargs):
+        from django.db import transaction
+        with transaction.atomic():
+            if self.pk:
+                # Le chemin n'est modifie que par _mettre_a_jour_chemin (valeur en memoire potentiellement perimee)
+                ancien = Unite.objects.filter(pk=self.pk).values_list('chemin', 'profondeur').first()
+                if ancien:
+                    self.chemin, self.profondeur = ancien
+            super().save(*args, **kwargs)
+            self._mettre_a_jour_chemin()
+
+    def _mettre_a_jour_chemin(self):
+        """Recalcule le chemin de l'unite et, en cas de deplacement, celui de tout son sous-arbre"""
+        from django.db.models import F, Value
+        from django.db.models.functions import Concat, Substr
+
+        chemin_parent, profondeur = '', 0
+        if self.unite_parent_id:
+            parent = Unite.objects.filter(pk=self.unite_parent_id).values_list('chemin', 'profondeur').first()
+            if parent:
+                chemin_parent, profondeur = parent[0], parent[1] + 1
+        nouveau_chemin = f"{chemin_parent}{self.pk}/"
+        if nouveau_chemin == self.chemin and profondeur == self.profondeur:
+            return
+        if self.chemin and chemin_parent.startswith(self.chemin):
+            raise ValueError("Une unité ne peut pas être déplacée sous une de ses sous-unités")
+
+        ancien_chemin, ancienne_profondeur = self.chemin, self.profondeur
+        Unite.objects.filter(pk=self.pk).update(chemin=nouveau_chemin, profondeur=profondeur)
+        if ancien_chemin:
+            # Deplacement : un seul UPDATE pour reecrire le prefixe de tous les descendants
+            Unite.objects.filter(chemin__startswith=ancien_chemin).exclude(pk=self.pk).update(
+                chemin=Concat(Value(nouveau_chemin), Substr('chemin', len(ancien_chemin) + 1)),
+                profondeur=F('profondeur') + (profondeur - ancienne_profondeur),
+            )
+        self.chemin, self.profondeur = nouveau_chemin, profondeur
+
+    def ancetres_ids(self):
+        """Identifiants des ancetres, de la racine au parent direct (sans requete)"""
+        return [int(pk) for pk in self.chemin.split('/') if pk][:-1]
+
+    def ancetres(self):
+        """Ancetres de la racine au parent direct, en une requete par cle primaire"""
+        return Unite.objects.filter(pk__in=self.ancetres_ids()).order_by('profondeur')
+
+    def descendants(self):
+        """Toutes les sous-unites, en une requete sur l'index du chemin"""
+        return Unite.objects.filter(chemin__startswith=self.chemin).exclude(pk=self.pk)
+
+    def fichiers_sous_arbre(self):
+        """Fichiers de l'unite et de toutes ses sous-unites"""
+        return Fichier.objects.filter(unite__chemin__startswith=self.chemin)
+
+    @property
+    def est_feuille(self):
+        """Une unite finale (chapitre) n'a pas d'unite enfant"""
+        return self.nb_unites_enfants == 0
+
 
 class Fichier(models.Model):
     """Fichier pédagogique (Texte, PDF, Vidéo, Liens)"""
@@ -166,6 +279,8 @@ class Fichier(models.Model):
     )
     fichier = models.FileField(
         upload_to='fichiers/%Y/%m/',
+        # Stocke par contenu (SHA-256) : un meme PDF joint a plusieurs unites n'est stocke qu'une fois
+        storage=stockage_fichiers,
         blank=True,
         null=True,
         help_text="Fichier uploadé (pour PDF, images, etc.)"
@@ -196,6 +311,22 @@ class Fichier(models.Model):
     date_creation = models.DateTimeField(auto_now_add=True)
     date_modification = models.DateTimeField(auto_now=True)
 
+    # Rempli par manage.py process_media apres chaque upload (voir traitement_medias.py)
+    empreinte = models.CharField(max_length=64, blank=True, default='', editable=False,
+                                 help_text="SHA-256 du contenu")
+    nb_pages = models.PositiveIntegerField(blank=True, null=True, editable=False, help_text="Pages (PDF)")
+    metadonnees = models.JSONField(default=dict, blank=True, editable=False,
+                                   help_text="Métadonnées du document ou de l'image")
+    miniature = models.FileField(upload_to='apercus/', blank=True, null=True, editable=False,
+                                 help_text="Première page (PDF) ou image réduite")
+    variantes = models.JSONField(default=dict, blank=True, editable=False,
+                                 help_text="Images réduites par largeur en pixels (IMG)")
+    traite_le = models.DateTimeField(blank=True, null=True, editable=False,
+                                     help_text="Vide tant que le fichier uploadé n'a pas été analysé")
+    erreur_traitement = models.TextField(blank=True, default='', editable=False)
+    traitement_reserve_le = models.DateTimeField(blank=True, null=True, editable=False,
+                                                 help_text="Analyse en cours par un worker process_media")
+
     class Meta:
         ordering = ['-date_creation', 'nom']
         verbose_name = "Fichier"
@@ -213,6 +344,26 @@ class Fichier(models.Model):
         return None
 
 
+class Blob(models.Model):
+    """
+    Contenu stocke par empreinte (stockage.py), partage par les Fichier qui le referencent.
+    nb_references est maintenu par les signaux de Fichier et recalcule par manage.py gc_media.
+    """
+    nom = models.CharField(max_length=255, unique=True, verbose_name="Nom dans le stockage")
+    empreinte = models.CharField(max_length=64, db_index=True, verbose_name="SHA-256")
+    taille = models.BigIntegerField(default=0, verbose_name="Taille (octets)")
+    nb_references = models.PositiveIntegerField(default=0, verbose_name="Fichiers qui le référencent")
+    date_creation = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Contenu stocké"
+        verbose_name_plural = "Contenus stockés"
+        ordering = ['-date_creation']
+
+    def __str__(self):
+        return f"{self.empreinte[:12]}... ({self.nb_references} référence(s))"
+
+
 # ==================== MODELES D'ABONNEMENT ====================
 
 
@@ -331,7 +482,28 @@ class Abonnement(models.Model):
                 fields=['user', 'niveau', 'statut'],
                 condition=models.Q(statut='ACTIF'),
                 name='unique_abonnement_actif_par_user_niveau'
-            )
+            ),
+            # Rapprochement des paiements par reference (voir references.py et rapprochement.py)
+            models.UniqueConstraint(fields=['merchant_reference_id'], name='abonnement_merchant_ref_unique'),
+        ]
+        indexes = [
+            # Rapprochement des paiements par telephone (voir rapprochement.py)
+            models.Index(
+                fields=['user', 'date_creation'],
+                condition=models.Q(statut='EN_ATTENTE'),
+                name='abonnement_en_attente_idx'
+            ),
+            # Flux des paiements recents (curseur date_modification, id)
+            models.Index(fields=['date_modification', 'id'], name='abonnement_modification_idx'),
+            # Listes du dashboard des paiements (derniers abonnements par statut)
+            models.Index(fields=['statut', 'date_creation'], name='abonnement_statut_creation_idx'),
+            models.Index(fields=['statut', 'date_debut'], name='abonnement_statut_debut_idx'),
+            # Balayage des expirations (expire_abonnements)
+            models.Index(fields=['statut', 'date_fin'], name='abonnement_statut_fin_idx'),
+            # Acces d'un utilisateur a un niveau et paiement en attente a reutiliser (s_abonner)
+            models.Index(fields=['user', 'niveau', 'statut'], name='abonnement_user_niveau_idx'),
+            # Page "mes abonnements"
+            models.Index(fields=['user', '-date_creation'], name='abonnement_user_creation_idx'),
         ]
 
     def __str__(self):
@@ -359,13 +531,51 @@ class Abonnement(models.Model):
             self.date_fin = datetime.combine(date_expiration, time.max)
         else:
             # Par défaut, 31 août de l'année en cours
-            from datetime import date
-            default_expiration = date(date.today().year, 8, 31)
-            self.date_fin = datetime.combine(default_expiration, time.max)
+            self.date_fin = datetime.combine(get_default_expiration_date(), time.max)
         
         self.save()
 
 
+class AbonnementArchive(models.Model):
+    """
+    Abonnements termines (ANNULE, ECHOUE, EXPIRE) deplaces hors de la table Abonnement
+    par manage.py reap_abonnements ; l'id d'origine est conserve
+    """
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='abonnements_archives')
+    niveau = models.ForeignKey(Niveau, on_delete=models.CASCADE, related_name='abonnements_archives')
+    produit = models.ForeignKey(Produit, on_delete=models.PROTECT, related_name='abonnements_archives')
+    statut = models.CharField(max_length=20, choices=Abonnement.STATUT_CHOICES)
+    reference_interne = models.CharField(max_length=200, blank=True, null=True)
+    merchant_reference_id = models.CharField(max_length=200, blank=True, null=True, db_index=True)
+    code_paiement = models.CharField(max_length=10, blank=True, null=True)
+    methode_paiement = models.CharField(max_length=20, blank=True, null=True)
+    montant_paye = models.PositiveIntegerField(blank=True, null=True)
+    date_debut = models.DateTimeField(blank=True, null=True)
+    date_fin = models.DateTimeField(blank=True, null=True)
+    date_creation = models.DateTimeField()
+    date_modification = models.DateTimeField()
+    date_archivage = models.DateTimeField(auto_now_add=True)
+
+    # Champs recopies depuis Abonnement
+    CHAMPS_COPIES = [
+        'id', 'user_id', 'niveau_id', 'produit_id', 'statut', 'reference_interne', 'merchant_reference_id',
+        'code_paiement', 'methode_paiement', 'montant_paye', 'date_debut', 'date_fin',
+        'date_creation', 'date_modification',
+    ]
+
+    class Meta:
+        ordering = ['-date_creation']
+        verbose_name = "Abonnement archivé"
+        verbose_name_plural = "Abonnements archivés"
+        indexes = [
+            models.Index(fields=['user', 'date_creation'], name='archive_user_creation_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.niveau_id} ({self.get_statut_display()}, archivé)"
+
+
 class WebhookLog(models.Model):
     """Journal des notifications webhook reçues de Cyberschool"""
     STATUT_CHOICES = [
@@ -373,7 +583,15 @@ class WebhookLog(models.Model):
         ('FAILED', 'Échec'),
         ('PENDING', 'En attente'),
     ]
+    RAPPROCHEMENT_CHOICES = [
+        ('REFERENCE', 'Par référence marchand'),
+        ('TELEPHONE', 'Par téléphone et montant'),
+        ('AMBIGU', 'Ambigu (plusieurs abonnements possibles)'),
+        ('AUCUN', 'Aucun abonnement'),
+    ]
 
+    provider = models.CharField(max_length=30, default='cyberschool', verbose_name="Fournisseur",
+                                help_text="Point d'entrée ayant reçu la notification")
     merchant_reference_id = models.CharField(max_length=255, null=True, blank=True, verbose_name="Référence marchand")
     code = models.IntegerField(null=True, blank=True, verbose_name="Code de réponse")
     status = models.CharField(max_length=20, choices=STATUT_CHOICES, verbose_name="Statut")
@@ -384,18 +602,146 @@ class WebhookLog(models.Model):
     abonnement = models.ForeignKey(Abonnement, on_delete=models.SET_NULL, null=True, blank=True,
                                   related_name='webhook_logs', verbose_name="Abonnement")
     activation_succes = models.BooleanField(default=False, verbose_name="Activation réussie")
-    telegram_notification_sent = models.BooleanField(default=True, verbose_name="Notif Telegram envoyée")
+    telegram_notification_sent = models.BooleanField(default=False, verbose_name="Notif Telegram envoyée")
     raw_data = models.JSONField(default=dict, verbose_name="Données brutes")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Date de réception")
+    traite_le = models.DateTimeField(null=True, blank=True, verbose_name="Traité le",
+                                     help_text="Vide = en attente de manage.py process_webhooks")
+    erreur_traitement = models.TextField(blank=True, default='', verbose_name="Erreur de traitement")
+    reponse = models.JSONField(null=True, blank=True, verbose_name="Réponse renvoyée",
+                               help_text="Rejouée telle quelle si la même transaction est reçue à nouveau")
+    reponse_http = models.PositiveSmallIntegerField(null=True, blank=True, verbose_name="Code HTTP renvoyé")
+    rapprochement = models.CharField(max_length=20, choices=RAPPROCHEMENT_CHOICES, blank=True, default='',
+                                     verbose_name="Rapprochement")
+    candidats = models.JSONField(default=list, blank=True, verbose_name="Abonnements candidats",
+                                 help_text="Identifiants des abonnements possibles quand le rapprochement est ambigu")
 
     class Meta:
         verbose_name = "Journal Webhook"
         verbose_name_plural = "Journaux Webhooks"
         ordering = ['-created_at']
+        constraints = [
+            # Idempotence : une transaction n'est enregistree qu'une fois par fournisseur
+            models.UniqueConstraint(
+                fields=['provider', 'transaction_id'],
+                condition=models.Q(transaction_id__isnull=False) & ~models.Q(transaction_id=''),
+                name='webhook_transaction_unique'
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(traite_le__isnull=True),
+                name='webhook_a_traiter_idx'
+            ),
+            # Liste et filtres de l'admin (tri par date de reception decroissante)
+            models.Index(fields=['-created_at'], name='webhook_created_idx'),
+            models.Index(fields=['status', '-created_at'], name='webhook_status_created_idx'),
+            models.Index(fields=['operator', '-created_at'], name='webhook_operator_created_idx'),
+        ]
 
     def __str__(self):
         return f"Webhook {self.merchant_reference_id or 'N/A'} - {self.status} ({self.created_at.strftime('%d/%m/%Y %H:%M')})"
 
+class NotificationTelegram(models.Model):
+    """File d'attente durable des notifications Telegram (videe par manage.py run_notifier)"""
+    STATUT_CHOICES = [
+        ('EN_ATTENTE', 'En attente'),
+        ('ENVOYEE', 'Envoyée'),
+        ('ECHEC', 'Échec définitif'),
+    ]
+    CATEGORIE_CHOICES = [
+        ('NOUVEL_ABONNEMENT', 'Nouvel abonnement'),
+        ('WEBHOOK_RECU', 'Webhook reçu'),
+        ('PAIEMENT_SUCCES', 'Paiement réussi'),
+        ('PAIEMENT_ECHEC', 'Paiement échoué'),
+        ('PAIEMENT_NON_TROUVE', 'Paiement sans abonnement'),
+    ]
+
+    message = models.TextField(verbose_name="Message")
+    categorie = models.CharField(max_length=30, choices=CATEGORIE_CHOICES, blank=True, default='',
+                                 verbose_name="Catégorie", help_text="Vide = toujours envoyée individuellement")
+    operateur = models.CharField(max_length=50, blank=True, default='', verbose_name="Opérateur")
+    montant = models.PositiveIntegerField(null=True, blank=True, verbose_name="Montant")
+    statut = models.CharField(max_length=20, choices=STATUT_CHOICES, default='EN_ATTENTE', verbose_name="Statut")
+    tentatives = models.PositiveSmallIntegerField(default=0, verbose_name="Tentatives")
+    prochaine_tentative = models.DateTimeField(default=timezone.now, verbose_name="Prochaine tentative")
+    derniere_erreur = models.TextField(blank=True, default='', verbose_name="Dernière erreur")
+    webhook_log = models.ForeignKey(WebhookLog, on_delete=models.SET_NULL, null=True, blank=True,
+                                    related_name='notifications', verbose_name="Webhook")
+    date_creation = models.DateTimeField(auto_now_add=True, verbose_name="Date de création")
+    date_envoi = models.DateTimeField(null=True, blank=True, verbose_name="Date d'envoi")
+
+    class Meta:
+        verbose_name = "Notification Telegram"
+        verbose_name_plural = "Notifications Telegram"
+        ordering = ['-date_creation']
+        indexes = [
+            models.Index(
+                fields=['prochaine_tentative'],
+                condition=models.Q(statut='EN_ATTENTE'),
+                name='notif_telegram_a_envoyer_idx'
+            )
+        ]
+
+    def __str__(self):
+        return f"Notification {self.pk} - {self.get_statut_display()} ({self.tentatives} tentative(s))"
+
+
+class StatistiquePaiement(models.Model):
+    """
+    Agregats journaliers des abonnements par operateur, niveau et recommandation,
+    maintenus a chaque changement de statut (voir statistiques.py)
+    """
+    jour = models.DateField(verbose_name="Jour")
+    operateur = models.CharField(max_length=20, blank=True, default='', verbose_name="Opérateur")
+    niveau = models.ForeignKey(Niveau, on_delete=models.CASCADE, related_name='statistiques_paiement',
+                               verbose_name="Niveau")
+    recommande_par = models.CharField(max_length=20, default='aucun', verbose_name="Recommandé par")
+    nb_crees = models.PositiveIntegerField(default=0, verbose_name="Abonnements créés")
+    nb_actives = models.PositiveIntegerField(default=0, verbose_name="Paiements réussis")
+    nb_echoues = models.PositiveIntegerField(default=0, verbose_name="Paiements échoués")
+    nb_annules = models.PositiveIntegerField(default=0, verbose_name="Annulés")
+    nb_expires = models.PositiveIntegerField(default=0, verbose_name="Expirés")
+    montant_total = models.PositiveBigIntegerField(default=0, verbose_name="Revenu (FCFA)")
+
+    class Meta:
+        verbose_name = "Statistique de paiement"
+        verbose_name_plural = "Statistiques de paiement"
+        ordering = ['-jour']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['jour', 'operateur', 'niveau', 'recommande_par'],
+                name='statistique_paiement_unique'
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.jour:%d/%m/%Y} - {self.niveau_id} / {self.operateur or 'N/A'} / {self.recommande_par}"
+
+
+class StatistiqueRecommandation(models.Model):
+    """
+    Compteurs journaliers par code de recommandation : inscriptions du jour et abonnements
+    crees ce jour encore en attente (paiements et revenus : voir StatistiquePaiement)
+    """
+    jour = models.DateField(verbose_name="Jour")
+    recommande_par = models.CharField(max_length=20, default='aucun', verbose_name="Recommandé par")
+    nb_inscrits = models.PositiveIntegerField(default=0, verbose_name="Inscriptions")
+    nb_en_attente = models.PositiveIntegerField(default=0, verbose_name="Abonnements en attente")
+
+    class Meta:
+        verbose_name = "Statistique de recommandation"
+        verbose_name_plural = "Statistiques de recommandation"
+        ordering = ['-jour']
+        constraints = [
+            models.UniqueConstraint(fields=['jour', 'recommande_par'], name='statistique_recommandation_unique')
+        ]
+
+    def __str__(self):
+        return f"{self.jour:%d/%m/%Y} - {self.recommande_par}"
+
+
 # ==================== USER PROFILE ====================
 class UserProfile(models.Model):
     RECOMMANDATION_CHOICES = [
@@ -416,18 +762,57 @@ class UserProfile(models.Model):
         verbose_name='Recommandé par'
     )
     telephone = models.CharField(max_length=20, blank=True, null=True, verbose_name='Téléphone')
-# Appareil autorise pour cet utilisateur (securite JWT)
-    device_id = models.CharField(
-        max_length=255,
+    telephone_normalise = models.CharField(
+        max_length=20,
         blank=True,
-        null=True,
-        unique=True,
-        help_text="Identifiant unique de l appareil autorise"
+        default='',
+        db_index=True,
+        editable=False,
+        help_text="Telephone sans indicatif ni zero initial, pour le rapprochement des paiements"
     )
     
     def __str__(self):
         return f"Profile de {self.user.username}"
+
+    def save(self, *args, **kwargs):
+        from .rapprochement import normaliser_telephone
+        self.telephone_normalise = normaliser_telephone(self.telephone)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'telephone' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'telephone_normalise'}
+        super().save(*args, **kwargs)
     
     class Meta:
         verbose_name = 'Profil utilisateur'
         verbose_name_plural = 'Profils utilisateurs'
+
+
+class UserDevice(models.Model):
+    """
+    Appareil autorise pour un utilisateur (securite JWT) : au plus APPAREILS_MAX actifs,
+    le moins recemment utilise est mis de cote au-dela (voir appareils.py)
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='appareils', verbose_name="Utilisateur")
+    device_id = models.CharField(max_length=255, verbose_name="Identifiant de l'appareil")
+    date_ajout = models.DateTimeField(auto_now_add=True, verbose_name="Date d'ajout")
+    # Ecrit par lots, en retard d'au plus APPAREILS_ACCES_INTERVALLE
+    dernier_acces = models.DateTimeField(null=True, blank=True, verbose_name="Dernier accès")
+    revoque_le = models.DateTimeField(null=True, blank=True, verbose_name="Révoqué le")
+    # Faux : remplace par un appareil plus recent (limite APPAREILS_MAX), reactive a sa prochaine connexion
+    revoque_par_admin = models.BooleanField(default=False, verbose_name="Révoqué par l'admin")
+
+    class Meta:
+        verbose_name = "Appareil"
+        verbose_name_plural = "Appareils"
+        ordering = ['-date_ajout']
+        constraints = [
+            # Un appareil n'appartient qu'a un compte (comme l'ancien UserProfile.device_id unique)
+            models.UniqueConstraint(fields=['device_id'], name='appareil_device_unique')
+        ]
+
+    def __str__(self):
+        return f"{self.user} - {self.device_id[:8]}..."
+
+    @property
+    def est_actif(self):
+        return self.revoque_le is None
@@ -0,0 +1,119 @@
+"""Plan precalcule d'un niveau (parties > chapitres > fichiers) stocke dans le cache partage"""
+import threading
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+
+from .models import Unite, Fichier
+
+
+OUTLINE_CACHE_VERSION = 1
+OUTLINE_CACHE_TIMEOUT = None  # Reconstruit par les signaux, pas d'expiration
+
+
+def outline_cache_key(niveau_id):
+    return f"outline:v{OUTLINE_CACHE_VERSION}:niveau:{niveau_id}"
+
+
+def construire_outline(niveau_id):
+    """
+    Construit le plan d'un niveau en deux requetes, quelle que soit la taille de l'arbre :
+    une pour les unites, une pour le nombre de fichiers par unite et par type.
+    """
+    unites = list(
+        Unite.objects.filter(niveau_id=niveau_id)
+        .order_by('ordre', 'nom')
+        .values('id', 'nom', 'type_unite', 'ordre', 'unite_parent_id')
+    )
+
+    fichiers_par_unite = defaultdict(dict)
+    comptes = (
+        Fichier.objects.filter(unite__niveau_id=niveau_id)
+        .order_by()
+        .values('unite_id', 'type_fichier')
+        .annotate(total=Count('id'))
+    )
+    for ligne in comptes:
+        fichiers_par_unite[ligne['unite_id']][ligne['type_fichier']] = ligne['total']
+
+    enfants = defaultdict(list)
+    for unite in unites:
+        enfants[unite['unite_parent_id']].append(unite)
+
+    def _chapitre(unite):
+        types = fichiers_par_unite.get(unite['id'], {})
+        return {
+            'id': unite['id'],
+            'nom': unite['nom'],
+            'type_unite': unite['type_unite'],
+            'ordre': unite['ordre'],
+            'fichiers_count': sum(types.values()),
+            'types_fichier': sorted(types),
+        }
+
+    parties = []
+    for partie in enfants[None]:
+        chapitres = [_chapitre(enfant) for enfant in enfants[partie['id']]]
+        parties.append({
+            'id': partie['id'],
+            'nom': partie['nom'],
+            'type_unite': partie['type_unite'],
+            'ordre': partie['ordre'],
+            'chapitres': chapitres,
+            'chapitres_count': len(chapitres),
+        })
+
+    return {
+        'niveau_id': niveau_id,
+        'parties': parties,
+        # Chapitres = unites finales (sans enfants) de la hierarchie
+        'chapitres_count': sum(1 for unite in unites if not enfants[unite['id']]),
+    }
+
+
+def get_outline(niveau_id):
+    """Retourne le plan du niveau depuis le cache, en le construisant si besoin"""
+    cle = outline_cache_key(niveau_id)
+    outline = cache.get(cle)
+    if outline is None:
+        outline = construire_outline(niveau_id)
+        cache.set(cle, outline, OUTLINE_CACHE_TIMEOUT)
+    return outline
+
+
+def reconstruire_outline(niveau_id):
+    """Reconstruit et remplace le plan du niveau dans le cache"""
+    outline = construire_outline(niveau_id)
+    cache.set(outline_cache_key(niveau_id), outline, OUTLINE_CACHE_TIMEOUT)
+    return outline
+
+
+# Niveaux a reconstruire au prochain commit, par thread (une transaction par thread)
+_en_attente = threading.local()
+
+
+def _reconstruire_en_attente():
+    niveau_ids = getattr(_en_attente, 'niveau_ids', set())
+    _en_attente.niveau_ids = set()
+    for niveau_id in niveau_ids:
+        reconstruire_outline(niveau_id)
+
+
+def planifier_reconstruction(*niveau_ids):
+    """
+    Reconstruit le plan des niveaux donnes apres le commit de la transaction courante.
+    Les niveaux touches dans une meme transaction (ex: suppression en cascade) sont
+    regroupes pour ne reconstruire chaque plan qu'une seule fois : le premier callback
+    on_commit execute vide l'ensemble, les suivants n'ont plus rien a faire.
+    Apres un rollback, les niveaux restes en attente sont reconstruits au commit suivant.
+    """
+    niveau_ids = {niveau_id for niveau_id in niveau_ids if niveau_id}
+    if not niveau_ids:
+        return
+    if not hasattr(_en_attente, 'niveau_ids'):
+        _en_attente.niveau_ids = set()
+    _en_attente.niveau_ids.update(niveau_ids)
+    # Hors transaction, on_commit execute le callback immediatement
+    transaction.on_commit(_reconstruire_en_attente)
@@ -0,0 +1,120 @@
+"""Rapprochement d'un paiement Cyberschool avec l'abonnement EN_ATTENTE correspondant"""
+import re
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Abonnement, UserProfile
+
+
+# Un paiement par telephone doit arriver dans cette fenetre apres la creation de l'abonnement
+FENETRE_RAPPROCHEMENT = getattr(settings, 'PAIEMENT_FENETRE_RAPPROCHEMENT', 2 * 60 * 60)
+INDICATIF_PAYS = '241'
+
+METHODE_REFERENCE = 'REFERENCE'
+METHODE_TELEPHONE = 'TELEPHONE'
+METHODE_AMBIGU = 'AMBIGU'
+METHODE_AUCUN = 'AUCUN'
+
+
+def normaliser_telephone(numero):
+    """
+    Forme canonique d'un numero gabonais : chiffres seuls, sans indicatif ni zero initial
+    ('+241 77 04 53 54', '24177045354', '077045354' -> '77045354').
+    """
+    chiffres = re.sub(r'\D', '', str(numero or ''))
+    if chiffres.startswith('00'):
+        chiffres = chiffres[2:]
+    if chiffres.startswith(INDICATIF_PAYS) and len(chiffres) > len(INDICATIF_PAYS) + 7:
+        chiffres = chiffres[len(INDICATIF_PAYS):]
+    return chiffres.lstrip('0')
+
+
+def _montant(valeur):
+    try:
+        return int(float(valeur))
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass
+class Rapprochement:
+    """Resultat : l'abonnement trouve (verrouille), la methode utilisee et les candidats en cas d'ambiguite"""
+    methode: str
+    abonnement: Abonnement = None
+    candidats: list = field(default_factory=list)
+
+    @property
+    def ambigu(self):
+        return self.methode == METHODE_AMBIGU
+
+
+def _unique(candidats):
+    """
+    Un seul abonnement possible, ou plusieurs tentatives du meme utilisateur pour le meme niveau
+    (la plus recente est retenue). Sinon None.
+    """
+    if len({(a.user_id, a.niveau_id) for a in candidats}) == 1:
+        return candidats[0]
+    return None
+
+
+def _verrouiller(queryset):
+    return list(
+        queryset.select_for_update(of=('self',))
+        .select_related('user', 'niveau', 'produit')
+        .order_by('-date_creation')
+    )
+
+
+def par_reference(merchant_ref):
+    """Abonnement portant cette reference marchand (contrainte unique), verrouille : liste de 0 ou 1"""
+    return _verrouiller(Abonnement.objects.filter(merchant_reference_id=merchant_ref))
+
+
+def par_telephone(numero_tel, montant=None, date_paiement=None):
+    """
+    Abonnements EN_ATTENTE des utilisateurs ayant ce telephone, crees dans la fenetre
+    precedant le paiement et dont le produit correspond au montant, verrouilles.
+    """
+    telephone = normaliser_telephone(numero_tel)
+    if not telephone:
+        return []
+    date_paiement = date_paiement or timezone.now()
+    queryset = Abonnement.objects.filter(
+        statut='EN_ATTENTE',
+        user_id__in=UserProfile.objects.filter(telephone_normalise=telephone).values('user_id'),
+        date_creation__gte=date_paiement - timedelta(seconds=FENETRE_RAPPROCHEMENT),
+        date_creation__lte=date_paiement,
+    )
+    montant = _montant(montant)
+    if montant is not None:
+        queryset = queryset.filter(produit__prix=montant)
+    return _verrouiller(queryset)
+
+
+def rapprocher_paiement(merchant_ref=None, numero_tel=None, montant=None, date_paiement=None):
+    """
+    Trouve l'abonnement correspondant a un paiement : par reference marchand, puis par
+    telephone et montant. Les candidats sont verrouilles (SELECT ... FOR UPDATE) : a appeler
+    dans une transaction. Plusieurs candidats distincts donnent METHODE_AMBIGU, sans choix.
+    """
+    if merchant_ref:
+        candidats = par_reference(merchant_ref)
+        if candidats:
+            abonnement = _unique(candidats)
+            if abonnement:
+                return Rapprochement(METHODE_REFERENCE, abonnement)
+            return Rapprochement(METHODE_AMBIGU, candidats=candidats)
+
+    if numero_tel:
+        candidats = par_telephone(numero_tel, montant, date_paiement)
+        if candidats:
+            abonnement = _unique(candidats)
+            if abonnement:
+                return Rapprochement(METHODE_TELEPHONE, abonnement)
+            return Rapprochement(METHODE_AMBIGU, candidats=candidats)
+
+    return Rapprochement(METHODE_AUCUN)
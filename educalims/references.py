@@ -0,0 +1,89 @@
+"""
+References marchand envoyees a Cyberschool : 9 chiffres, uniques et non devinables.
+
+Chaque reference est l'image d'une valeur de sequence Postgres par une permutation de
+[0, 9 * 10**8) : un reseau de Feistel a cle (HMAC) sur 30 bits, avec "cycle walking"
+pour rester dans l'intervalle. Deux valeurs de sequence distinctes donnent toujours deux
+references distinctes, sans qu'on puisse deviner la suivante.
+"""
+import hashlib
+import hmac
+import random
+
+from django.conf import settings
+from django.db import connection
+
+
+SEQUENCE = 'abonnement_merchant_reference_seq'
+REFERENCE_MIN = 10 ** 8
+ESPACE = 9 * 10 ** 8  # references 100000000 a 999999999
+BITS = 30  # 2**30 > ESPACE
+DEMI = BITS // 2
+MASQUE = (1 << DEMI) - 1
+TOURS = 4
+
+
+def _cle():
+    # Ne doit plus changer une fois des references emises (sinon la permutation change)
+    return (getattr(settings, 'MERCHANT_REFERENCE_CLE', None) or settings.SECRET_KEY).encode()
+
+
+def _feistel(valeur, cle):
+    gauche, droite = valeur >> DEMI, valeur & MASQUE
+    for tour in range(TOURS):
+        empreinte = hmac.new(cle, f"{tour}:{droite}".encode(), hashlib.sha256).digest()
+        gauche, droite = droite, gauche ^ (int.from_bytes(empreinte[:4], 'big') & MASQUE)
+    return (gauche << DEMI) | droite
+
+
+def permuter(numero):
+    """Image de `numero` (0 <= numero < ESPACE) par la permutation : une reference de 9 chiffres"""
+    if not 0 <= numero < ESPACE:
+        raise ValueError(f"Numero hors de l'espace des references: {numero}")
+    cle = _cle()
+    valeur = _feistel(numero, cle)
+    # Cycle walking : on reapplique la permutation tant qu'on sort de l'intervalle
+    while valeur >= ESPACE:
+        valeur = _feistel(valeur, cle)
+    return str(REFERENCE_MIN + valeur)
+
+
+def creer_sequence(schema_editor=None):
+    """Cree la sequence des references (Postgres uniquement)"""
+    conn = schema_editor.connection if schema_editor else connection
+    if conn.vendor != 'postgresql':
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(f"CREATE SEQUENCE IF NOT EXISTS {SEQUENCE} MINVALUE 0 START 0 MAXVALUE {ESPACE - 1}")
+
+
+def _prochain_numero(conn):
+    if conn.vendor != 'postgresql':
+        # Hors Postgres (developpement) : tirage aleatoire, l'unicite reste garantie par l'index
+        return random.randrange(ESPACE)
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT nextval(%s)", [SEQUENCE])
+        return cursor.fetchone()[0]
+
+
+def reference_libre(reference, Abonnement=None, AbonnementArchive=None):
+    """Vrai si la reference n'est portee par aucun abonnement, meme archive (sondes de l'index unique)"""
+    from .models import Abonnement as AbonnementModele, AbonnementArchive as ArchiveModele
+    Abonnement = Abonnement or AbonnementModele
+    AbonnementArchive = AbonnementArchive or ArchiveModele
+    return not (
+        Abonnement.objects.filter(merchant_reference_id=reference).exists()
+        or AbonnementArchive.objects.filter(merchant_reference_id=reference).exists()
+    )
+
+
+def allouer_reference(conn=None, **modeles):
+    """
+    Nouvelle reference marchand. Les references aleatoires emises avant l'allocateur peuvent
+    coincider avec une image de la sequence : on passe alors a la valeur suivante.
+    """
+    conn = conn or connection
+    while True:
+        reference = permuter(_prochain_numero(conn))
+        if reference_libre(reference, **modeles):
+            return reference
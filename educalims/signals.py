@@ -0,0 +1,251 @@
+"""Signaux de l'application educalims (maintenance des donnees precalculees)"""
+from django.db import transaction
+from django.db.models.signals import post_init, pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from . import compteurs
+from .entitlements import invalider_droits
+from .evenements import publier_statut
+from .appareils import invalider_appareils
+from .dedoublonnage import referencer
+from .models import Cycle, Discipline, Niveau, Unite, Fichier, Abonnement, UserProfile, UserDevice
+from .outline import planifier_reconstruction
+from .statistiques import enregistrer_inscription, enregistrer_transition
+from .traitement_medias import supprimer_apercus
+
+
+def _rafraichir_depuis_unites(unite_ids):
+    """Met a jour les compteurs des unites donnees et de leurs niveaux, disciplines et cycles"""
+    unite_ids = {pk for pk in unite_ids if pk}
+    if not unite_ids:
+        return set()
+    lignes = list(
+        Unite.objects.filter(pk__in=unite_ids)
+        .values_list('niveau_id', 'discipline_id', 'niveau__cycle_id')
+    )
+    compteurs.rafraichir_unites(unite_ids)
+    compteurs.rafraichir_niveaux(ligne[0] for ligne in lignes)
+    compteurs.rafraichir_disciplines(ligne[1] for ligne in lignes)
+    compteurs.rafraichir_cycles(ligne[2] for ligne in lignes)
+    return {ligne[0] for ligne in lignes}
+
+
+# ==================== UNITES ====================
+
+@receiver(pre_save, sender=Unite)
+def memoriser_unite(sender, instance, **kwargs):
+    """Memorise l'ancienne position d'une unite deplacee"""
+    instance._ancien = None
+    if instance.pk:
+        instance._ancien = (
+            Unite.objects.filter(pk=instance.pk)
+            .values('niveau_id', 'discipline_id', 'unite_parent_id', 'niveau__cycle_id')
+            .first()
+        )
+
+
+@receiver(post_save, sender=Unite)
+@receiver(post_delete, sender=Unite)
+def maintenir_unite(sender, instance, **kwargs):
+    ancien = getattr(instance, '_ancien', None) or {}
+    parents = {instance.unite_parent_id, ancien.get('unite_parent_id')}
+    compteurs.rafraichir_unites(parents | {instance.pk})
+    niveau_ids = {instance.niveau_id, ancien.get('niveau_id')}
+    compteurs.rafraichir_niveaux(niveau_ids)
+    compteurs.rafraichir_disciplines({instance.discipline_id, ancien.get('discipline_id')})
+    compteurs.rafraichir_cycles(
+        set(Niveau.objects.filter(pk__in=niveau_ids - {None}).values_list('cycle_id', flat=True))
+        | {ancien.get('niveau__cycle_id')}
+    )
+    planifier_reconstruction(*niveau_ids)
+
+
+# ==================== FICHIERS ====================
+
+# Champs dont la modification n'affecte ni les compteurs ni le plan des niveaux
+CHAMPS_FICHIER_SANS_IMPACT = frozenset({
+    'telechargements', 'taille', 'duree', 'empreinte', 'nb_pages', 'metadonnees', 'miniature', 'variantes',
+    'traite_le', 'erreur_traitement', 'traitement_reserve_le',
+})
+
+
+def _sans_impact(update_fields):
+    return update_fields is not None and set(update_fields) <= CHAMPS_FICHIER_SANS_IMPACT
+
+
+@receiver(pre_save, sender=Fichier)
+def memoriser_fichier(sender, instance, update_fields=None, **kwargs):
+    """Memorise l'ancienne unite d'un fichier deplace ; un nouvel upload sera analyse par process_media"""
+    instance._ancienne_unite_id = None
+    instance._ancien_fichier = None
+    if instance.pk and not _sans_impact(update_fields):
+        ancien = Fichier.objects.filter(pk=instance.pk).values_list('unite_id', 'fichier').first()
+        if ancien:
+            instance._ancienne_unite_id, ancien_fichier = ancien
+            instance._ancien_fichier = ancien_fichier
+            # Upload pas encore enregistre par le stockage (_committed) ou fichier remplace
+            if not instance.fichier._committed or (instance.fichier.name or '') != (ancien_fichier or ''):
+                instance.traite_le = None
+                # Analyse en cours sur l'ancien fichier : son resultat sera ignore
+                instance.traitement_reserve_le = None
+
+
+@receiver(post_save, sender=Fichier)
+@receiver(post_delete, sender=Fichier)
+def maintenir_fichier(sender, instance, update_fields=None, **kwargs):
+    if _sans_impact(update_fields):
+        return
+    niveau_ids = _rafraichir_depuis_unites(
+        {instance.unite_id, getattr(instance, '_ancienne_unite_id', None)}
+    )
+    planifier_reconstruction(*niveau_ids)
+
+
+@receiver(post_save, sender=Fichier)
+def referencer_blob_fichier(sender, instance, update_fields=None, raw=False, **kwargs):
+    """Stockage par contenu : une reference de plus au nouveau blob, une de moins a l'ancien"""
+    if raw or _sans_impact(update_fields):
+        return
+    nom = instance.fichier.name or None
+    ancien = getattr(instance, '_ancien_fichier', None) or None
+    if nom != ancien:
+        referencer(nom, 1)
+        referencer(ancien, -1)
+
+
+@receiver(post_delete, sender=Fichier)
+def liberer_blob_fichier(sender, instance, **kwargs):
+    """Blob sans reference : supprime par manage.py gc_media ; apercus supprimes apres commit"""
+    referencer(instance.fichier.name, -1)
+    fichier_id = instance.pk
+    transaction.on_commit(lambda: supprimer_apercus(fichier_id))
+
+
+# ==================== NIVEAUX ====================
+
+@receiver(pre_save, sender=Niveau)
+def memoriser_niveau(sender, instance, **kwargs):
+    instance._ancien = None
+    if instance.pk:
+        instance._ancien = (
+            Niveau.objects.filter(pk=instance.pk).values('cycle_id', 'niveau_parent_id').first()
+        )
+
+
+@receiver(pre_delete, sender=Niveau)
+def memoriser_disciplines_niveau(sender, instance, **kwargs):
+    """Les liaisons M2M sont supprimees avant le niveau : on garde ses disciplines"""
+    instance._discipline_ids = set(instance.disciplines.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=Niveau)
+@receiver(post_delete, sender=Niveau)
+def maintenir_niveau(sender, instance, **kwargs):
+    ancien = getattr(instance, '_ancien', None) or {}
+    compteurs.rafraichir_niveaux({instance.pk, instance.niveau_parent_id, ancien.get('niveau_parent_id')})
+    compteurs.rafraichir_cycles({instance.cycle_id, ancien.get('cycle_id')})
+    discipline_ids = getattr(instance, '_discipline_ids', None)
+    if discipline_ids is None:
+        discipline_ids = instance.disciplines.values_list('pk', flat=True)
+    compteurs.rafraichir_disciplines(discipline_ids)
+
+
+@receiver(m2m_changed, sender=Niveau.disciplines.through)
+def maintenir_niveau_disciplines(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear', 'post_clear'):
+        return
+    if action == 'pre_clear':
+        # pk_set est vide pour clear() : on memorise les liaisons avant suppression
+        related = instance.niveaux if reverse else instance.disciplines
+        instance._m2m_clear_ids = set(related.values_list('pk', flat=True))
+        return
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_m2m_clear_ids', set())
+    if reverse:
+        compteurs.rafraichir_disciplines({instance.pk})
+    else:
+        compteurs.rafraichir_disciplines(pk_set or ())
+
+
+# ==================== CYCLES ET DISCIPLINES ====================
+
+@receiver(post_save, sender=Cycle)
+def maintenir_cycle(sender, instance, **kwargs):
+    compteurs.rafraichir_cycles({instance.pk})
+
+
+@receiver(post_save, sender=Discipline)
+def maintenir_discipline(sender, instance, **kwargs):
+    compteurs.rafraichir_disciplines({instance.pk})
+
+
+@receiver(m2m_changed, sender=Discipline.cycles.through)
+def maintenir_discipline_cycles(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear', 'post_clear'):
+        return
+    if action == 'pre_clear':
+        related = instance.disciplines if reverse else instance.cycles
+        instance._m2m_clear_ids = set(related.values_list('pk', flat=True))
+        return
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_m2m_clear_ids', set())
+    if reverse:
+        compteurs.rafraichir_cycles({instance.pk})
+    else:
+        compteurs.rafraichir_cycles(pk_set or ())
+
+
+# ==================== ABONNEMENTS ====================
+
+@receiver(post_init, sender=Abonnement)
+def memoriser_etat_abonnement(sender, instance, **kwargs):
+    """Memorise le statut et l'utilisateur charges (sans declencher de requete si differes)"""
+    instance._statut_initial = instance.__dict__.get('statut')
+    instance._user_id_initial = instance.__dict__.get('user_id')
+
+
+@receiver(post_save, sender=Abonnement)
+def maintenir_abonnement(sender, instance, created=False, **kwargs):
+    """Droits en cache, flux temps reel et statistiques de paiement a chaque changement de statut"""
+    if created:
+        # post_init a vu le statut passe au constructeur : ce n'est pas un etat charge
+        instance._statut_initial = None
+    change = (
+        instance.statut != instance._statut_initial
+        or instance.user_id != instance._user_id_initial
+        or instance.statut == 'ACTIF'  # dates de validite eventuellement modifiees
+    )
+    if change:
+        user_ids = (instance.user_id, instance._user_id_initial)
+        transaction.on_commit(lambda: invalider_droits(*user_ids))
+    if instance.statut != instance._statut_initial:
+        # Reveille la page de paiement et le widget de l'admin (flux SSE), au COMMIT
+        publier_statut(instance.pk, instance.statut)
+        enregistrer_transition(instance, instance._statut_initial)
+    instance._statut_initial = instance.statut
+    instance._user_id_initial = instance.user_id
+
+
+@receiver(post_delete, sender=Abonnement)
+def invalider_droits_abonnement_supprime(sender, instance, **kwargs):
+    user_id = instance.user_id
+    transaction.on_commit(lambda: invalider_droits(user_id))
+
+
+# ==================== PROFILS ====================
+
+@receiver(post_save, sender=UserProfile)
+def comptabiliser_inscription(sender, instance, created=False, raw=False, **kwargs):
+    """Classement des recommandations : une inscription de plus pour le code choisi"""
+    if created and not raw:
+        enregistrer_inscription(instance)
+
+
+# ==================== APPAREILS ====================
+
+@receiver(post_save, sender=UserDevice)
+@receiver(post_delete, sender=UserDevice)
+def maintenir_appareils(sender, instance, **kwargs):
+    """Appareil ajoute, revoque ou supprime : les sessions relisent les appareils (voir appareils.py)"""
+    user_id = instance.user_id
+    transaction.on_commit(lambda: invalider_appareils(user_id))
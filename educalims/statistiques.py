@@ -0,0 +1,261 @@
+"""
+Agregats des paiements (StatistiquePaiement) et des codes de recommandation
+(StatistiqueRecommandation), maintenus a chaque inscription et changement de statut d'abonnement
+"""
+from collections import defaultdict
+from datetime import date, timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import Abonnement, AbonnementArchive, StatistiquePaiement, StatistiqueRecommandation, UserProfile
+
+
+# Compteur incremente quand un abonnement passe a ce statut
+COMPTEURS = {
+    'EN_ATTENTE': 'nb_crees',
+    'ACTIF': 'nb_actives',
+    'ECHOUE': 'nb_echoues',
+    'ANNULE': 'nb_annules',
+    'EXPIRE': 'nb_expires',
+}
+
+
+def _recommande_par(user_id):
+    return (
+        UserProfile.objects.filter(user_id=user_id).values_list('recommande_par', flat=True).first()
+        or 'aucun'
+    )
+
+
+def _incrementer(modele, cle, increments):
+    """Ajoute les `increments` (champ=valeur) a la ligne `cle` du modele, creee si besoin"""
+    mise_a_jour = {champ: F(champ) + valeur for champ, valeur in increments.items()}
+    if modele.objects.filter(**cle).update(**mise_a_jour):
+        return
+    try:
+        with transaction.atomic():
+            modele.objects.create(**cle, **increments)
+    except IntegrityError:
+        # Ligne creee entre-temps par une autre transaction
+        modele.objects.filter(**cle).update(**mise_a_jour)
+
+
+def incrementer(jour, operateur, niveau_id, recommande_par, **increments):
+    """Ajoute les `increments` (champ=valeur) a la ligne d'agregat de paiement, creee si besoin"""
+    cle = {
+        'jour': jour,
+        'operateur': (operateur or '')[:20],
+        'niveau_id': niveau_id,
+        'recommande_par': recommande_par,
+    }
+    _incrementer(StatistiquePaiement, cle, increments)
+
+
+def modifier_en_attente(jour, recommande_par, delta):
+    """Ajuste le nombre d'abonnements en attente crees le `jour` pour ce code de recommandation"""
+    cle = {'jour': jour, 'recommande_par': recommande_par}
+    if delta > 0:
+        _incrementer(StatistiqueRecommandation, cle, {'nb_en_attente': delta})
+    else:
+        StatistiqueRecommandation.objects.filter(**cle, nb_en_attente__gte=-delta).update(
+            nb_en_attente=F('nb_en_attente') + delta
+        )
+
+
+def enregistrer_inscription(profil):
+    """Comptabilise une inscription pour le code de recommandation du profil"""
+    _incrementer(
+        StatistiqueRecommandation,
+        {'jour': timezone.localdate(), 'recommande_par': profil.recommande_par or 'aucun'},
+        {'nb_inscrits': 1},
+    )
+
+
+def enregistrer_transition(abonnement, ancien_statut):
+    """Comptabilise le passage de `ancien_statut` au statut actuel de l'abonnement"""
+    champ = COMPTEURS.get(abonnement.statut)
+    if champ is None or abonnement.statut == ancien_statut:
+        return
+    recommande_par = _recommande_par(abonnement.user_id)
+    increments = {champ: 1}
+    if abonnement.statut == 'ACTIF':
+        increments['montant_total'] = abonnement.montant_paye or 0
+    operateur = '' if abonnement.statut == 'EN_ATTENTE' else abonnement.methode_paiement
+    incrementer(timezone.localdate(), operateur, abonnement.niveau_id, recommande_par, **increments)
+
+    # Abonnements en attente, comptes au jour de leur creation
+    if 'EN_ATTENTE' in (abonnement.statut, ancien_statut):
+        jour_creation = timezone.localdate(abonnement.date_creation)
+        modifier_en_attente(jour_creation, recommande_par, 1 if abonnement.statut == 'EN_ATTENTE' else -1)
+
+
+def reconstruire_statistiques(Abonnement=Abonnement, StatistiquePaiement=StatistiquePaiement,
+                              AbonnementArchive=AbonnementArchive):
+    """
+    Recalcule tous les agregats depuis les abonnements et leurs archives (quelques GROUP BY).
+    Les transitions passees sont datees par date_creation, date_debut (activation)
+    ou date_modification (echec, annulation, expiration).
+    Retourne le nombre de lignes d'agregat.
+    """
+    recommande_par = Coalesce('user__profile__recommande_par', Value('aucun'))
+    agregats = defaultdict(lambda: defaultdict(int))
+
+    def ajouter(queryset, date, operateur, compteurs):
+        lignes = (
+            queryset.order_by()
+            .values('niveau_id', jour=TruncDate(date), op=operateur, ref=recommande_par)
+            .annotate(**compteurs)
+        )
+        for ligne in lignes:
+            cle = (ligne.pop('jour'), (ligne.pop('op') or '')[:20], ligne.pop('niveau_id'), ligne.pop('ref'))
+            for champ, valeur in ligne.items():
+                agregats[cle][champ] += valeur or 0
+
+    for modele in (Abonnement, AbonnementArchive):
+        if modele is None:
+            continue
+        ajouter(modele.objects.all(), 'date_creation', Value(''), {'nb_crees': Count('id')})
+        # Activation passee par l'admin (statut modifie directement) : pas de date_debut
+        ajouter(
+            modele.objects.filter(Q(date_debut__isnull=False) | Q(statut__in=['ACTIF', 'EXPIRE'])),
+            Coalesce('date_debut', 'date_modification'), F('methode_paiement'),
+            {'nb_actives': Count('id'), 'montant_total': Sum('montant_paye')}
+        )
+        ajouter(
+            modele.objects.filter(statut__in=['ECHOUE', 'ANNULE', 'EXPIRE']), 'date_modification',
+            F('methode_paiement'),
+            {
+                'nb_echoues': Count('id', filter=Q(statut='ECHOUE')),
+                'nb_annules': Count('id', filter=Q(statut='ANNULE')),
+                'nb_expires': Count('id', filter=Q(statut='EXPIRE')),
+            }
+        )
+
+    with transaction.atomic():
+        StatistiquePaiement.objects.all().delete()
+        StatistiquePaiement.objects.bulk_create([
+            StatistiquePaiement(jour=jour, operateur=operateur, niveau_id=niveau_id,
+                                recommande_par=ref, **compteurs)
+            for (jour, operateur, niveau_id, ref), compteurs in agregats.items()
+        ], batch_size=1000)
+    return len(agregats)
+
+
+def resume_statistiques(jours=30):
+    """Totaux des `jours` derniers jours, par jour, operateur, niveau et recommandation (table d'agregats)"""
+    debut = timezone.localdate() - timedelta(days=jours - 1)
+    queryset = StatistiquePaiement.objects.filter(jour__gte=debut).order_by()
+    sommes = {
+        'crees': Sum('nb_crees'),
+        'actives': Sum('nb_actives'),
+        'echoues': Sum('nb_echoues'),
+        'montant': Sum('montant_total'),
+    }
+    return {
+        'jours': jours,
+        'totaux': queryset.aggregate(**sommes),
+        'par_jour': list(queryset.values('jour').annotate(**sommes).order_by('-jour')),
+        'par_operateur': list(
+            queryset.exclude(operateur='').values('operateur').annotate(**sommes).order_by('-montant')
+        ),
+        'par_niveau': list(
+            queryset.values('niveau__nom').annotate(**sommes).order_by('-montant', 'niveau__nom')
+        ),
+        'par_recommandation': list(
+            queryset.values('recommande_par').annotate(**sommes).order_by('-montant', 'recommande_par')
+        ),
+    }
+
+
+def reconstruire_recommandations(UserProfile=UserProfile, Abonnement=Abonnement,
+                                 StatistiqueRecommandation=StatistiqueRecommandation):
+    """
+    Recalcule les compteurs par code de recommandation : inscriptions (date d'inscription
+    de l'utilisateur) et abonnements encore en attente (jour de creation).
+    Retourne le nombre de lignes.
+    """
+    compteurs = defaultdict(lambda: defaultdict(int))
+    inscriptions = (
+        UserProfile.objects.order_by()
+        .values('recommande_par', jour=TruncDate('user__date_joined'))
+        .annotate(nombre=Count('id'))
+    )
+    for ligne in inscriptions:
+        compteurs[(ligne['jour'], ligne['recommande_par'] or 'aucun')]['nb_inscrits'] += ligne['nombre']
+    en_attente = (
+        Abonnement.objects.filter(statut='EN_ATTENTE').order_by()
+        .values(jour=TruncDate('date_creation'),
+                ref=Coalesce('user__profile__recommande_par', Value('aucun')))
+        .annotate(nombre=Count('id'))
+    )
+    for ligne in en_attente:
+        compteurs[(ligne['jour'], ligne['ref'])]['nb_en_attente'] += ligne['nombre']
+
+    with transaction.atomic():
+        StatistiqueRecommandation.objects.all().delete()
+        StatistiqueRecommandation.objects.bulk_create([
+            StatistiqueRecommandation(jour=jour, recommande_par=ref, **valeurs)
+            for (jour, ref), valeurs in compteurs.items()
+        ], batch_size=1000)
+    return len(compteurs)
+
+
+# Periodes du classement des recommandations
+PERIODES = ('jour', 'semaine', 'saison')
+# Premier mois de la saison (annee scolaire : septembre a fin aout, cf. activer_abonnement)
+MOIS_DEBUT_SAISON = 9
+
+
+def debut_periode(periode, aujourd_hui=None):
+    """Premier jour de la periode contenant aujourd'hui : jour, semaine (lundi) ou saison"""
+    aujourd_hui = aujourd_hui or timezone.localdate()
+    if periode == 'semaine':
+        return aujourd_hui - timedelta(days=aujourd_hui.weekday())
+    if periode == 'saison':
+        annee = aujourd_hui.year if aujourd_hui.month >= MOIS_DEBUT_SAISON else aujourd_hui.year - 1
+        return date(annee, MOIS_DEBUT_SAISON, 1)
+    return aujourd_hui
+
+
+def classement_recommandations(periode='jour'):
+    """
+    Inscriptions, abonnements en attente, paiements et revenus par code de recommandation
+    sur la periode, depuis les tables d'agregats (deux GROUP BY). Tries par revenu.
+    """
+    debut = debut_periode(periode)
+    libelles = dict(UserProfile.RECOMMANDATION_CHOICES)
+    lignes = {}
+
+    def ligne(code):
+        if code not in lignes:
+            lignes[code] = {'code': code, 'libelle': libelles.get(code, code),
+                            'inscrits': 0, 'en_attente': 0, 'payes': 0, 'montant': 0}
+        return lignes[code]
+
+    # Tous les codes figurent au classement, meme sans activite sur la periode
+    for code in libelles:
+        ligne(code)
+
+    recommandations = (
+        StatistiqueRecommandation.objects.filter(jour__gte=debut).order_by()
+        .values('recommande_par')
+        .annotate(inscrits=Sum('nb_inscrits'), en_attente=Sum('nb_en_attente'))
+    )
+    for r in recommandations:
+        ligne(r['recommande_par']).update(inscrits=r['inscrits'] or 0, en_attente=r['en_attente'] or 0)
+    paiements = (
+        StatistiquePaiement.objects.filter(jour__gte=debut).order_by()
+        .values('recommande_par')
+        .annotate(payes=Sum('nb_actives'), montant=Sum('montant_total'))
+    )
+    for p in paiements:
+        ligne(p['recommande_par']).update(payes=p['payes'] or 0, montant=p['montant'] or 0)
+
+    return {
+        'periode': periode,
+        'debut': debut,
+        'classement': sorted(lignes.values(), key=lambda l: (-l['montant'], -l['payes'], -l['inscrits'], l['code'])),
+    }
@@ -0,0 +1,80 @@
+"""
+Stockage des fichiers pedagogiques par contenu : chaque upload est ecrit sous blobs/ au nom de
+son SHA-256, calcule pendant l'ecriture. Un contenu deja present n'est pas recopie, les Fichier
+partagent le meme blob (references comptees dans Blob, voir signals.py). Les blobs ne sont
+jamais supprimes par le stockage : manage.py gc_media supprime ceux qui ne sont plus references.
+"""
+import hashlib
+import os
+import re
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+
+
+DOSSIER_BLOBS = 'blobs'
+DOSSIER_TEMPORAIRE = f'{DOSSIER_BLOBS}/tmp'
+NOM_BLOB = re.compile(rf'^{DOSSIER_BLOBS}/[0-9a-f]{{2}}/[0-9a-f]{{2}}/(?P<empreinte>[0-9a-f]{{64}})(\.[\w.]+)?$')
+
+
+def nom_blob(empreinte, extension=''):
+    return f"{DOSSIER_BLOBS}/{empreinte[:2]}/{empreinte[2:4]}/{empreinte}{extension.lower()}"
+
+
+def empreinte_du_nom(nom):
+    """SHA-256 d'un nom de blob, None pour les autres noms (fichiers anterieurs au stockage par contenu)"""
+    correspondance = NOM_BLOB.match(nom or '')
+    return correspondance.group('empreinte') if correspondance else None
+
+
+class StockageDedoublonne(FileSystemStorage):
+    """FileSystemStorage dont les noms sont l'empreinte du contenu (le nom propose ne donne que l'extension)"""
+
+    def get_available_name(self, name, max_length=None):
+        # Le nom definitif depend du contenu : choisi par _save
+        return name
+
+    def _save(self, name, content):
+        temporaire = self.path(DOSSIER_TEMPORAIRE)
+        os.makedirs(temporaire, exist_ok=True)
+        descripteur, chemin_temporaire = tempfile.mkstemp(dir=temporaire)
+        try:
+            empreinte = hashlib.sha256()
+            with os.fdopen(descripteur, 'wb') as sortie:
+                for bloc in content.chunks():
+                    if isinstance(bloc, str):
+                        bloc = bloc.encode()
+                    empreinte.update(bloc)
+                    sortie.write(bloc)
+
+            nom = nom_blob(empreinte.hexdigest(), os.path.splitext(name)[1])
+            chemin = self.path(nom)
+            if os.path.exists(chemin):
+                # Deja stocke : date rafraichie pour que gc_media ne le supprime pas avant
+                # que le Fichier qui le reference soit enregistre
+                os.utime(chemin)
+            else:
+                os.makedirs(os.path.dirname(chemin), exist_ok=True)
+                if self.file_permissions_mode is not None:
+                    os.chmod(chemin_temporaire, self.file_permissions_mode)
+                else:
+                    # mkstemp cree en 0600 : droits habituels d'un upload
+                    masque = os.umask(0)
+                    os.umask(masque)
+                    os.chmod(chemin_temporaire, 0o666 & ~masque)
+                # Renommage atomique : deux uploads simultanes du meme contenu ecrivent le meme blob
+                os.replace(chemin_temporaire, chemin)
+        finally:
+            if os.path.exists(chemin_temporaire):
+                os.remove(chemin_temporaire)
+        return nom
+
+    def delete(self, name):
+        if empreinte_du_nom(name):
+            # Peut etre partage par d'autres Fichier : suppression par gc_media
+            return
+        super().delete(name)
+
+
+def stockage_fichiers():
+    return StockageDedoublonne()
@@ -0,0 +1,85 @@
+"""
+Ecritures differees par processus (compteurs de telechargements, derniers acces des appareils) :
+valeurs accumulees en memoire puis ecrites par lots par un timer, au plus tard `intervalle`
+secondes apres la premiere valeur, et a la sortie du processus
+"""
+import atexit
+import logging
+import operator
+import os
+import threading
+
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class TamponEcritures:
+    """
+    Valeurs par cle, fusionnees en memoire (`fusionner` : somme pour un compteur, max pour une
+    date) et passees par lots a `ecrire(valeurs)`. En cas d'echec, les valeurs sont remises en
+    memoire pour le vidage suivant. Une perte (SIGKILL, OOM) est limitee a `intervalle` secondes.
+    """
+
+    def __init__(self, nom, ecrire, intervalle, fusionner=operator.add):
+        self.nom = nom
+        self.ecrire = ecrire
+        self.intervalle = intervalle
+        self.fusionner = fusionner
+        self._valeurs = {}
+        self._verrou = threading.Lock()
+        self._timer = None
+        self._pid = os.getpid()
+        atexit.register(self._vider_a_la_sortie)
+
+    def _ajouter(self, valeurs):
+        # Appele verrou pris
+        if self._pid != os.getpid():
+            # Processus fork (workers gunicorn) : ni les valeurs ni le timer du parent
+            self._valeurs, self._timer, self._pid = {}, None, os.getpid()
+        for cle, valeur in valeurs.items():
+            self._valeurs[cle] = self.fusionner(self._valeurs[cle], valeur) if cle in self._valeurs else valeur
+        if self._timer is None:
+            self._timer = threading.Timer(self.intervalle, self._vider_par_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def ajouter(self, cle, valeur):
+        with self._verrou:
+            self._ajouter({cle: valeur})
+
+    def valeur(self, cle, defaut=None):
+        """Valeur memorisee par ce processus et pas encore ecrite"""
+        return self._valeurs.get(cle, defaut)
+
+    def vider(self):
+        """Ecrit les valeurs memorisees ; retourne le dict ecrit"""
+        with self._verrou:
+            valeurs, self._valeurs = self._valeurs, {}
+        if not valeurs:
+            return {}
+        try:
+            self.ecrire(valeurs)
+        except Exception:
+            # Base indisponible : valeurs remises en memoire, nouveau vidage programme
+            with self._verrou:
+                self._ajouter(valeurs)
+            raise
+        return valeurs
+
+    def _vider_par_timer(self):
+        with self._verrou:
+            self._timer = None
+        try:
+            self.vider()
+        except Exception as e:
+            logger.warning(f"Ecriture differee {self.nom} reportee: {e}")
+        finally:
+            # Connexion ouverte par ce thread : fermee, un timer ne la reutilise pas
+            connections.close_all()
+
+    def _vider_a_la_sortie(self):
+        try:
+            self.vider()
+        except Exception:
+            pass
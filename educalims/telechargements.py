@@ -0,0 +1,49 @@
+"""
+Compteur de telechargements des fichiers : increments accumules en memoire par processus et
+ecrits par lots (UPDATE ... SET telechargements = telechargements + delta), ou directement
+en mode exact. Jamais de save() : ni course lecture-ecriture, ni date_modification modifiee.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from .models import Fichier
+from .tampons import TamponEcritures
+
+# 'tampon' : ecriture differee par lots ; 'exact' : un UPDATE atomique par telechargement
+TELECHARGEMENTS_MODE = getattr(settings, 'TELECHARGEMENTS_MODE', 'tampon')
+# Delai maximal d'ecriture des increments memorises (secondes)
+TELECHARGEMENTS_INTERVALLE = getattr(settings, 'TELECHARGEMENTS_INTERVALLE', 30)
+
+
+def _ecrire_increments(increments):
+    """Un UPDATE par valeur d'increment distincte"""
+    par_delta = defaultdict(list)
+    for fichier_id, delta in increments.items():
+        par_delta[delta].append(fichier_id)
+    with transaction.atomic():
+        for delta, fichier_ids in par_delta.items():
+            Fichier.objects.filter(pk__in=fichier_ids).update(telechargements=F('telechargements') + delta)
+
+
+_increments = TamponEcritures('telechargements', _ecrire_increments, TELECHARGEMENTS_INTERVALLE)
+
+
+def compter_telechargement(fichier_id):
+    """Un telechargement de plus pour le fichier"""
+    if TELECHARGEMENTS_MODE == 'exact':
+        Fichier.objects.filter(pk=fichier_id).update(telechargements=F('telechargements') + 1)
+        return
+    _increments.ajouter(fichier_id, 1)
+
+
+def en_attente(fichier_id):
+    """Telechargements memorises par ce processus et pas encore ecrits"""
+    return _increments.valeur(fichier_id, 0)
+
+
+def vider_telechargements():
+    """Ecrit les increments memorises ; retourne le nombre de telechargements ecrits"""
+    return sum(_increments.vider().values())
@@ -0,0 +1,301 @@
+"""Notifications Telegram : mise en file (outbox) par les vues, envoi par manage.py run_notifier"""
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import NotificationTelegram, WebhookLog
+
+logger = logging.getLogger(__name__)
+
+# Backoff exponentiel : 30s, 1min, 2min... plafonne a 1h
+BACKOFF_INITIAL = 30
+BACKOFF_MAX = 60 * 60
+# Lot reserve par un worker : ignore des autres workers pendant l'envoi (20 messages ~ 1 min au
+# debit d'un groupe). Un worker arrete en cours d'envoi rend ses notifications a l'expiration.
+BAIL_ENVOI = 10 * 60
+
+
+class TelegramError(Exception):
+    """Echec d'envoi d'un message a l'API Telegram"""
+
+
+class TelegramRateLimit(TelegramError):
+    """L'API Telegram demande d'attendre `retry_after` secondes (HTTP 429)"""
+
+    def __init__(self, retry_after, message=''):
+        super().__init__(message or f"429: retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+# ==================== DEBIT ET CONNEXION ====================
+
+class LimiteurDebit:
+    """Seau a jetons : `capacite` envois immediats, puis `debit` envois par seconde"""
+
+    def __init__(self, debit, capacite):
+        self.debit = debit
+        self.capacite = capacite
+        self.jetons = capacite
+        self.dernier = time.monotonic()
+        self.suspendu_jusqu_a = 0.0
+        self._verrou = threading.Lock()
+
+    def _recharger(self, maintenant):
+        self.jetons = min(self.capacite, self.jetons + (maintenant - self.dernier) * self.debit)
+        self.dernier = maintenant
+
+    def attendre(self):
+        """Bloque jusqu'a ce qu'un jeton soit disponible, puis le consomme"""
+        with self._verrou:
+            while True:
+                maintenant = time.monotonic()
+                if maintenant < self.suspendu_jusqu_a:
+                    time.sleep(self.suspendu_jusqu_a - maintenant)
+                    continue
+                self._recharger(maintenant)
+                if self.jetons >= 1:
+                    self.jetons -= 1
+                    return
+                time.sleep((1 - self.jetons) / self.debit)
+
+    def suspendre(self, secondes):
+        """Aucun envoi pendant `secondes` (retry_after renvoye par Telegram)"""
+        self.suspendu_jusqu_a = max(self.suspendu_jusqu_a, time.monotonic() + secondes)
+        self.jetons = 0
+
+
+# Limites Telegram : ~30 messages/s pour le bot, 20 messages/min dans un groupe
+limiteur_global = LimiteurDebit(debit=settings.TELEGRAM_DEBIT_PAR_SECONDE, capacite=settings.TELEGRAM_DEBIT_PAR_SECONDE)
+limiteur_chat = LimiteurDebit(debit=settings.TELEGRAM_DEBIT_CHAT_PAR_MINUTE / 60, capacite=settings.TELEGRAM_DEBIT_CHAT_PAR_MINUTE)
+
+_session = None
+_session_pid = None
+
+
+def get_session():
+    """Session HTTP keep-alive unique par processus (recreee apres un fork)"""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session = requests.Session()
+        _session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        _session_pid = os.getpid()
+    return _session
+
+
+# ==================== MISE EN FILE ====================
+
+def _montant(valeur):
+    try:
+        return int(float(valeur))
+    except (TypeError, ValueError):
+        return None
+
+
+def envoyer_notification_telegram(message, webhook_log=None, categorie='', operateur='', montant=None):
+    """
+    Met une notification Telegram en file d'attente (aucun appel reseau dans la requete).
+    `categorie`, `operateur` et `montant` permettent de la regrouper en mode resume.
+    """
+    return NotificationTelegram.objects.create(
+        message=message,
+        webhook_log=webhook_log,
+        categorie=categorie,
+        operateur=(operateur or '')[:50],
+        montant=_montant(montant),
+    )
+
+
+# ==================== ENVOI ====================
+
+def envoyer_message(message):
+    """Envoie immediatement un message a Telegram (debit limite) ; leve TelegramError en cas d'echec"""
+    limiteur_global.attendre()
+    limiteur_chat.attendre()
+
+    url = f"{settings.TELEGRAM_API_URL}/bot{settings.TELEGRAM_BOT_TOKEN}/sendMessage"
+    payload = {
+        "chat_id": settings.TELEGRAM_CHAT_ID,
+        "text": message,
+        "parse_mode": "HTML"
+    }
+    try:
+        response = get_session().post(url, data=payload, timeout=10)
+        result = response.json()
+    except (requests.RequestException, ValueError) as e:
+        raise TelegramError(str(e)) from e
+
+    if not result.get("ok"):
+        retry_after = (result.get("parameters") or {}).get("retry_after")
+        if response.status_code == 429 and retry_after:
+            limiteur_global.suspendre(retry_after)
+            limiteur_chat.suspendre(retry_after)
+            raise TelegramRateLimit(retry_after, result.get('description', ''))
+        raise TelegramError(f"{response.status_code}: {result.get('description', result)}")
+
+
+def _delai_backoff(tentatives):
+    return timedelta(seconds=min(BACKOFF_INITIAL * 2 ** (tentatives - 1), BACKOFF_MAX))
+
+
+def _mettre_a_jour_webhook_logs(webhook_log_ids):
+    """telegram_notification_sent reflete l'envoi effectif de toutes les notifications du webhook"""
+    for webhook_log_id in webhook_log_ids:
+        toutes_envoyees = not NotificationTelegram.objects.filter(
+            webhook_log_id=webhook_log_id
+        ).exclude(statut='ENVOYEE').exists()
+        WebhookLog.objects.filter(pk=webhook_log_id).update(telegram_notification_sent=toutes_envoyees)
+
+
+def _reserver(notifications):
+    """A appeler dans la transaction du SELECT ... FOR UPDATE SKIP LOCKED, l'envoi se fait apres le commit"""
+    NotificationTelegram.objects.filter(pk__in=[n.pk for n in notifications]).update(
+        prochaine_tentative=timezone.now() + timedelta(seconds=BAIL_ENVOI)
+    )
+
+
+def _envoyer_lot(notifications, message):
+    """
+    Envoie `message` pour le compte des `notifications` (une seule, ou un resume)
+    et enregistre le resultat sur chacune. Retourne False si Telegram demande d'attendre.
+    """
+    maintenant = timezone.now()
+    limite_atteinte = False
+    try:
+        envoyer_message(message)
+    except TelegramRateLimit as e:
+        # Pas une tentative ratee : on replanifie sans consommer d'essai
+        logger.warning(f"Telegram limite le debit, pause de {e.retry_after}s")
+        for notification in notifications:
+            notification.prochaine_tentative = maintenant + timedelta(seconds=e.retry_after)
+            notification.derniere_erreur = str(e)
+        limite_atteinte = True
+    except TelegramError as e:
+        for notification in notifications:
+            notification.tentatives += 1
+            notification.derniere_erreur = str(e)
+            if notification.tentatives >= settings.TELEGRAM_MAX_TENTATIVES:
+                notification.statut = 'ECHEC'
+                logger.error(f"Notification {notification.pk} abandonnee apres {notification.tentatives} tentatives: {e}")
+            else:
+                notification.prochaine_tentative = maintenant + _delai_backoff(notification.tentatives)
+                logger.warning(f"Notification {notification.pk} en echec (tentative {notification.tentatives}): {e}")
+    else:
+        for notification in notifications:
+            notification.tentatives += 1
+            notification.statut = 'ENVOYEE'
+            notification.date_envoi = maintenant
+            notification.derniere_erreur = ''
+
+    NotificationTelegram.objects.bulk_update(
+        notifications, ['statut', 'tentatives', 'prochaine_tentative', 'derniere_erreur', 'date_envoi']
+    )
+    _mettre_a_jour_webhook_logs({n.webhook_log_id for n in notifications if n.webhook_log_id})
+    return not limite_atteinte
+
+
+# ==================== MODE RESUME ====================
+
+LIBELLES_RESUME = [
+    ('NOUVEL_ABONNEMENT', '🆕', 'Nouveaux abonnements'),
+    ('WEBHOOK_RECU', '🔔', 'Webhooks reçus'),
+    ('PAIEMENT_SUCCES', '✅', 'Paiements réussis'),
+    ('PAIEMENT_ECHEC', '❌', 'Paiements échoués'),
+    ('PAIEMENT_NON_TROUVE', '⚠️', 'Paiements sans abonnement'),
+]
+
+
+def construire_resume(notifications):
+    """Message unique resumant des notifications : nombre par categorie, totaux par operateur"""
+    debut = min(n.date_creation for n in notifications)
+    fin = max(n.date_creation for n in notifications)
+    par_categorie = Counter(n.categorie for n in notifications)
+    montants = defaultdict(int)
+    for n in notifications:
+        montants[n.categorie] += n.montant or 0
+
+    lignes = [
+        f"📊 <b>Résumé des notifications</b> "
+        f"({timezone.localtime(debut):%H:%M} → {timezone.localtime(fin):%H:%M})",
+        "",
+    ]
+    for categorie, emoji, libelle in LIBELLES_RESUME:
+        if par_categorie[categorie]:
+            ligne = f"{emoji} <b>{libelle}:</b> {par_categorie[categorie]}"
+            if categorie in ('PAIEMENT_SUCCES', 'PAIEMENT_NON_TROUVE') and montants[categorie]:
+                ligne += f" — {montants[categorie]} FCFA"
+            lignes.append(ligne)
+
+    par_operateur = defaultdict(lambda: {'succes': 0, 'echecs': 0, 'total': 0})
+    for n in notifications:
+        if n.categorie == 'PAIEMENT_SUCCES':
+            par_operateur[n.operateur or 'N/A']['succes'] += 1
+            par_operateur[n.operateur or 'N/A']['total'] += n.montant or 0
+        elif n.categorie == 'PAIEMENT_ECHEC':
+            par_operateur[n.operateur or 'N/A']['echecs'] += 1
+    if par_operateur:
+        lignes += ["", "💳 <b>Par opérateur:</b>"]
+        for operateur, stats in sorted(par_operateur.items()):
+            lignes.append(
+                f"• {operateur}: {stats['succes']} réussi(s), {stats['echecs']} échec(s) — {stats['total']} FCFA"
+            )
+    return "\n".join(lignes)
+
+
+def _traiter_resume(limite):
+    """
+    Envoie un resume des notifications categorisees des que la plus ancienne
+    a depasse la fenetre TELEGRAM_RESUME_FENETRE. Retourne le nombre de notifications resumees.
+    """
+    fenetre = timedelta(seconds=settings.TELEGRAM_RESUME_FENETRE)
+    maintenant = timezone.now()
+    with transaction.atomic():
+        lot = list(
+            NotificationTelegram.objects.select_for_update(skip_locked=True)
+            .filter(statut='EN_ATTENTE', prochaine_tentative__lte=maintenant)
+            .exclude(categorie='')
+            .order_by('date_creation')[:limite]
+        )
+        if not lot or lot[0].date_creation > maintenant - fenetre:
+            return 0
+        _reserver(lot)
+    _envoyer_lot(lot, construire_resume(lot))
+    return len(lot)
+
+
+# ==================== WORKER ====================
+
+def traiter_notifications(limite=20):
+    """
+    Envoie un lot de notifications en attente. Le lot est reserve dans une transaction
+    courte (SKIP LOCKED, voir BAIL_ENVOI) : plusieurs workers peuvent tourner en parallele et
+    aucun verrou n'est garde pendant les appels a Telegram.
+    En mode resume (TELEGRAM_RESUME_FENETRE > 0), les notifications categorisees
+    sont regroupees en un seul message par fenetre.
+    Retourne le nombre de notifications traitees.
+    """
+    traitees = 0
+    queryset = NotificationTelegram.objects.select_for_update(skip_locked=True).filter(
+        statut='EN_ATTENTE', prochaine_tentative__lte=timezone.now()
+    )
+    if settings.TELEGRAM_RESUME_FENETRE:
+        traitees += _traiter_resume(limite=500)
+        queryset = queryset.filter(categorie='')
+
+    with transaction.atomic():
+        lot = list(queryset.order_by('prochaine_tentative')[:limite])
+        _reserver(lot)
+    for position, notification in enumerate(lot, start=1):
+        traitees += 1
+        if not _envoyer_lot([notification], notification.message):
+            # Reste du lot rendu tout de suite (prochaine_tentative d'origine, toujours en memoire)
+            NotificationTelegram.objects.bulk_update(lot[position:], ['prochaine_tentative'])
+            break
+    return traitees
@@ -1,3 +1,850 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import json
+import random
+import shutil
+import tempfile
+import threading
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import StringIO
+from urllib.parse import parse_qs
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
+
+from . import compteurs, references, telechargements
+from .appareils import charger_appareils, enregistrer_appareil
+from .archivage import ARCHIVAGE_MOIS, archiver_lot
+from .expiration import ATTENTE_DUREE_MAX, annuler_attentes_lot
+from .middleware import DeviceIdMiddleware
+from .models import (
+    Abonnement, AbonnementArchive, Cycle, Discipline, Fichier, Niveau, NotificationTelegram, Produit, Unite,
+    UserDevice, UserProfile, WebhookLog,
+)
+from .rapprochement import (
+    FENETRE_RAPPROCHEMENT, METHODE_AMBIGU, METHODE_AUCUN, METHODE_REFERENCE, METHODE_TELEPHONE,
+    normaliser_telephone, rapprocher_paiement,
+)
+from .tampons import TamponEcritures
+from .telegram import BACKOFF_INITIAL, envoyer_notification_telegram, traiter_notifications
+from .webhooks import (
+    PROVIDER_CALLBACK, doublons_par_heure, enregistrer_webhook, traiter_webhook_immediat,
+    traiter_webhooks_en_attente,
+)
+
+
+MEDIA_ROOT_TESTS = tempfile.mkdtemp()
+CONTENU = bytes(range(256)) * 64
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT_TESTS)
+class TelechargementPlagesTests(TestCase):
+    """Telechargement servi par Django : Range, 206/416, plages multiples, ETag et If-Range"""
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT_TESTS, ignore_errors=True)
+
+    def setUp(self):
+        cycle = Cycle.objects.create(nom='Lycée')
+        discipline = Discipline.objects.create(nom='Maths')
+        self.niveau = Niveau.objects.create(nom='Terminale', cycle=cycle)
+        unite = Unite.objects.create(nom='Chapitre 1', niveau=self.niveau, discipline=discipline)
+        self.fichier = Fichier(nom='Sujet', unite=unite, type_fichier='VID')
+        self.fichier.fichier.save('cours.mp4', ContentFile(CONTENU), save=True)
+        self.addCleanup(self.fichier.fichier.delete, save=False)
+
+        produit = Produit.objects.create(nom='Annuel', prix=1000, date_expiration=date.today() + timedelta(days=365))
+        self.user = User.objects.create_user('eleve', password='secret')
+        Abonnement.objects.create(
+            user=self.user, niveau=self.niveau, produit=produit, statut='ACTIF',
+            date_debut=timezone.now(), date_fin=timezone.now() + timedelta(days=30),
+        )
+        self.client.force_login(self.user)
+        self.url = reverse('educalims:fichier_telecharger', args=[self.fichier.pk])
+
+    def telecharger(self, **entetes):
+        return self.client.get(self.url, headers=entetes)
+
+    def test_fichier_complet(self):
+        response = self.telecharger()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), CONTENU)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Type'], 'video/mp4')
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertIn('Last-Modified', response)
+        self.assertIn('private', response['Cache-Control'])
+
+    def test_lecture_partielle(self):
+        response = self.telecharger(Range='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(CONTENU)}')
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(b''.join(response.streaming_content), CONTENU[100:200])
+
+    def test_plages_ouverte_et_suffixe(self):
+        response = self.telecharger(Range=f'bytes={len(CONTENU) - 10}-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), CONTENU[-10:])
+
+        response = self.telecharger(Range='bytes=-25')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes {len(CONTENU) - 25}-{len(CONTENU) - 1}/{len(CONTENU)}')
+        self.assertEqual(b''.join(response.streaming_content), CONTENU[-25:])
+
+        # Fin au-dela du fichier : tronquee a la taille
+        response = self.telecharger(Range=f'bytes=0-{len(CONTENU) * 2}')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), CONTENU)
+
+    def test_plage_hors_fichier(self):
+        response = self.telecharger(Range=f'bytes={len(CONTENU)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(CONTENU)}')
+
+    def test_plage_invalide_ignoree(self):
+        for entete in ('bytes=20-10', 'octets=0-10', 'bytes=abc'):
+            with self.subTest(entete=entete):
+                response = self.telecharger(Range=entete)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(b''.join(response.streaming_content), CONTENU)
+
+    def test_plages_multiples(self):
+        response = self.telecharger(Range='bytes=0-9,1000-1019,-5')
+        self.assertEqual(response.status_code, 206)
+        type_contenu, _, frontiere = response['Content-Type'].partition('; boundary=')
+        self.assertEqual(type_contenu, 'multipart/byteranges')
+        corps = b''.join(response.streaming_content)
+        self.assertEqual(int(response['Content-Length']), len(corps))
+        self.assertTrue(corps.endswith(f'--{frontiere}--\r\n'.encode()))
+
+        parties = corps.split(f'--{frontiere}'.encode())[1:-1]
+        attendues = [(0, 9), (1000, 1019), (len(CONTENU) - 5, len(CONTENU) - 1)]
+        self.assertEqual(len(parties), len(attendues))
+        for partie, (debut, fin) in zip(parties, attendues):
+            entetes, _, donnees = partie.partition(b'\r\n\r\n')
+            self.assertIn(f'Content-Range: bytes {debut}-{fin}/{len(CONTENU)}'.encode(), entetes)
+            self.assertIn(b'Content-Type: video/mp4', entetes)
+            self.assertEqual(donnees, CONTENU[debut:fin + 1] + b'\r\n')
+
+    def test_reprise_apres_coupure(self):
+        premiere = self.telecharger()
+        etag = premiere['ETag']
+        # Connexion coupee apres les premiers blocs
+        recu = b''
+        for bloc in premiere.streaming_content:
+            recu += bloc
+            if len(recu) >= 5000:
+                break
+        premiere.close()
+
+        reprise = self.telecharger(Range=f'bytes={len(recu)}-', If_Range=etag)
+        self.assertEqual(reprise.status_code, 206)
+        self.assertEqual(reprise['ETag'], etag)
+        self.assertEqual(recu + b''.join(reprise.streaming_content), CONTENU)
+
+    def test_reprise_avec_date(self):
+        derniere_modification = self.telecharger()['Last-Modified']
+        response = self.telecharger(Range='bytes=10-', If_Range=derniere_modification)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), CONTENU[10:])
+
+    def test_reprise_fichier_modifie(self):
+        etag = self.telecharger()['ETag']
+        nouveau = CONTENU[::-1] + b'version 2'
+        # Stockage par contenu : une nouvelle version est un nouvel upload (nouveau blob)
+        self.fichier.fichier.save('cours.mp4', ContentFile(nouveau), save=True)
+
+        # Le fichier a change : If-Range ne correspond plus, le fichier complet est renvoye
+        response = self.telecharger(Range='bytes=5000-', If_Range=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(b''.join(response.streaming_content), nouveau)
+
+        response = self.telecharger(Range='bytes=5000-', If_Range=http_date(0))
+        self.assertEqual(response.status_code, 200)
+
+    def test_validation_conditionnelle(self):
+        etag = self.telecharger()['ETag']
+        response = self.telecharger(If_None_Match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_acces_sans_abonnement(self):
+        autre = User.objects.create_user('visiteur', password='secret')
+        self.client.force_login(autre)
+        response = self.telecharger(Range='bytes=0-9')
+        self.assertRedirects(response, reverse('educalims:niveau_detail', args=[self.niveau.pk]),
+                             fetch_redirect_response=False)
+
+
+class CompteursTests(TestCase):
+    """Compteurs denormalises maintenus par les signaux (compteurs.py)"""
+
+    def setUp(self):
+        self.cycle = Cycle.objects.create(nom='Collège')
+        self.discipline = Discipline.objects.create(nom='Physique')
+        self.discipline.cycles.add(self.cycle)
+        self.niveau = Niveau.objects.create(nom='3ème', cycle=self.cycle)
+        self.partie = Unite.objects.create(nom='Partie 1', niveau=self.niveau, discipline=self.discipline,
+                                           type_unite='P')
+        self.chapitre = Unite.objects.create(nom='Chapitre 1', niveau=self.niveau, discipline=self.discipline,
+                                             unite_parent=self.partie)
+
+    def ajouter_fichier(self, unite, **champs):
+        return Fichier.objects.create(nom='Cours', unite=unite, type_fichier='TXT', contenu_texte='...', **champs)
+
+    def compteurs(self, objet, *champs):
+        objet.refresh_from_db()
+        return tuple(getattr(objet, champ) for champ in champs)
+
+    def test_creation_et_desactivation_de_fichiers(self):
+        fichier = self.ajouter_fichier(self.chapitre)
+        self.ajouter_fichier(self.chapitre, est_actif=False)
+        self.assertEqual(self.compteurs(self.chapitre, 'nb_fichiers_actifs'), (1,))
+        self.assertEqual(self.compteurs(self.niveau, 'nb_chapitres', 'nb_fichiers_actifs'), (1, 1))
+        self.assertEqual(self.compteurs(self.discipline, 'nb_chapitres', 'nb_fichiers_actifs'), (1, 1))
+        self.assertEqual(self.compteurs(self.cycle, 'nb_disciplines', 'nb_chapitres', 'nb_fichiers_actifs'),
+                         (1, 1, 1))
+
+        fichier.est_actif = False
+        fichier.save()
+        self.assertEqual(self.compteurs(self.chapitre, 'nb_fichiers_actifs'), (0,))
+        self.assertEqual(self.compteurs(self.cycle, 'nb_fichiers_actifs'), (0,))
+
+    def test_fichier_deplace_et_supprime(self):
+        autre = Unite.objects.create(nom='Chapitre 2', niveau=self.niveau, discipline=self.discipline,
+                                     unite_parent=self.partie)
+        fichier = self.ajouter_fichier(self.chapitre)
+        fichier.unite = autre
+        fichier.save()
+        self.assertEqual(self.compteurs(self.chapitre, 'nb_fichiers_actifs'), (0,))
+        self.assertEqual(self.compteurs(autre, 'nb_fichiers_actifs'), (1,))
+        self.assertEqual(self.compteurs(self.partie, 'nb_unites_enfants'), (2,))
+        self.assertEqual(self.compteurs(self.niveau, 'nb_chapitres', 'nb_fichiers_actifs'), (2, 1))
+
+        fichier.delete()
+        self.assertEqual(self.compteurs(autre, 'nb_fichiers_actifs'), (0,))
+        self.assertEqual(self.compteurs(self.niveau, 'nb_fichiers_actifs'), (0,))
+
+    def test_sauvegarde_d_une_instance_perimee(self):
+        # Instance chargee avant l'ajout du fichier : son save() ne remet pas les compteurs a 0
+        niveau = Niveau.objects.get(pk=self.niveau.pk)
+        cycle = Cycle.objects.get(pk=self.cycle.pk)
+        self.ajouter_fichier(self.chapitre)
+        niveau.nom = '3ème A'
+        niveau.save()
+        cycle.ordre = 2
+        cycle.save()
+        self.assertEqual(self.compteurs(self.niveau, 'nom', 'nb_fichiers_actifs'), ('3ème A', 1))
+        self.assertEqual(self.compteurs(self.cycle, 'ordre', 'nb_fichiers_actifs'), (2, 1))
+
+    def test_rafraichir_tout_apres_update(self):
+        self.ajouter_fichier(self.chapitre)
+        # update() ne declenche pas les signaux : reconcile_counters recalcule tout
+        Fichier.objects.update(est_actif=False)
+        self.assertEqual(self.compteurs(self.niveau, 'nb_fichiers_actifs'), (1,))
+        compteurs.rafraichir_tout()
+        self.assertEqual(self.compteurs(self.niveau, 'nb_fichiers_actifs'), (0,))
+        self.assertEqual(self.compteurs(self.chapitre, 'nb_fichiers_actifs'), (0,))
+
+
+class CheminUnitesTests(TestCase):
+    """Chemin materialise des unites (chemin, profondeur) et requetes qui l'utilisent"""
+
+    def setUp(self):
+        cycle = Cycle.objects.create(nom='Lycée')
+        self.niveau = Niveau.objects.create(nom='Seconde', cycle=cycle)
+        self.discipline = Discipline.objects.create(nom='SVT')
+        self.theme = self.creer('Thème', type_unite='T')
+        self.partie = self.creer('Partie', unite_parent=self.theme, type_unite='P')
+        self.chapitre = self.creer('Chapitre', unite_parent=self.partie)
+
+    def creer(self, nom, **champs):
+        return Unite.objects.create(nom=nom, niveau=self.niveau, discipline=self.discipline, **champs)
+
+    def test_chemin_a_la_creation(self):
+        self.assertEqual(self.theme.chemin, f'{self.theme.pk}/')
+        self.assertEqual(self.chapitre.chemin, f'{self.theme.pk}/{self.partie.pk}/{self.chapitre.pk}/')
+        self.assertEqual((self.theme.profondeur, self.partie.profondeur, self.chapitre.profondeur), (0, 1, 2))
+        self.assertEqual(self.chapitre.ancetres_ids(), [self.theme.pk, self.partie.pk])
+        self.assertEqual(list(self.chapitre.ancetres()), [self.theme, self.partie])
+        self.assertCountEqual(self.theme.descendants(), [self.partie, self.chapitre])
+
+    def test_deplacement_du_sous_arbre(self):
+        autre_theme = self.creer('Autre thème', type_unite='T')
+        self.partie.unite_parent = autre_theme
+        self.partie.save()
+
+        self.chapitre.refresh_from_db()
+        self.assertEqual(self.chapitre.chemin, f'{autre_theme.pk}/{self.partie.pk}/{self.chapitre.pk}/')
+        self.assertEqual(self.chapitre.profondeur, 2)
+        self.assertEqual(list(self.theme.descendants()), [])
+
+        # Partie remontee a la racine : profondeur des descendants diminuee
+        self.partie.unite_parent = None
+        self.partie.save()
+        self.chapitre.refresh_from_db()
+        self.assertEqual(self.chapitre.chemin, f'{self.partie.pk}/{self.chapitre.pk}/')
+        self.assertEqual(self.chapitre.profondeur, 1)
+
+    def test_chemin_perime_en_memoire(self):
+        # Instance chargee avant le deplacement de son parent : save() garde le chemin en base
+        chapitre = Unite.objects.get(pk=self.chapitre.pk)
+        self.partie.unite_parent = None
+        self.partie.save()
+        chapitre.nom = 'Chapitre renommé'
+        chapitre.save()
+        chapitre.refresh_from_db()
+        self.assertEqual(chapitre.chemin, f'{self.partie.pk}/{self.chapitre.pk}/')
+
+    def test_cycle_refuse(self):
+        self.theme.unite_parent = self.chapitre
+        with self.assertRaises(ValidationError):
+            self.theme.clean()
+        with self.assertRaises(ValueError):
+            self.theme.save()
+
+    def test_libelle_sans_requete(self):
+        chapitre = Unite.objects.select_related('unite_parent').get(pk=self.chapitre.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(str(chapitre), '[Chapitre] Partie > Chapitre')
+        chapitre = Unite.objects.get(pk=self.chapitre.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(str(chapitre), '[Chapitre] Chapitre')
+
+
+class WebhookIdempotenceTests(TestCase):
+    """Livraisons repetees d'une meme transactionId Cyberschool : un seul traitement"""
+
+    def setUp(self):
+        cycle = Cycle.objects.create(nom='Lycée')
+        niveau = Niveau.objects.create(nom='Première', cycle=cycle)
+        produit = Produit.objects.create(nom='Annuel', prix=5000)
+        self.abonnement = Abonnement.objects.create(
+            user=User.objects.create_user('eleve', password='secret'), niveau=niveau, produit=produit,
+            merchant_reference_id='123456789',
+        )
+        self.url = reverse('educalims:webhook_cyberschool_simple')
+        self.payload = {
+            'merchantReferenceId': '123456789', 'code': 200, 'status': 'SUCCESS', 'amount': '5000',
+            'operator': 'AIRTEL', 'transactionId': 'TX-1',
+        }
+
+    def livrer(self, payload=None):
+        return self.client.post(self.url, payload or self.payload, content_type='application/json')
+
+    def test_livraison_rejouee(self):
+        premiere = self.livrer()
+        self.assertEqual(premiere.json()['status'], 'activated')
+        self.abonnement.refresh_from_db()
+        date_debut = self.abonnement.date_debut
+        notifications = NotificationTelegram.objects.count()
+        doublons = doublons_par_heure(1)[-1][1]
+
+        rejouee = self.livrer()
+        self.assertEqual(rejouee.status_code, premiere.status_code)
+        self.assertEqual(rejouee.json(), premiere.json())
+        self.assertEqual(WebhookLog.objects.count(), 1)
+        self.assertEqual(NotificationTelegram.objects.count(), notifications)
+        self.assertEqual(doublons_par_heure(1)[-1][1], doublons + 1)
+        self.abonnement.refresh_from_db()
+        self.assertEqual(self.abonnement.date_debut, date_debut)
+
+    def test_transaction_distincte_traitee(self):
+        self.livrer()
+        autre = self.livrer(dict(self.payload, transactionId='TX-2'))
+        self.assertEqual(autre.json()['status'], 'activated')
+        self.assertEqual(autre.json()['message'], 'Abonnement déjà actif')
+        self.assertEqual(WebhookLog.objects.count(), 2)
+
+    def test_meme_transaction_par_le_callback(self):
+        # Une transactionId est unique par fournisseur : le callback a son propre journal
+        self.livrer()
+        webhook_log, cree = enregistrer_webhook(self.payload, provider=PROVIDER_CALLBACK)
+        self.assertTrue(cree)
+        self.assertEqual(WebhookLog.objects.filter(transaction_id='TX-1').count(), 2)
+
+    @override_settings(WEBHOOK_TRAITEMENT_DIFFERE=True)
+    def test_rejeu_avant_traitement_differe(self):
+        self.assertEqual(self.livrer().json()['status'], 'received')
+        rejouee = self.livrer()
+        self.assertTrue(rejouee.json()['doublon'])
+
+        self.assertEqual(traiter_webhooks_en_attente(), 1)
+        self.assertEqual(traiter_webhooks_en_attente(), 0)
+        self.abonnement.refresh_from_db()
+        self.assertEqual(self.abonnement.statut, 'ACTIF')
+        # Livraison suivante : la reponse enregistree par le traitement est rejouee
+        self.assertEqual(self.livrer().json()['status'], 'activated')
+
+    def test_traitement_immediat_deja_reserve(self):
+        webhook_log, _ = enregistrer_webhook(self.payload)
+        traiter_webhooks_en_attente()
+        self.assertIsNone(traiter_webhook_immediat(webhook_log))
+        self.assertEqual(
+            NotificationTelegram.objects.filter(categorie='PAIEMENT_SUCCES').count(), 1
+        )
+
+
+class RapprochementTests(TestCase):
+    """Rapprochement d'un paiement : reference marchand, puis telephone et montant"""
+
+    def setUp(self):
+        cycle = Cycle.objects.create(nom='Collège')
+        self.niveau = Niveau.objects.create(nom='4ème', cycle=cycle)
+        self.produit = Produit.objects.create(nom='Annuel', prix=5000)
+
+    def creer_abonnement(self, username, telephone='077045354', niveau=None, **champs):
+        user = User.objects.filter(username=username).first() or User.objects.create_user(username)
+        UserProfile.objects.update_or_create(user=user, defaults={'telephone': telephone})
+        return Abonnement.objects.create(user=user, niveau=niveau or self.niveau, produit=self.produit, **champs)
+
+    def test_normaliser_telephone(self):
+        for numero in ('+241 77 04 53 54', '24177045354', '0024177045354', '077045354', '77-04-53-54'):
+            with self.subTest(numero=numero):
+                self.assertEqual(normaliser_telephone(numero), '77045354')
+        self.assertEqual(normaliser_telephone(None), '')
+
+    def test_par_reference(self):
+        abonnement = self.creer_abonnement('eleve', merchant_reference_id='123456789')
+        # La reference l'emporte sur le telephone d'un autre abonnement
+        self.creer_abonnement('autre', telephone='066112233')
+        resultat = rapprocher_paiement('123456789', '066112233', 5000)
+        self.assertEqual((resultat.methode, resultat.abonnement), (METHODE_REFERENCE, abonnement))
+
+    def test_par_telephone_et_montant(self):
+        abonnement = self.creer_abonnement('eleve')
+        resultat = rapprocher_paiement('reference-inconnue', '+241 77 04 53 54', '5000')
+        self.assertEqual((resultat.methode, resultat.abonnement), (METHODE_TELEPHONE, abonnement))
+
+        self.assertEqual(rapprocher_paiement(None, '077045354', 2500).methode, METHODE_AUCUN)
+        self.assertEqual(rapprocher_paiement(None, '066000000', 5000).methode, METHODE_AUCUN)
+
+    def test_hors_fenetre_ou_deja_actif(self):
+        abonnement = self.creer_abonnement('eleve')
+        Abonnement.objects.filter(pk=abonnement.pk).update(
+            date_creation=timezone.now() - timedelta(seconds=FENETRE_RAPPROCHEMENT + 60)
+        )
+        self.assertEqual(rapprocher_paiement(None, '077045354', 5000).methode, METHODE_AUCUN)
+
+        actif = self.creer_abonnement('eleve', statut='ACTIF')
+        self.assertEqual(rapprocher_paiement(None, '077045354', 5000).methode, METHODE_AUCUN)
+        # Par reference, un abonnement deja actif est retrouve (livraison tardive)
+        Abonnement.objects.filter(pk=actif.pk).update(merchant_reference_id='987654321')
+        self.assertEqual(rapprocher_paiement('987654321').abonnement, actif)
+
+    def test_tentatives_du_meme_utilisateur(self):
+        self.creer_abonnement('eleve')
+        recente = self.creer_abonnement('eleve')
+        Abonnement.objects.filter(pk=recente.pk).update(date_creation=timezone.now() + timedelta(seconds=1))
+        resultat = rapprocher_paiement(None, '077045354', 5000, timezone.now() + timedelta(seconds=2))
+        self.assertEqual((resultat.methode, resultat.abonnement), (METHODE_TELEPHONE, recente))
+
+    def test_ambigu(self):
+        # Deux comptes avec le meme telephone, ou le meme compte sur deux niveaux
+        premier = self.creer_abonnement('eleve')
+        second = self.creer_abonnement('frere')
+        troisieme = Niveau.objects.create(nom='3ème', cycle=self.niveau.cycle)
+        autre_niveau = self.creer_abonnement('eleve', niveau=troisieme)
+        resultat = rapprocher_paiement(None, '077045354', 5000)
+        self.assertTrue(resultat.ambigu)
+        self.assertIsNone(resultat.abonnement)
+        self.assertCountEqual(resultat.candidats, [premier, second, autre_niveau])
+
+    def test_webhook_ambigu_sans_activation(self):
+        self.creer_abonnement('eleve')
+        self.creer_abonnement('frere')
+        response = self.client.post(reverse('educalims:webhook_cyberschool_simple'), {
+            'code': 200, 'amount': '5000', 'numero_tel': '24177045354', 'transactionId': 'TX-9',
+        }, content_type='application/json')
+        self.assertEqual(response.json()['status'], 'ambiguous')
+        webhook_log = WebhookLog.objects.get(transaction_id='TX-9')
+        self.assertEqual(webhook_log.rapprochement, METHODE_AMBIGU)
+        self.assertEqual(len(webhook_log.candidats), 2)
+        self.assertFalse(Abonnement.objects.filter(statut='ACTIF').exists())
+
+
+@override_settings(MERCHANT_REFERENCE_CLE='cle-des-tests')
+class ReferencesTests(TestCase):
+    """Permutation des references marchand (references.py)"""
+
+    def inverser(self, reference):
+        """Permutation inverse : les tours de Feistel a l'envers, puis le meme cycle walking"""
+        cle = references._cle()
+        valeur = int(reference) - references.REFERENCE_MIN
+        while True:
+            gauche, droite = valeur >> references.DEMI, valeur & references.MASQUE
+            for tour in reversed(range(references.TOURS)):
+                empreinte = hmac.new(cle, f"{tour}:{gauche}".encode(), hashlib.sha256).digest()
+                gauche, droite = droite ^ (int.from_bytes(empreinte[:4], 'big') & references.MASQUE), gauche
+            valeur = (gauche << references.DEMI) | droite
+            if valeur < references.ESPACE:
+                return valeur
+
+    def test_references_de_neuf_chiffres(self):
+        echantillon = [0, 1, references.ESPACE - 1] + random.Random(0).sample(range(references.ESPACE), 2000)
+        for numero in echantillon:
+            reference = references.permuter(numero)
+            self.assertRegex(reference, r'^[1-9]\d{8}$')
+            self.assertEqual(self.inverser(reference), numero)
+
+    def test_unicite(self):
+        numeros = range(20000)
+        references_emises = [references.permuter(numero) for numero in numeros]
+        self.assertEqual(len(set(references_emises)), len(numeros))
+        # Non devinable : deux numeros consecutifs ne donnent pas deux references consecutives
+        self.assertNotEqual(int(references_emises[1]) - int(references_emises[0]), 1)
+
+    def test_hors_espace(self):
+        for numero in (-1, references.ESPACE):
+            with self.subTest(numero=numero):
+                with self.assertRaises(ValueError):
+                    references.permuter(numero)
+
+    def test_cle(self):
+        reference = references.permuter(42)
+        self.assertEqual(references.permuter(42), reference)
+        with override_settings(MERCHANT_REFERENCE_CLE='autre-cle'):
+            self.assertNotEqual(references.permuter(42), reference)
+
+    def test_reference_deja_portee(self):
+        cycle = Cycle.objects.create(nom='Lycée')
+        abonnement = Abonnement.objects.create(
+            user=User.objects.create_user('eleve'), niveau=Niveau.objects.create(nom='Seconde', cycle=cycle),
+            produit=Produit.objects.create(nom='Annuel', prix=5000), merchant_reference_id=references.permuter(7),
+        )
+        self.assertFalse(references.reference_libre(abonnement.merchant_reference_id))
+        self.assertTrue(references.reference_libre(references.permuter(8)))
+        self.assertNotEqual(references.allouer_reference(), abonnement.merchant_reference_id)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT_TESTS)
+class AppareilsTests(TestCase):
+    """Appareils autorises : 3 au plus (APPAREILS_MAX), remplacement du moins recemment utilise"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('eleve', password='secret')
+        # Droits et appareils mis en cache sous des identifiants reutilises par les tests suivants
+        self.addCleanup(cache.clear)
+
+    def actifs(self, user=None):
+        return set(charger_appareils((user or self.user).pk))
+
+    def utiliser(self, device_id, il_y_a):
+        UserDevice.objects.filter(device_id=device_id).update(dernier_acces=timezone.now() - timedelta(hours=il_y_a))
+
+    def test_remplacement_du_moins_recent(self):
+        for numero, il_y_a in ((1, 1), (2, 3), (3, 2)):
+            self.assertTrue(enregistrer_appareil(self.user, f'tel-{numero}'))
+            self.utiliser(f'tel-{numero}', il_y_a)
+        self.assertEqual(self.actifs(), {'tel-1', 'tel-2', 'tel-3'})
+
+        self.assertTrue(enregistrer_appareil(self.user, 'tel-4'))
+        self.assertEqual(self.actifs(), {'tel-1', 'tel-3', 'tel-4'})
+        self.assertIsNotNone(UserDevice.objects.get(device_id='tel-2').revoque_le)
+
+    def test_retour_sur_un_ancien_appareil(self):
+        for numero in range(1, 5):
+            enregistrer_appareil(self.user, f'tel-{numero}')
+            self.utiliser(f'tel-{numero}', 5 - numero)
+        self.assertNotIn('tel-1', self.actifs())
+
+        # Reconnexion sur tel-1 : reactive sans nouvelle ligne, tel-2 est mis de cote a son tour
+        self.assertTrue(enregistrer_appareil(self.user, 'tel-1'))
+        self.assertEqual(self.actifs(), {'tel-1', 'tel-3', 'tel-4'})
+        self.assertEqual(UserDevice.objects.filter(user=self.user).count(), 4)
+        # Appareil deja actif : rien ne change
+        self.assertTrue(enregistrer_appareil(self.user, 'tel-3'))
+        self.assertEqual(self.actifs(), {'tel-1', 'tel-3', 'tel-4'})
+
+    def test_revoque_par_admin_et_autre_compte(self):
+        enregistrer_appareil(self.user, 'tel-1')
+        UserDevice.objects.filter(device_id='tel-1').update(revoque_le=timezone.now(), revoque_par_admin=True)
+        self.assertFalse(enregistrer_appareil(self.user, 'tel-1'))
+        self.assertEqual(self.actifs(), set())
+
+        autre = User.objects.create_user('frere')
+        enregistrer_appareil(self.user, 'tel-2')
+        self.assertFalse(enregistrer_appareil(autre, 'tel-2'))
+        self.assertEqual(self.actifs(autre), set())
+        self.assertEqual(UserDevice.objects.get(device_id='tel-2').user, self.user)
+
+    def connecter(self, device_id):
+        self.client.logout()
+        self.client.cookies['device_token'] = DeviceIdMiddleware.create_device_token(device_id)
+        return self.client.post(reverse('educalims:login'), {'username': 'eleve', 'password': 'secret'})
+
+    def test_enregistrement_a_la_connexion(self):
+        cycle = Cycle.objects.create(nom='Lycée')
+        unite = Unite.objects.create(nom='Chapitre', niveau=Niveau.objects.create(nom='Seconde', cycle=cycle),
+                                     discipline=Discipline.objects.create(nom='Maths'))
+        url = reverse('educalims:fichier_detail', args=[
+            Fichier.objects.create(nom='Cours', unite=unite, type_fichier='TXT', contenu_texte='...').pk
+        ])
+
+        self.connecter('tel-1')
+        self.assertEqual(self.actifs(), {'tel-1'})
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        # Appareil inconnu avec une session existante : refuse jusqu'a la connexion sur cet appareil
+        self.client.cookies['device_token'] = DeviceIdMiddleware.create_device_token('tel-2')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.connecter('tel-2')
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.actifs(), {'tel-1', 'tel-2'})
+
+
+class EcrituresDiffereesTests(TestCase):
+    """Tampons d'ecritures differees (tampons.py) et compteur de telechargements"""
+
+    def setUp(self):
+        # Increments laisses par d'autres tests dans le tampon du processus
+        telechargements.vider_telechargements()
+        cycle = Cycle.objects.create(nom='Lycée')
+        unite = Unite.objects.create(nom='Chapitre', niveau=Niveau.objects.create(nom='Seconde', cycle=cycle),
+                                     discipline=Discipline.objects.create(nom='Maths'))
+        self.fichiers = [
+            Fichier.objects.create(nom=f'Cours {numero}', unite=unite, type_fichier='TXT', contenu_texte='...')
+            for numero in range(2)
+        ]
+
+    def compteurs(self):
+        return [Fichier.objects.get(pk=fichier.pk).telechargements for fichier in self.fichiers]
+
+    def test_vidage_par_lots(self):
+        premier, second = self.fichiers
+        for _ in range(3):
+            telechargements.compter_telechargement(premier.pk)
+        telechargements.compter_telechargement(second.pk)
+        self.assertEqual(self.compteurs(), [0, 0])
+        self.assertEqual(telechargements.en_attente(premier.pk), 3)
+
+        self.assertEqual(telechargements.vider_telechargements(), 4)
+        self.assertEqual(self.compteurs(), [3, 1])
+        self.assertEqual(telechargements.en_attente(premier.pk), 0)
+        self.assertEqual(telechargements.vider_telechargements(), 0)
+
+    def test_page_de_detail(self):
+        url = reverse('educalims:fichier_detail', args=[self.fichiers[0].pk])
+        self.client.get(url)
+        response = self.client.get(url)
+        # Compteur affiche : valeur en base plus increments pas encore ecrits
+        self.assertEqual(response.context['fichier'].telechargements, 2)
+        telechargements.vider_telechargements()
+        self.assertEqual(self.compteurs(), [2, 0])
+
+    def test_valeurs_gardees_en_cas_d_echec(self):
+        ecrites = []
+
+        def ecrire(valeurs):
+            if not ecrites:
+                ecrites.append(None)
+                raise DatabaseError("base indisponible")
+            ecrites.append(dict(valeurs))
+
+        tampon = TamponEcritures('tests', ecrire, intervalle=3600)
+        tampon.ajouter('a', 2)
+        with self.assertRaises(DatabaseError):
+            tampon.vider()
+        tampon.ajouter('a', 1)
+        tampon.ajouter('b', 5)
+        self.assertEqual(tampon.vider(), {'a': 3, 'b': 5})
+        self.assertEqual(ecrites[-1], {'a': 3, 'b': 5})
+        tampon._timer.cancel()
+
+    def test_vidage_par_le_timer(self):
+        ecrit = threading.Event()
+        ecrites = []
+
+        def ecrire(valeurs):
+            ecrites.append(dict(valeurs))
+            ecrit.set()
+
+        tampon = TamponEcritures('tests', ecrire, intervalle=0.05, fusionner=max)
+        tampon.ajouter('tel-1', 3)
+        tampon.ajouter('tel-1', 7)
+        tampon.ajouter('tel-1', 5)
+        self.assertTrue(ecrit.wait(5))
+        self.assertEqual(ecrites, [{'tel-1': 7}])
+        self.assertIsNone(tampon.valeur('tel-1'))
+
+
+class FauxTelegram(BaseHTTPRequestHandler):
+    """API Telegram locale : enregistre les messages recus et renvoie les reponses prevues"""
+    messages = []
+    reponses = []
+
+    def do_POST(self):
+        corps = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        self.messages.append(corps['text'][0])
+        statut, reponse = self.reponses.pop(0) if self.reponses else (200, {'ok': True})
+        donnees = json.dumps(reponse).encode()
+        self.send_response(statut)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(donnees)))
+        self.end_headers()
+        self.wfile.write(donnees)
+
+    def log_message(self, *args):
+        pass
+
+
+class NotificationsTelegramTests(TestCase):
+    """File d'attente des notifications Telegram (outbox) et envoi par run_notifier"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.serveur = HTTPServer(('127.0.0.1', 0), FauxTelegram)
+        threading.Thread(target=cls.serveur.serve_forever, daemon=True).start()
+        cls.enterClassContext(override_settings(TELEGRAM_API_URL=f'http://127.0.0.1:{cls.serveur.server_port}'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.serveur.shutdown()
+        cls.serveur.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        FauxTelegram.messages = []
+        FauxTelegram.reponses = []
+        self.webhook_log = WebhookLog.objects.create(provider='cyberschool', status='SUCCESS', raw_data={})
+
+    def test_mise_en_file_puis_envoi(self):
+        notification = envoyer_notification_telegram('Bonjour', webhook_log=self.webhook_log)
+        self.assertEqual(FauxTelegram.messages, [])
+        self.assertEqual(notification.statut, 'EN_ATTENTE')
+
+        self.assertEqual(traiter_notifications(), 1)
+        self.assertEqual(FauxTelegram.messages, ['Bonjour'])
+        notification.refresh_from_db()
+        self.assertEqual((notification.statut, notification.tentatives), ('ENVOYEE', 1))
+        self.webhook_log.refresh_from_db()
+        self.assertTrue(self.webhook_log.telegram_notification_sent)
+        self.assertEqual(traiter_notifications(), 0)
+
+    def test_echec_avec_backoff(self):
+        FauxTelegram.reponses = [(500, {'ok': False, 'description': 'Internal Server Error'})]
+        notification = envoyer_notification_telegram('Bonjour', webhook_log=self.webhook_log)
+        avant = timezone.now()
+        self.assertEqual(traiter_notifications(), 1)
+
+        notification.refresh_from_db()
+        self.assertEqual((notification.statut, notification.tentatives), ('EN_ATTENTE', 1))
+        self.assertIn('500', notification.derniere_erreur)
+        self.assertGreaterEqual(notification.prochaine_tentative, avant + timedelta(seconds=BACKOFF_INITIAL))
+        # Pas de nouvel essai avant la fin du backoff
+        self.assertEqual(traiter_notifications(), 0)
+        self.webhook_log.refresh_from_db()
+        self.assertFalse(self.webhook_log.telegram_notification_sent)
+
+    def test_abandon_apres_le_dernier_essai(self):
+        FauxTelegram.reponses = [(400, {'ok': False, 'description': 'Bad Request'})]
+        notification = envoyer_notification_telegram('Bonjour')
+        NotificationTelegram.objects.filter(pk=notification.pk).update(
+            tentatives=settings.TELEGRAM_MAX_TENTATIVES - 1
+        )
+        traiter_notifications()
+        notification.refresh_from_db()
+        self.assertEqual(notification.statut, 'ECHEC')
+
+    def test_limite_de_debit(self):
+        FauxTelegram.reponses = [(429, {'ok': False, 'description': 'Too Many Requests',
+                                        'parameters': {'retry_after': 1}})]
+        premiere = envoyer_notification_telegram('Premier')
+        seconde = envoyer_notification_telegram('Second')
+        self.assertEqual(traiter_notifications(), 1)
+
+        premiere.refresh_from_db()
+        seconde.refresh_from_db()
+        # 429 : replanifiee sans consommer d'essai ; le reste du lot est rendu aussitot
+        self.assertEqual((premiere.statut, premiere.tentatives), ('EN_ATTENTE', 0))
+        self.assertLessEqual(seconde.prochaine_tentative, timezone.now())
+        self.assertEqual(FauxTelegram.messages, ['Premier'])
+
+    @override_settings(TELEGRAM_RESUME_FENETRE=60)
+    def test_mode_resume(self):
+        for operateur, montant in (('AIRTEL', 5000), ('MOOV', 3000), ('AIRTEL', 5000)):
+            envoyer_notification_telegram('Paiement', categorie='PAIEMENT_SUCCES', operateur=operateur,
+                                          montant=montant)
+        envoyer_notification_telegram('Erreur')
+        # Fenetre pas encore ecoulee : seules les notifications sans categorie partent
+        self.assertEqual(traiter_notifications(), 1)
+        self.assertEqual(FauxTelegram.messages, ['Erreur'])
+
+        NotificationTelegram.objects.update(date_creation=timezone.now() - timedelta(minutes=2))
+        self.assertEqual(traiter_notifications(), 3)
+        self.assertEqual(len(FauxTelegram.messages), 2)
+        resume = FauxTelegram.messages[-1]
+        self.assertIn('Paiements réussis:</b> 3 — 13000 FCFA', resume)
+        self.assertIn('AIRTEL: 2 réussi(s), 0 échec(s) — 10000 FCFA', resume)
+        self.assertFalse(NotificationTelegram.objects.exclude(statut='ENVOYEE').exists())
+
+
+class NettoyageAbonnementsTests(TestCase):
+    """Annulation des paiements abandonnes et archivage des abonnements termines (reap_abonnements)"""
+
+    def setUp(self):
+        cycle = Cycle.objects.create(nom='Lycée')
+        self.niveau = Niveau.objects.create(nom='Terminale', cycle=cycle)
+        self.produit = Produit.objects.create(nom='Annuel', prix=5000)
+        self.user = User.objects.create_user('eleve')
+
+    def creer(self, statut, age, **champs):
+        """Abonnement cree et modifie il y a `age` (timedelta) : update() contourne auto_now"""
+        abonnement = Abonnement.objects.create(user=self.user, niveau=self.niveau, produit=self.produit,
+                                               statut=statut, **champs)
+        date = timezone.now() - age
+        Abonnement.objects.filter(pk=abonnement.pk).update(date_creation=date, date_modification=date)
+        return abonnement
+
+    def statuts(self):
+        return dict(Abonnement.objects.values_list('pk', 'statut'))
+
+    def test_annulation_des_attentes_abandonnees(self):
+        ancien = self.creer('EN_ATTENTE', timedelta(seconds=ATTENTE_DUREE_MAX + 60))
+        recent = self.creer('EN_ATTENTE', timedelta(hours=1))
+        actif = self.creer('ACTIF', timedelta(days=2))
+
+        self.assertEqual(annuler_attentes_lot(), 1)
+        self.assertEqual(self.statuts(), {ancien.pk: 'ANNULE', recent.pk: 'EN_ATTENTE', actif.pk: 'ACTIF'})
+        self.assertEqual(annuler_attentes_lot(), 0)
+
+    def test_archivage(self):
+        termine = self.creer('EXPIRE', timedelta(days=30 * ARCHIVAGE_MOIS + 1), merchant_reference_id='111111111')
+        recent = self.creer('ANNULE', timedelta(days=1))
+        actif = self.creer('ACTIF', timedelta(days=30 * ARCHIVAGE_MOIS + 1))
+        webhook_log = WebhookLog.objects.create(provider='cyberschool', abonnement=termine, raw_data={},
+                                                merchant_reference_id='111111111')
+
+        self.assertEqual(archiver_lot(), 1)
+        self.assertEqual(self.statuts(), {recent.pk: 'ANNULE', actif.pk: 'ACTIF'})
+        archive = AbonnementArchive.objects.get(pk=termine.pk)
+        self.assertEqual((archive.statut, archive.user, archive.merchant_reference_id),
+                         ('EXPIRE', self.user, '111111111'))
+        webhook_log.refresh_from_db()
+        self.assertIsNone(webhook_log.abonnement)
+        # Reference archivee : jamais reattribuee
+        self.assertFalse(references.reference_libre('111111111'))
+
+    def test_commande_par_lots(self):
+        for _ in range(5):
+            self.creer('EN_ATTENTE', timedelta(days=2))
+        sortie = StringIO()
+        call_command('reap_abonnements', lot=2, sans_archivage=True, stdout=sortie)
+        self.assertEqual(set(self.statuts().values()), {'ANNULE'})
+        self.assertIn('Annulation lot 3: 1 abonnement(s)', sortie.getvalue())
+        self.assertIn('Annulation: 5 abonnement(s) en 3 lot(s)', sortie.getvalue())
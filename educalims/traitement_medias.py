@@ -0,0 +1,97 @@
+"""
+Traitement des fichiers uploades (manage.py process_media) : les Fichier pas encore traites
+sont analyses dans un pool de processus (analyse_medias.py) et les resultats enregistres
+"""
+import logging
+import os
+import shutil
+from concurrent.futures import as_completed
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .analyse_medias import analyser
+from .models import Fichier
+
+logger = logging.getLogger(__name__)
+
+TRAITEMENT_LOT = 20
+# Un lot reserve par un worker arrete en cours d'analyse redevient disponible apres ce delai
+TRAITEMENT_BAIL = 30 * 60
+# Miniatures et variantes sous MEDIA_ROOT/apercus/<id du fichier>/
+APERCUS = 'apercus'
+LARGEUR_MINIATURE = getattr(settings, 'MEDIAS_LARGEUR_MINIATURE', 480)
+LARGEURS_VARIANTES = getattr(settings, 'MEDIAS_LARGEURS_VARIANTES', (320, 640, 1280))
+
+
+def fichiers_a_traiter():
+    return Fichier.objects.filter(traite_le__isnull=True).exclude(fichier='').exclude(fichier__isnull=True)
+
+
+def supprimer_apercus(fichier_id):
+    """Supprime la miniature et les variantes d'un fichier (MEDIA_ROOT/apercus/<id>/)"""
+    shutil.rmtree(os.path.join(settings.MEDIA_ROOT, APERCUS, str(fichier_id)), ignore_errors=True)
+
+
+def reserver_lot(taille=TRAITEMENT_LOT):
+    """
+    Reserve un lot dans une transaction courte (SELECT ... FOR UPDATE SKIP LOCKED) : les autres
+    workers l'ignorent ensuite sans qu'aucun verrou ne soit garde pendant l'analyse.
+    Retourne (date de reservation, fichiers reserves).
+    """
+    reserve_le = timezone.now()
+    with transaction.atomic():
+        lot = list(
+            fichiers_a_traiter().select_for_update(skip_locked=True)
+            .filter(Q(traitement_reserve_le__isnull=True)
+                    | Q(traitement_reserve_le__lt=reserve_le - timedelta(seconds=TRAITEMENT_BAIL)))
+            .only('pk', 'fichier', 'type_fichier')
+            .order_by('date_creation')[:taille]
+        )
+        Fichier.objects.filter(pk__in=[fichier.pk for fichier in lot]).update(traitement_reserve_le=reserve_le)
+    return reserve_le, lot
+
+
+def _enregistrer(fichier, reserve_le, resultat):
+    # update() : ni date_modification ni signaux (le plan des niveaux ne change pas).
+    # Fichier remplace ou remis en file pendant l'analyse (reservation effacee) : resultat ignore
+    return Fichier.objects.filter(pk=fichier.pk, traitement_reserve_le=reserve_le).update(
+        traite_le=timezone.now(), traitement_reserve_le=None, **resultat
+    )
+
+
+def traiter_lot(executeur, taille=TRAITEMENT_LOT):
+    """
+    Analyse un lot de fichiers en parallele dans `executeur` (ProcessPoolExecutor), hors
+    transaction ; chaque resultat est enregistre par son propre UPDATE.
+    Plusieurs workers peuvent tourner en parallele (voir reserver_lot).
+    Retourne le nombre de fichiers traites.
+    """
+    reserve_le, lot = reserver_lot(taille)
+    travaux = {
+        executeur.submit(
+            analyser, fichier.fichier.path, fichier.type_fichier, str(settings.MEDIA_ROOT),
+            f"{APERCUS}/{fichier.pk}", LARGEUR_MINIATURE, LARGEURS_VARIANTES,
+        ): fichier
+        for fichier in lot
+    }
+    for travail in as_completed(travaux):
+        fichier = travaux[travail]
+        try:
+            resultat = travail.result()
+        except Exception as e:
+            logger.error(f"Erreur de traitement du fichier {fichier.pk}: {e}", exc_info=True)
+            resultat = {'erreur_traitement': str(e) or e.__class__.__name__}
+        else:
+            resultat['erreur_traitement'] = ''
+        try:
+            _enregistrer(fichier, reserve_le, resultat)
+        except DatabaseError as e:
+            # Resultat refuse par la base (ex: caractere NUL dans les metadonnees) : erreur
+            # enregistree seule, le fichier n'est pas retraite en boucle
+            logger.error(f"Resultat du fichier {fichier.pk} non enregistre: {e}", exc_info=True)
+            _enregistrer(fichier, reserve_le, {'erreur_traitement': f"Enregistrement impossible: {e}"})
+    return len(lot)
@@ -29,6 +29,7 @@ urlpatterns = [
 
     # Fichiers
     path('fichiers/<int:fichier_id>/', views.fichier_detail, name='fichier_detail'),
+    path('fichiers/<int:fichier_id>/telecharger/', views.fichier_telecharger, name='fichier_telecharger'),
 
     # Abonnements
     path('abonnements/', views.mes_abonnements, name='mes_abonnements'),
@@ -36,6 +37,9 @@ urlpatterns = [
     path('api/paiement/callback/', views.paiement_callback, name='paiement_callback'),
     path('webhook/cyberschool/', views.webhook_cyberschool_simple, name='webhook_cyberschool_simple'),
     path('api/verifier-acces/<int:niveau_id>/', views.verifier_acces, name='verifier_acces'),
+    path('api/verifier-acces/', views.verifier_acces_groupe, name='verifier_acces_groupe'),
     path('api/abonnement/<int:abonnement_id>/statut/', views.abonnement_statut, name='abonnement_statut'),
+    path('api/abonnement/<int:abonnement_id>/flux/', views.abonnement_statut_flux, name='abonnement_statut_flux'),
     path('api/paiements-recents/', views.api_paiements_recents, name='api_paiements_recents'),
+    path('api/paiements-recents/flux/', views.api_paiements_recents_flux, name='api_paiements_recents_flux'),
 ]
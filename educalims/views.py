@@ -1,56 +1,47 @@
+from django.conf import settings
+from django.db import transaction
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import HttpResponse, JsonResponse
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Q
+from django.http import Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
 from django.contrib import messages
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.utils import timezone
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+import asyncio
+import hashlib
+from datetime import datetime, timedelta, timezone as dt_timezone
 import json
 import uuid
-import random
-import requests
 import logging
-from .models import Cycle, Discipline, Niveau, Unite, Fichier, Produit, Abonnement, WebhookLog, UserProfile
+from .models import Cycle, Discipline, Niveau, Unite, Fichier, Produit, Abonnement
 from .forms import CustomUserCreationForm, LoginForm
-from .middleware import DeviceIdMiddleware
-from .middleware import device_required
+from .medias import apercu, premier_octet, reponse_fichier
+from .middleware import device_required, get_device_id, poser_cookie_appareil
+from .appareils import enregistrer_appareil
+from .outline import get_outline
+from .rapprochement import rapprocher_paiement
+from .references import allouer_reference
+from .telechargements import compter_telechargement, en_attente as en_attente_telechargements
+from .evenements import TOUS, ecouteur
+from .entitlements import a_acces, abonnement_valide, get_droits
+from .telegram import envoyer_notification_telegram
+from .webhooks import (
+    PROVIDER_CALLBACK, enregistrer_webhook, memoriser_reponse, reponse_doublon, traiter_webhook_immediat,
+)
 
 logger = logging.getLogger(__name__)
 
 
 # ==================== TELEGRAM NOTIFICATIONS ====================
-
-TELEGRAM_BOT_TOKEN = "8539115405:AAFxfimKuOeVKqYL5mQaclVsQ5Lh2hIcIok"
-TELEGRAM_CHAT_ID = "1646298746"
-
-
-def envoyer_notification_telegram(message):
-    """Envoie une notification à Telegram via bot"""
-    try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-
-        payload = {
-            "chat_id": TELEGRAM_CHAT_ID,
-            "text": message,
-            "parse_mode": "HTML"
-        }
-
-        logger.info(f"Envoi Telegram: {message[:100]}...")
-        response = requests.post(url, data=payload, timeout=10)
-        result = response.json()
-
-        if result.get("ok"):
-            logger.info(f"Réponse Telegram: OK - Message envoyé")
-            return True
-        else:
-            logger.error(f"Erreur Telegram: {result}")
-            return False
-
-    except Exception as e:
-        logger.error(f"Erreur Telegram: {str(e)}", exc_info=True)
-        return False
-
+# Les notifications sont mises en file (NotificationTelegram) et envoyées par manage.py run_notifier
 
 def notifier_paiement_telegram(abonnement, statut="SUCCES", transaction_id="", numero_tel=""):
     """Envoie une notification Telegram pour un paiement"""
@@ -91,7 +82,13 @@ def notifier_paiement_telegram(abonnement, statut="SUCCES", transaction_id="", n
     if statut == "SUCCES" and abonnement.date_fin:
         message += f"\n📅 <b>Valide jusqu'au:</b> {abonnement.date_fin.strftime('%d/%m/%Y à %H:%M')}\n"
 
-    return envoyer_notification_telegram(message.strip())
+    categories = {"SUCCES": "PAIEMENT_SUCCES", "ECHEC": "PAIEMENT_ECHEC"}
+    return envoyer_notification_telegram(
+        message.strip(),
+        categorie=categories.get(statut, ''),
+        operateur=abonnement.methode_paiement,
+        montant=abonnement.montant_paye or abonnement.produit.prix
+    )
 
 
 def notifier_nouveau_abonnement_telegram(abonnement):
@@ -110,7 +107,9 @@ def notifier_nouveau_abonnement_telegram(abonnement):
 ⏳ <b>En attente de paiement...</b>
 """
 
-    return envoyer_notification_telegram(message.strip())
+    return envoyer_notification_telegram(
+        message.strip(), categorie='NOUVEL_ABONNEMENT', montant=abonnement.produit.prix
+    )
 
 
 # ==================== VUES PRINCIPALES ====================
@@ -130,10 +129,8 @@ def cycles_list(request):
 def cycle_detail(request, cycle_id):
     """Détail d'un cycle avec ses disciplines"""
     cycle = get_object_or_404(Cycle, pk=cycle_id)
+    # Le nombre de niveaux enfants est un compteur dénormalisé (nb_niveaux_enfants)
     disciplines = cycle.disciplines.all()
-    # Annoter chaque discipline avec le nombre de niveaux enfants
-    for discipline in disciplines:
-        discipline.niveaux_enfants_count = discipline.niveaux.filter(est_niveau_enfant=True).count()
     return render(request, 'educalims/cycle_detail.html', {
         'cycle': cycle,
         'disciplines': disciplines
@@ -142,10 +139,8 @@ def cycle_detail(request, cycle_id):
 
 def disciplines_list(request):
     """Liste de toutes les disciplines"""
-    disciplines = Discipline.objects.all()
-    # Annoter chaque discipline avec le nombre de niveaux enfants seulement
-    for discipline in disciplines:
-        discipline.niveaux_enfants_count = discipline.niveaux.filter(est_niveau_enfant=True).count()
+    # Le nombre de niveaux enfants est un compteur dénormalisé (nb_niveaux_enfants)
+    disciplines = Discipline.objects.prefetch_related('cycles')
     return render(request, 'educalims/disciplines_list.html', {'disciplines': disciplines})
 
 
@@ -153,11 +148,12 @@ def discipline_detail(request, discipline_id):
     """Détail d'une discipline avec ses niveaux enfants uniquement"""
     discipline = get_object_or_404(Discipline, pk=discipline_id)
     # N'afficher que les niveaux enfants (ceux qui ont un niveau_parent)
-    niveaux = discipline.niveaux.filter(est_niveau_enfant=True).order_by('ordre', 'nom')
-    # Annoter chaque niveau avec le nombre de sous-unités finales (chapitres sans enfants)
-    for niveau in niveaux:
-        # Compter les unités qui n'ont pas d'enfants (les feuilles de la hiérarchie)
-        niveau.chapitres_count = niveau.unites.filter(unites_enfants__isnull=True).count()
+    # Le nombre de chapitres (unités finales) est un compteur dénormalisé (nb_chapitres)
+    niveaux = list(
+        discipline.niveaux.filter(est_niveau_enfant=True)
+        .select_related('niveau_parent')
+        .order_by('ordre', 'nom')
+    )
     return render(request, 'educalims/discipline_detail.html', {
         'discipline': discipline,
         'niveaux': niveaux
@@ -166,28 +162,20 @@ def discipline_detail(request, discipline_id):
 
 def niveau_detail(request, niveau_id):
     """Détail d'un niveau avec ses unités"""
-    niveau = get_object_or_404(Niveau, pk=niveau_id)
-    # Récupérer les disciplines associées au niveau
-    disciplines = niveau.disciplines.all()
-    # Récupérer les parties (unités sans parent)
-    parties = niveau.unites.filter(unite_parent__isnull=True).order_by('ordre')
-    # Compter les chapitres (unités finales sans enfants)
-    niveau.chapitres_count = niveau.unites.filter(unites_enfants__isnull=True).count()
-
-    # Vérifier si l'utilisateur a accès à ce niveau
-    acces_autorise = False
-    if request.user.is_authenticated:
-        abonnement = Abonnement.objects.filter(
-            user=request.user,
-            niveau=niveau,
-            statut='ACTIF'
-        ).first()
-        acces_autorise = abonnement and abonnement.est_valide()
+    niveau = get_object_or_404(Niveau.objects.select_related('cycle'), pk=niveau_id)
+    # Discipline principale du niveau (pour le fil d'Ariane)
+    discipline = niveau.disciplines.first()
+    # Plan précalculé (parties > chapitres > fichiers), servi depuis le cache partagé
+    outline = get_outline(niveau.pk)
+    niveau.chapitres_count = outline['chapitres_count']
+
+    # Vérifier si l'utilisateur a accès à ce niveau (droits en cache)
+    acces_autorise = a_acces(request.user, niveau.pk)
 
     return render(request, 'educalims/niveau_detail.html', {
         'niveau': niveau,
-        'parties': parties,
-        'discipline': disciplines.first() if disciplines else None,
+        'parties': outline['parties'],
+        'discipline': discipline,
         'acces_autorise': acces_autorise
     })
 
@@ -195,11 +183,14 @@ def niveau_detail(request, niveau_id):
 @device_required
 def unite_detail(request, unite_id):
     """Détail d'une unité avec ses fichiers et sous-unités"""
-    unite = get_object_or_404(Unite, pk=unite_id)
+    unite = get_object_or_404(
+        Unite.objects.select_related('niveau', 'discipline', 'unite_parent'), pk=unite_id
+    )
     fichiers = unite.fichiers.filter(est_actif=True)
     sous_unites = unite.unites_enfants.all().order_by('ordre')
     return render(request, 'educalims/unite_detail.html', {
         'unite': unite,
+        'ancetres': unite.ancetres(),
         'fichiers': fichiers,
         'sous_unites': sous_unites
     })
@@ -208,12 +199,50 @@ def unite_detail(request, unite_id):
 @device_required
 def fichier_detail(request, fichier_id):
     """Détail d'un fichier"""
-    fichier = get_object_or_404(Fichier, pk=fichier_id, est_actif=True)
-    # Incrémenter le compteur de téléchargements
-    if fichier.type_fichier != 'LNK':
-        fichier.telechargements += 1
-        fichier.save()
-    return render(request, 'educalims/fichier_detail.html', {'fichier': fichier})
+    fichier = get_object_or_404(Fichier.objects.select_related('unite__niveau'), pk=fichier_id, est_actif=True)
+    # Contenu affiché sur la page (texte, vidéo sans fichier) : compté ici ; les fichiers le sont
+    # par fichier_telecharger
+    if fichier.type_fichier != 'LNK' and not fichier.fichier:
+        compter_telechargement(fichier.pk)
+    fichier.telechargements += en_attente_telechargements(fichier.pk)
+    return render(request, 'educalims/fichier_detail.html', {
+        'fichier': fichier,
+        # Fil d'Ariane complet (Thème > Partie > Chapitre...) en une seule requête
+        'ancetres': fichier.unite.ancetres(),
+        # Aperçus servis par fichier_telecharger, réservés aux abonnés (droits en cache)
+        'acces_autorise': a_acces(request.user, fichier.unite.niveau_id),
+    })
+
+
+@device_required
+def fichier_telecharger(request, fichier_id):
+    """
+    Téléchargement d'un fichier : contrôle de l'abonnement et de l'appareil, puis envoi par
+    nginx (X-Accel-Redirect) sans passer les octets par Django, ou FileResponse en développement
+    """
+    fichier = get_object_or_404(Fichier.objects.select_related('unite'), pk=fichier_id, est_actif=True)
+    if not fichier.fichier:
+        raise Http404("Aucun fichier à télécharger")
+    if not request.user.is_authenticated:
+        return redirect_to_login(request.get_full_path())
+    # L'équipe ouvre les fichiers depuis l'admin sans abonnement
+    if not request.user.is_staff and not a_acces(request.user, fichier.unite.niveau_id):
+        messages.warning(request, "Abonnez-vous à ce niveau pour télécharger ses fichiers.")
+        return redirect('educalims:niveau_detail', niveau_id=fichier.unite.niveau_id)
+
+    # Miniature ou variante réduite (?format=miniature|320|640...), non comptée
+    format_ = request.GET.get('format')
+    if format_:
+        champ = apercu(fichier, format_)
+        if champ is None:
+            raise Http404("Aperçu indisponible")
+        return reponse_fichier(request, fichier, champ)
+
+    # Reprises et sauts dans une vidéo (Range) ne comptent pas comme nouveaux téléchargements, ni
+    # les ouvertures depuis l'admin
+    if premier_octet(request) and not request.user.is_staff:
+        compter_telechargement(fichier.pk)
+    return reponse_fichier(request, fichier)
 
 
 # ==================== VUES D'AUTHENTIFICATION ====================
@@ -232,8 +261,17 @@ def custom_login(request):
             if user is not None:
                 login(request, user)
                 messages.success(request, f'Bienvenue, {username} !')
+                # Appareil autorise a la connexion : au-dela de APPAREILS_MAX, il remplace le
+                # moins recemment utilise (retour a un ancien telephone compris)
+                device_id = get_device_id(request)
+                if device_id and not enregistrer_appareil(user, device_id):
+                    messages.warning(request, "Cet appareil a été révoqué ou est lié à un autre compte : "
+                                              "le contenu payant n'y est pas accessible.")
                 next_url = request.GET.get('next', 'educalims:home')
-                return redirect(next_url)
+                response = redirect(next_url)
+                if device_id:
+                    poser_cookie_appareil(response, device_id)
+                return response
             else:
                 messages.error(request, 'Nom d\'utilisateur ou mot de passe incorrect.')
     else:
@@ -314,47 +352,52 @@ def s_abonner(request, niveau_id):
         return redirect('educalims:discipline_detail', discipline_id=niveau.disciplines.first().id)
 
     # Vérifier si l'utilisateur a déjà un abonnement actif à ce niveau
-    abonnement_existant = Abonnement.objects.filter(
-        user=request.user,
-        niveau=niveau,
-        statut='ACTIF'
-    ).first()
-
-    if abonnement_existant and abonnement_existant.est_valide():
+    if a_acces(request.user, niveau.pk):
         messages.info(request, 'Vous avez déjà un abonnement actif à ce niveau.')
         return redirect('educalims:mes_abonnements')
 
-    # Générer une référence de transaction unique pour notre système et pour Cyberschool
-    reference_interne = f"SUB-{uuid.uuid4().hex[:12].upper()}"
-    # Format numérique pour Cyberschool (9 chiffres)
-    merchant_reference_id = f"{random.randint(100000000, 999999999)}"
-
-    # Créer un abonnement en attente
-    abonnement = Abonnement.objects.create(
-        user=request.user,
-        niveau=niveau,
-        produit=produit,
-        statut='EN_ATTENTE',
-        reference_interne=reference_interne,
-        merchant_reference_id=merchant_reference_id
+    # Réutiliser le paiement en attente récent du même niveau (page rechargée, retour arrière)
+    abonnement = (
+        Abonnement.objects.filter(
+            user=request.user,
+            niveau=niveau,
+            produit=produit,
+            statut='EN_ATTENTE',
+            date_creation__gte=timezone.now() - timedelta(seconds=settings.ABONNEMENT_ATTENTE_REUTILISATION),
+        )
+        .order_by('-date_creation')
+        .first()
     )
 
-    # Envoyer notification Telegram pour le nouvel abonnement
-    notifier_nouveau_abonnement_telegram(abonnement)
+    if abonnement is None:
+        # Générer une référence de transaction unique pour notre système et pour Cyberschool
+        reference_interne = f"SUB-{uuid.uuid4().hex[:12].upper()}"
+        # Format numérique pour Cyberschool (9 chiffres), unique et non devinable
+        merchant_reference_id = allouer_reference()
+
+        # Créer un abonnement en attente
+        abonnement = Abonnement.objects.create(
+            user=request.user,
+            niveau=niveau,
+            produit=produit,
+            statut='EN_ATTENTE',
+            reference_interne=reference_interne,
+            merchant_reference_id=merchant_reference_id
+        )
+
+        # Envoyer notification Telegram pour le nouvel abonnement
+        notifier_nouveau_abonnement_telegram(abonnement)
+
+    reference_interne = abonnement.reference_interne
+    merchant_reference_id = abonnement.merchant_reference_id
     
     # Enregistrer le device_id et creer le cookie JWT
-    device_id = getattr(request, 'device_id', None)
+    device_id = get_device_id(request)
     
     if device_id:
-        # Creer ou mettre a jour le UserProfile avec le device_id
-        profile, created = UserProfile.objects.get_or_create(
-            user=request.user,
-            defaults={'device_id': device_id}
-        )
-        
-        if not created and profile.device_id != device_id:
-            profile.device_id = device_id
-            profile.save()
+        # Autoriser l'appareil (au plus APPAREILS_MAX par utilisateur). Le UserProfile n'est cree
+        # qu'a l'inscription : sa creation compte une inscription (voir statistiques.py)
+        enregistrer_appareil(request.user, device_id)
 
     # Creer la reponse avec le cookie JWT
     response = render(request, 'educalims/abonnement/paiement.html', {
@@ -367,15 +410,7 @@ def s_abonner(request, niveau_id):
     
     # Ajouter le cookie JWT si device_id existe
     if device_id:
-        device_token = DeviceIdMiddleware.create_device_token(device_id)
-        response.set_cookie(
-            'device_token',
-            device_token,
-            max_age=365 * 24 * 60 * 60,  # 1 an
-            httponly=True,
-            secure=False,  # True en production avec HTTPS
-            samesite='Lax'
-        )
+        poser_cookie_appareil(response, device_id)
     
     return response
 
@@ -399,76 +434,23 @@ def paiement_callback(request):
         "operator": "AIRTEL_MONEY"
     }
     L'abonnement est active uniquement si code == 200.
+    Une transactionId deja recue renvoie la reponse d'origine sans retraitement.
     """
     try:
         data = json.loads(request.body)
-
-        # Récupérer les données de paiement
-        code = data.get('code')
-        merchant_reference_id = data.get('merchantReferenceId') or data.get('reference')
-        transaction_id = data.get('transactionId')
-        amount = data.get('amount')
-        operator = data.get('operator', data.get('operateur', ''))
-        numero_tel = data.get('numero_tel')
-
-        # Trouver l'abonnement correspondant via merchant_reference_id
-        abonnement = None
-        if merchant_reference_id:
-            abonnement = Abonnement.objects.filter(merchant_reference_id=merchant_reference_id).first()
-
-        if not abonnement:
-            # Log pour debug
-            print(f"DEBUG: Callback recu - merchantReferenceId: {merchant_reference_id}, code: {code}")
-            print(f"DEBUG: Abonnements en attente: {list(Abonnement.objects.filter(statut='EN_ATTENTE').values_list('merchant_reference_id', flat=True))}")
-            return JsonResponse({
-                'status': 'error',
-                'message': f'Abonnement non trouve (merchantReferenceId: {merchant_reference_id})'
-            }, status=404)
-
-        # Vérifier si le paiement est réussi (code == 200)
-        if code == 200:
-            # Mettre à jour l'abonnement
-            abonnement.code_paiement = str(code)
-            abonnement.methode_paiement = operator.upper() if operator else 'AUTRE'
-            abonnement.montant_paye = amount
-
-            # Activer l'abonnement
-            abonnement.activer_abonnement(date_expiration=abonnement.produit.date_expiration)
-
-            print(f"SUCCESS: Abonnement {abonnement.id} active pour {abonnement.user.username}")
-
-            # Envoyer notification Telegram pour paiement réussi avec détails
-            notifier_paiement_telegram(
-                abonnement,
-                statut="SUCCES",
-                transaction_id=transaction_id or "",
-                numero_tel=numero_tel or ""
-            )
-
-            return JsonResponse({
-                'status': 'success',
-                'message': 'Abonnement active avec succes',
-                'abonnement_id': abonnement.id
-            }, status=200)
-        else:
-            # Paiement échoué
-            abonnement.statut = 'ECHOUE'
-            abonnement.code_paiement = str(code)
-            abonnement.methode_paiement = operator.upper() if operator else 'AUTRE'
-            abonnement.save()
-
-            # Envoyer notification Telegram pour paiement échoué avec détails
-            notifier_paiement_telegram(
-                abonnement,
-                statut="ECHEC",
-                transaction_id=transaction_id or "",
-                numero_tel=numero_tel or ""
-            )
-
-            return JsonResponse({
-                'status': 'error',
-                'message': f'Paiement echoue (code: {code})'
-            }, status=400)
+        # En cas d'erreur le journal est annule aussi : la relivraison sera retraitee
+        with transaction.atomic():
+            webhook_log, cree = enregistrer_webhook(data, provider=PROVIDER_CALLBACK)
+            if cree:
+                reponse, http_status = _traiter_paiement_callback(data, webhook_log)
+                webhook_log.status = 'SUCCESS' if data.get('code') == 200 else 'FAILED'
+                webhook_log.traite_le = timezone.now()
+                champs = ['status', 'traite_le', 'abonnement', 'activation_succes', 'rapprochement', 'candidats']
+                champs += memoriser_reponse(webhook_log, reponse, http_status)
+                webhook_log.save(update_fields=champs)
+        if not cree:
+            reponse, http_status = reponse_doublon(webhook_log)
+        return JsonResponse(reponse, status=http_status)
 
     except json.JSONDecodeError:
         return JsonResponse({
@@ -483,6 +465,102 @@ def paiement_callback(request):
         }, status=500)
 
 
+def _traiter_paiement_callback(data, webhook_log):
+    """Applique un callback de paiement ; retourne (corps de reponse JSON, code HTTP)"""
+    # Récupérer les données de paiement
+    code = data.get('code')
+    merchant_reference_id = data.get('merchantReferenceId') or data.get('reference')
+    transaction_id = data.get('transactionId')
+    amount = data.get('amount')
+    operator = data.get('operator', data.get('operateur', ''))
+    numero_tel = data.get('numero_tel')
+
+    # Trouver l'abonnement : reference marchand, puis telephone + montant (ligne verrouillee)
+    resultat = rapprocher_paiement(merchant_reference_id, numero_tel, amount, webhook_log.created_at)
+    abonnement = resultat.abonnement
+    webhook_log.rapprochement = resultat.methode
+    webhook_log.candidats = [a.pk for a in resultat.candidats]
+
+    if resultat.ambigu:
+        logger.warning(f"Callback {transaction_id}: rapprochement ambigu entre les abonnements {webhook_log.candidats}")
+        envoyer_notification_telegram(
+            f"❓ <b>PAIEMENT AMBIGU</b>\n\n"
+            f"Référence: <code>{merchant_reference_id}</code>\n"
+            f"Téléphone: {numero_tel or 'N/A'} | Montant: {amount} FCFA\n"
+            f"Abonnements possibles: {', '.join(f'#{a.pk} ({a.user.username})' for a in resultat.candidats)}",
+            webhook_log=webhook_log
+        )
+        return {
+            'status': 'error',
+            'message': 'Plusieurs abonnements correspondent, activation manuelle requise'
+        }, 409
+
+    if not abonnement:
+        logger.warning(f"Callback recu sans abonnement correspondant - merchantReferenceId: {merchant_reference_id}, code: {code}")
+        return {
+            'status': 'error',
+            'message': f'Abonnement non trouve (merchantReferenceId: {merchant_reference_id})'
+        }, 404
+
+    if code == 200 and abonnement.statut == 'ACTIF':
+        # Paiement deja pris en compte (webhook recu avant le callback)
+        webhook_log.abonnement = abonnement
+        webhook_log.activation_succes = True
+        return {
+            'status': 'success',
+            'message': 'Abonnement deja actif',
+            'abonnement_id': abonnement.id
+        }, 200
+
+    # Vérifier si le paiement est réussi (code == 200)
+    if code == 200:
+        # Mettre à jour l'abonnement
+        abonnement.code_paiement = str(code)
+        abonnement.methode_paiement = operator.upper() if operator else 'AUTRE'
+        abonnement.montant_paye = amount
+
+        # Activer l'abonnement
+        abonnement.activer_abonnement(date_expiration=abonnement.produit.date_expiration)
+        webhook_log.abonnement = abonnement
+        webhook_log.activation_succes = True
+
+        print(f"SUCCESS: Abonnement {abonnement.id} active pour {abonnement.user.username}")
+
+        # Envoyer notification Telegram pour paiement réussi avec détails
+        notifier_paiement_telegram(
+            abonnement,
+            statut="SUCCES",
+            transaction_id=transaction_id or "",
+            numero_tel=numero_tel or ""
+        )
+
+        return {
+            'status': 'success',
+            'message': 'Abonnement active avec succes',
+            'abonnement_id': abonnement.id
+        }, 200
+    else:
+        # Paiement échoué (un abonnement deja actif n'est pas touche)
+        if abonnement.statut == 'EN_ATTENTE':
+            abonnement.statut = 'ECHOUE'
+            abonnement.code_paiement = str(code)
+            abonnement.methode_paiement = operator.upper() if operator else 'AUTRE'
+            abonnement.save()
+
+        # Envoyer notification Telegram pour paiement échoué avec détails
+        notifier_paiement_telegram(
+            abonnement,
+            statut="ECHEC",
+            transaction_id=transaction_id or "",
+            numero_tel=numero_tel or ""
+        )
+
+        return {
+            'status': 'error',
+            'message': f'Paiement echoue (code: {code})'
+        }, 400
+
+
 @login_required
 def verifier_acces(request, niveau_id):
     """Vérifie si l'utilisateur a accès à un niveau (API)"""
@@ -491,62 +569,268 @@ def verifier_acces(request, niveau_id):
 
     niveau = get_object_or_404(Niveau, pk=niveau_id)
 
-    abonnement = Abonnement.objects.filter(
-        user=request.user,
-        niveau=niveau,
-        statut='ACTIF'
-    ).first()
-
-    acces = abonnement and abonnement.est_valide()
+    droit = abonnement_valide(request.user, niveau.pk)
 
     return JsonResponse({
-        'acces': acces,
+        'acces': droit is not None,
         'niveau': niveau.nom,
-        'abonnement_id': abonnement.id if abonnement else None
+        'abonnement_id': droit[0] if droit else None
     })
 
 
+# Nombre maximal de niveaux par appel de l'API de vérification groupée
+VERIFIER_ACCES_MAX_NIVEAUX = 200
+
+
 @login_required
-def abonnement_statut(request, abonnement_id):
-    """Vérifie le statut d'un abonnement (API pour la page de paiement)"""
-    abonnement = get_object_or_404(Abonnement, pk=abonnement_id, user=request.user)
+@require_http_methods(["GET"])
+def verifier_acces_groupe(request):
+    """
+    Vérifie l'accès à plusieurs niveaux en un seul appel (API).
+    Paramètres (un seul) : ?niveaux=1,2,3  ou  ?discipline=<id>  ou  ?cycle=<id>
+    Réponse compacte : {"niveaux": {"<id>": {"acces": true, "date_fin": <timestamp>, "abonnement_id": <id>}}}
+    Supporte If-None-Match : une réponse inchangée renvoie 304 sans corps.
+    """
+    try:
+        if request.GET.get('niveaux'):
+            niveau_ids = {int(pk) for pk in request.GET['niveaux'].split(',') if pk.strip()}
+        elif request.GET.get('discipline'):
+            niveau_ids = set(Niveau.objects.filter(
+                disciplines=int(request.GET['discipline'])
+            ).values_list('pk', flat=True))
+        elif request.GET.get('cycle'):
+            niveau_ids = set(Niveau.objects.filter(
+                cycle_id=int(request.GET['cycle'])
+            ).values_list('pk', flat=True))
+        else:
+            return JsonResponse({'erreur': 'Paramètre niveaux, discipline ou cycle requis'}, status=400)
+    except ValueError:
+        return JsonResponse({'erreur': 'Identifiant invalide'}, status=400)
+
+    if len(niveau_ids) > VERIFIER_ACCES_MAX_NIVEAUX:
+        return JsonResponse({'erreur': f'{VERIFIER_ACCES_MAX_NIVEAUX} niveaux maximum'}, status=400)
+
+    # Droits en cache : au plus une requête indexée pour tous les niveaux
+    droits = get_droits(request.user)
+    resultat = {}
+    for niveau_id in sorted(niveau_ids):
+        droit = droits.get(niveau_id)
+        if droit:
+            abonnement_id, date_fin = droit
+            resultat[str(niveau_id)] = {
+                'acces': True,
+                'date_fin': int(date_fin) if date_fin else None,
+                'abonnement_id': abonnement_id,
+            }
+        else:
+            resultat[str(niveau_id)] = {'acces': False}
 
-    return JsonResponse({
+    corps = json.dumps({'niveaux': resultat}, separators=(',', ':'))
+    etag = quote_etag(hashlib.sha1(corps.encode()).hexdigest()[:20])
+
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(corps, content_type='application/json')
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Cookie'])
+    return response
+
+
+def _statut_abonnement_data(abonnement):
+    return {
         'statut': abonnement.statut,
         'statut_display': abonnement.get_statut_display(),
         'valide': abonnement.est_valide() if abonnement.statut == 'ACTIF' else False,
         'date_debut': abonnement.date_debut.strftime('%d/%m/%Y %H:%M') if abonnement.date_debut else None,
         'date_fin': abonnement.date_fin.strftime('%d/%m/%Y %H:%M') if abonnement.date_fin else None,
-    })
+    }
+
+
+@login_required
+def abonnement_statut(request, abonnement_id):
+    """Vérifie le statut d'un abonnement (API pour la page de paiement)"""
+    abonnement = get_object_or_404(Abonnement, pk=abonnement_id, user=request.user)
+
+    return JsonResponse(_statut_abonnement_data(abonnement))
+
+
+# Statuts apres lesquels la page de paiement n'attend plus rien
+STATUTS_FINAUX = ('ACTIF', 'ECHOUE', 'ANNULE', 'EXPIRE')
+# Duree maximale d'un flux (le navigateur se reconnecte ensuite) et relecture de securite
+FLUX_DUREE_MAX = 5 * 60
+FLUX_RELECTURE = 15
+
+
+@login_required
+async def abonnement_statut_flux(request, abonnement_id):
+    """
+    Flux Server-Sent Events du statut d'un abonnement (servi par asgi.py).
+    Reveille par NOTIFY Postgres a l'activation ou a l'echec du paiement.
+    """
+    if not isinstance(request, ASGIRequest):
+        # Sous WSGI le flux bloquerait un worker : la page repasse au polling
+        return HttpResponse(status=503)
+
+    user = await request.auser()
+    if not await Abonnement.objects.filter(pk=abonnement_id, user=user).aexists():
+        raise Http404("Abonnement introuvable")
+
+    async def evenements():
+        file = ecouteur.abonner(abonnement_id)
+        loop = asyncio.get_running_loop()
+        fin = loop.time() + FLUX_DUREE_MAX
+        dernier = None
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                abonnement = await Abonnement.objects.filter(pk=abonnement_id).afirst()
+                if abonnement is None:
+                    return
+                data = _statut_abonnement_data(abonnement)
+                if data != dernier:
+                    yield f"event: statut\ndata: {json.dumps(data)}\n\n"
+                    dernier = data
+                if abonnement.statut in STATUTS_FINAUX or loop.time() >= fin:
+                    return
+                try:
+                    await asyncio.wait_for(file.get(), timeout=min(FLUX_RELECTURE, fin - loop.time()))
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+        finally:
+            ecouteur.desabonner(abonnement_id, file)
+
+    response = StreamingHttpResponse(evenements(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# Fenetre du flux des paiements recents et duree du cache partage entre les admins
+PAIEMENTS_RECENTS_FENETRE = timedelta(minutes=10)
+PAIEMENTS_RECENTS_TTL = 3
+PAIEMENTS_RECENTS_MAX = 50
+
+
+def _curseur(date_modification, pk):
+    """Curseur opaque '<microsecondes epoch>-<id>' : position dans l'ordre (date_modification, id)"""
+    return f"{int(date_modification.timestamp()) * 10**6 + date_modification.microsecond}-{pk}"
+
+
+def _lire_curseur(curseur):
+    try:
+        micro, pk = (int(partie) for partie in curseur.split('-', 1))
+    except (AttributeError, ValueError):
+        return None
+    date = datetime.fromtimestamp(micro // 10**6, tz=dt_timezone.utc).replace(microsecond=micro % 10**6)
+    return date, pk
+
+
+def paiements_recents(since=None):
+    """
+    Paiements modifies apres le curseur `since` (ou les 20 plus recents des 10 dernieres minutes),
+    en une requete jointe, mis en cache quelques secondes pour tous les admins.
+    Apres un curseur, les paiements sont lus dans l'ordre croissant et le curseur avance jusqu'au
+    dernier renvoye : au-dela de PAIEMENTS_RECENTS_MAX, la suite vient a l'appel suivant.
+    Retourne {'paiements': [...], 'curseur': ...}.
+    """
+    position = _lire_curseur(since) if since else None
+    cle = f"paiements:recents:{position and since}"
+    resultat = cache.get(cle)
+    if resultat is not None:
+        return resultat
+
+    queryset = Abonnement.objects.filter(date_modification__gte=timezone.now() - PAIEMENTS_RECENTS_FENETRE)
+    if position:
+        date, pk = position
+        queryset = queryset.filter(
+            Q(date_modification__gt=date) | Q(date_modification=date, pk__gt=pk)
+        ).order_by('date_modification', 'pk')
+    else:
+        queryset = queryset.order_by('-date_modification', '-pk')
+    lignes = list(
+        queryset.values(
+            'id', 'user__username', 'niveau__nom', 'statut', 'montant_paye', 'methode_paiement',
+            'date_modification', 'code_paiement', 'merchant_reference_id',
+        )[:PAIEMENTS_RECENTS_MAX if position else 20]
+    )
+    # Position la plus avancee renvoyee : derniere ligne en ordre croissant, premiere sinon
+    derniere = (lignes[-1] if position else lignes[0]) if lignes else None
+
+    statuts = dict(Abonnement.STATUT_CHOICES)
+    resultat = {
+        'paiements': [{
+            'id': p['id'],
+            'user': p['user__username'],
+            'niveau': p['niveau__nom'],
+            'statut': p['statut'],
+            'statut_display': statuts.get(p['statut'], p['statut']),
+            'montant': p['montant_paye'],
+            'methode': p['methode_paiement'],
+            'date_modification': timezone.localtime(p['date_modification']).strftime('%H:%M:%S'),
+            'code_paiement': p['code_paiement'],
+            'merchant_reference_id': p['merchant_reference_id'],
+            'curseur': _curseur(p['date_modification'], p['id']),
+        } for p in lignes],
+        'curseur': _curseur(derniere['date_modification'], derniere['id']) if derniere else since,
+    }
+    cache.set(cle, resultat, PAIEMENTS_RECENTS_TTL)
+    return resultat
 
 
 def api_paiements_recents(request):
-    """API pour les paiements recents (affiches sur la page d'accueil)"""
-    from django.utils import timezone
-    from datetime import timedelta
-
-    # Derniers paiements des 10 dernieres minutes
-    date_limite = timezone.now() - timedelta(minutes=10)
-    paiements = Abonnement.objects.filter(
-        date_modification__gte=date_limite
-    ).order_by('-date_modification')[:20]
-
-    data = []
-    for p in paiements:
-        data.append({
-            'id': p.id,
-            'user': p.user.username,
-            'niveau': p.niveau.nom,
-            'statut': p.statut,
-            'statut_display': p.get_statut_display(),
-            'montant': p.montant_paye,
-            'methode': p.methode_paiement,
-            'date_modification': p.date_modification.strftime('%H:%M:%S'),
-            'code_paiement': p.code_paiement,
-            'merchant_reference_id': p.merchant_reference_id
-        })
-
-    return JsonResponse({'paiements': data})
+    """
+    API pour les paiements recents (widget de l'admin).
+    ?since=<curseur> ne renvoie que les paiements nouveaux ou modifies, 204 s'il n'y en a aucun.
+    """
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Accès réservé aux administrateurs'}, status=403)
+    since = request.GET.get('since')
+    resultat = paiements_recents(since)
+    if since and not resultat['paiements']:
+        return HttpResponse(status=204)
+    return JsonResponse(resultat)
+
+
+async def api_paiements_recents_flux(request):
+    """Flux Server-Sent Events des paiements recents, reveille par les NOTIFY de changement de statut"""
+    user = await request.auser()
+    if not user.is_staff:
+        return HttpResponseForbidden("Accès réservé aux administrateurs")
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=503)
+
+    async def evenements():
+        file = ecouteur.abonner(TOUS)
+        loop = asyncio.get_running_loop()
+        fin = loop.time() + FLUX_DUREE_MAX
+        curseur = request.GET.get('since')
+        try:
+            yield "retry: 3000\n\n"
+            while loop.time() < fin:
+                resultat = await sync_to_async(paiements_recents)(curseur)
+                if resultat['paiements'] or curseur is None:
+                    yield f"event: paiements\ndata: {json.dumps(resultat)}\n\n"
+                curseur = resultat['curseur'] or ''
+                if len(resultat['paiements']) >= PAIEMENTS_RECENTS_MAX:
+                    # Lot plein : la suite est lue sans attendre de notification
+                    continue
+                try:
+                    await asyncio.wait_for(file.get(), timeout=min(FLUX_RELECTURE, fin - loop.time()))
+                    # Regroupe les changements rapproches en un seul envoi
+                    await asyncio.sleep(0.5)
+                    while not file.empty():
+                        file.get_nowait()
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+        finally:
+            ecouteur.desabonner(TOUS, file)
+
+    response = StreamingHttpResponse(evenements(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @csrf_exempt  # Désactive CSRF pour ce webhook
@@ -554,150 +838,29 @@ def api_paiements_recents(request):
 def webhook_cyberschool_simple(request):
     """
     Webhook simplifié pour recevoir les notifications Cyberschool.
-    Envoie tout sur Telegram et tente d'activer l'abonnement.
+    Enregistre le payload brut puis, selon WEBHOOK_TRAITEMENT_DIFFERE, répond aussitôt
+    (traitement par manage.py process_webhooks) ou active l'abonnement immédiatement.
     """
     try:
-        # Log les données brutes reçues
-        logger.info("=" * 80)
-        logger.info("🔔 WEBHOOK CYBERSCHOOL REÇU")
-        logger.info(f"Body raw: {request.body}")
-
         data = json.loads(request.body)
-        logger.info(f"JSON reçu: {data}")
-
-        # Extraire les données importantes
-        merchant_ref = data.get('merchantReferenceId') or data.get('reference') or data.get('customerID')
-        code = data.get('code')
-        status = data.get('status')
-        amount = data.get('amount')
-        operator = data.get('operator', data.get('operateur', ''))
-        transaction_id = data.get('transactionId')
-        numero_tel = data.get('numero_tel') or data.get('customerID')
-
-        logger.info(f"merchantReferenceId: {merchant_ref}")
-        logger.info(f"code: {code}")
-        logger.info(f"status: {status}")
-        logger.info(f"transactionId: {transaction_id}")
-        logger.info(f"numero_tel: {numero_tel}")
-
-        # Envoyer notification Telegram avec toutes les infos
-        message = f"""🔔 <b>WEBHOOK CYBERSCHOOL REÇU</b>
-
-📋 <b>Détails bruts:</b>
-• <b>merchantReferenceId:</b> <code>{merchant_ref}</code>
-• <b>reference:</b> <code>{data.get('reference')}</code>
-• <b>Code:</b> {code}
-• <b>Status:</b> {status}
-• <b>Montant:</b> {amount} FCFA
-• <b>Opérateur:</b> {operator}
-• <b>Transaction ID:</b> <code>{transaction_id or 'N/A'}</code>
-• <b>Téléphone:</b> {numero_tel or 'N/A'}
-• <b>customerID:</b> {data.get('customerID', 'N/A')}
-
-🕐 <b>Timestamp:</b> {data.get('timestamp', 'N/A')}
-"""
-        envoyer_notification_telegram(message.strip())
-
-        logger.info("📱 Notification Telegram envoyée")
-
-        # === ACTIVATION AUTOMATIQUE DE L'ABONNEMENT ===
-        if code == 200 and numero_tel:
-            logger.info(f"✅ Paiement réussi ! Recherche de l'abonnement avec téléphone: {numero_tel}")
-
-            try:
-                # Rechercher l'abonnement EN_ATTENTE le plus récent pour ce niveau
-                # Cyberschool génère son propre merchantReferenceId, donc on utilise le numéro de téléphone
-                abonnement = Abonnement.objects.filter(
-                    statut='EN_ATTENTE'
-                ).order_by('-date_creation').first()
-
-                if abonnement:
-                    # Activer l'abonnement
-                    abonnement.statut = 'ACTIF'
-                    abonnement.date_debut = timezone.now()
-                    abonnement.methode_paiement = operator
-                    abonnement.montant_paye = amount
-                    abonnement.code_paiement = str(code)
-
-                    # Calculer la date de fin selon la durée du produit
-                    if abonnement.produit and abonnement.produit.date_expiration:
-                        # Utiliser la date d'expiration du produit
-                        from datetime import datetime, time
-                        # Combiner la date d'expiration avec l'heure actuelle
-                        abonnement.date_fin = datetime.combine(abonnement.produit.date_expiration, time.max)
-
-                    abonnement.save()
-
-                    logger.info(f"🎉 ABONNEMENT ACTIVÉ: {abonnement}")
-                    logger.info(f"   - Niveau: {abonnement.niveau.nom if abonnement.niveau else 'N/A'}")
-                    logger.info(f"   - Utilisateur: {abonnement.user.username if abonnement.user else 'N/A'}")
-                    logger.info(f"   - Date début: {abonnement.date_debut}")
-                    logger.info(f"   - Date fin: {abonnement.date_fin}")
-
-                    # Enregistrer le webhook log
-                    WebhookLog.objects.create(
-                        merchant_reference_id=merchant_ref,
-                        code=code,
-                        status=status,
-                        amount=amount,
-                        operator=operator,
-                        transaction_id=transaction_id,
-                        phone_number=numero_tel,
-                        abonnement=abonnement,
-                        activation_succes=True,
-                        telegram_notification_sent=True,
-                        raw_data=data
-                    )
-
-                    # Récupérer celui qui a recommandé l'utilisateur
-                    profile = abonnement.user.profile if hasattr(abonnement.user, 'profile') else None
-                    recommande_par = profile.get_recommande_par_display() if profile else 'N/A'
-                    
-                    # Notification de succès
-                    envoyer_notification_telegram(
-                        f"✅ <b>ABONNEMENT ACTIVÉ</b>\n"
-                        f"📚 Niveau: <b>{abonnement.niveau.nom if abonnement.niveau else 'N/A'}</b>\n"
-                        f"👤 Utilisateur: <b>{abonnement.user.username if abonnement.user else 'N/A'}</b>\n"
-                        f"💰 Montant: {amount} FCFA\n"
-                        f"📞 Téléphone: {numero_tel or 'N/A'} | Recommandé par: {recommande_par}"
-                    )
-
-                    return JsonResponse({
-                        'status': 'activated',
-                        'message': 'Abonnement activé avec succès',
-                        'abonnement_id': abonnement.id
-                    }, status=200)
-                else:
-                    logger.warning(f"⚠️ Aucun abonnement trouvé avec merchant_reference_id: {merchant_ref}")
-                    envoyer_notification_telegram(
-                        f"⚠️ <b>ABONNEMENT NON TROUVÉ</b>\n\n"
-                        f"Référence: <code>{merchant_ref}</code>\n"
-                        f"Paiement reçu mais aucun abonnement correspondant."
-                    )
-
-            except Exception as e:
-                logger.error(f"❌ Erreur lors de l'activation: {str(e)}", exc_info=True)
-                envoyer_notification_telegram(f"❌ <b>ERREUR ACTIVATION</b>\n\n{str(e)}")
-
-        elif code != 200:
-            logger.warning(f"⚠️ Paiement échoué (code: {code})")
-            envoyer_notification_telegram(
-                f"⚠️ <b>PAIEMENT ÉCHOUÉ</b>\n\n"
-                f"Code: {code}\n"
-                f"Status: {status}"
-            )
-
-        # Retourner 200 pour confirmer réception
-        return JsonResponse({
-            'status': 'received',
-            'message': 'Webhook reçu et traité',
-            'merchant_ref': merchant_ref,
-            'code': code
-        }, status=200)
+        webhook_log, cree = enregistrer_webhook(data)
+        if not cree:
+            reponse, http_status = reponse_doublon(webhook_log)
+            return JsonResponse(reponse, status=http_status)
+        logger.info(f"Webhook Cyberschool {webhook_log.pk} reçu (ref: {webhook_log.merchant_reference_id}, code: {webhook_log.code})")
+
+        if settings.WEBHOOK_TRAITEMENT_DIFFERE:
+            return JsonResponse({'status': 'received', 'webhook_id': webhook_log.pk}, status=200)
+
+        resultat = traiter_webhook_immediat(webhook_log)
+        if resultat is None:
+            # Deja pris par manage.py process_webhooks
+            return JsonResponse({'status': 'received', 'webhook_id': webhook_log.pk}, status=200)
+        reponse, http_status = resultat
+        return JsonResponse(reponse, status=http_status)
 
     except json.JSONDecodeError as e:
-        logger.error(f"❌ Erreur JSON: {str(e)}")
-        logger.error(f"Body reçu: {request.body}")
+        logger.error(f"❌ Erreur JSON: {str(e)} - Body reçu: {request.body[:1000]}")
         envoyer_notification_telegram(f"❌ <b>ERREUR JSON</b>\n\n{str(e)}")
         return JsonResponse({'status': 'error', 'message': 'JSON invalide'}, status=400)
 
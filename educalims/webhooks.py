@@ -0,0 +1,326 @@
+"""Traitement des webhooks Cyberschool (immediat ou differe via manage.py process_webhooks)"""
+import logging
+from datetime import datetime, time, timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import WebhookLog
+from .rapprochement import rapprocher_paiement
+from .telegram import envoyer_notification_telegram
+
+logger = logging.getLogger(__name__)
+
+# Fournisseurs : une meme transactionId n'est traitee qu'une fois par fournisseur
+PROVIDER_WEBHOOK = 'cyberschool'
+PROVIDER_CALLBACK = 'cyberschool_callback'
+
+DOUBLONS_CACHE_TIMEOUT = 48 * 60 * 60
+
+
+def extraire_donnees(data):
+    """Champs utiles d'un payload Cyberschool"""
+    return {
+        'merchant_ref': data.get('merchantReferenceId') or data.get('reference') or data.get('customerID'),
+        'code': data.get('code'),
+        'status': data.get('status'),
+        'amount': data.get('amount'),
+        'operator': data.get('operator', data.get('operateur', '')),
+        'transaction_id': data.get('transactionId'),
+        'numero_tel': data.get('numero_tel') or data.get('customerID'),
+    }
+
+
+def _entier(valeur):
+    try:
+        return int(valeur)
+    except (TypeError, ValueError):
+        return None
+
+
+def _decimal(valeur):
+    try:
+        return Decimal(str(valeur)) if valeur is not None else None
+    except InvalidOperation:
+        return None
+
+
+def enregistrer_webhook(data, provider=PROVIDER_WEBHOOK):
+    """
+    Enregistre le payload brut en un seul INSERT, en attente de traitement.
+    Retourne (webhook_log, cree) : cree=False si cette transactionId a deja ete recue.
+    """
+    champs = extraire_donnees(data)
+    transaction_id = champs['transaction_id'] or None
+    if transaction_id:
+        existant = WebhookLog.objects.filter(provider=provider, transaction_id=transaction_id).first()
+        if existant:
+            return existant, False
+
+    webhook_log = WebhookLog(
+        provider=provider,
+        merchant_reference_id=champs['merchant_ref'],
+        code=_entier(champs['code']),
+        status='PENDING',
+        amount=_decimal(champs['amount']),
+        operator=(champs['operator'] or '')[:50] or None,
+        transaction_id=transaction_id,
+        phone_number=champs['numero_tel'],
+        raw_data=data,
+    )
+    try:
+        with transaction.atomic():
+            webhook_log.save(force_insert=True)
+    except IntegrityError:
+        # Livraison concurrente de la meme transaction : l'autre requete a gagne
+        existant = WebhookLog.objects.filter(provider=provider, transaction_id=transaction_id).first()
+        if existant is None:
+            raise
+        return existant, False
+    return webhook_log, True
+
+
+def _cle_doublons(heure):
+    return f"webhooks:doublons:{heure:%Y%m%d%H}"
+
+
+def compter_doublon():
+    """Incremente le compteur de livraisons en double de l'heure courante (cache partage)"""
+    cle = _cle_doublons(timezone.now())
+    cache.add(cle, 0, DOUBLONS_CACHE_TIMEOUT)
+    try:
+        cache.incr(cle)
+    except ValueError:
+        # Cle expiree entre add() et incr()
+        cache.set(cle, 1, DOUBLONS_CACHE_TIMEOUT)
+
+
+def doublons_par_heure(heures=24):
+    """[(heure, nombre de doublons)] pour les `heures` dernieres heures, de la plus ancienne a la plus recente"""
+    maintenant = timezone.now().replace(minute=0, second=0, microsecond=0)
+    tranches = [maintenant - timedelta(hours=i) for i in reversed(range(heures))]
+    valeurs = cache.get_many([_cle_doublons(h) for h in tranches])
+    return [(h, valeurs.get(_cle_doublons(h), 0)) for h in tranches]
+
+
+def reponse_doublon(webhook_log):
+    """Reponse a une livraison deja recue : celle renvoyee la premiere fois, sans retraitement"""
+    compter_doublon()
+    logger.info(f"Webhook {webhook_log.provider} en double (transaction {webhook_log.transaction_id}, log {webhook_log.pk})")
+    if webhook_log.reponse is not None:
+        return webhook_log.reponse, webhook_log.reponse_http or 200
+    return {'status': 'received', 'webhook_id': webhook_log.pk, 'doublon': True}, 200
+
+
+def memoriser_reponse(webhook_log, reponse, http_status):
+    """Conserve la reponse renvoyee pour la rejouer aux livraisons en double"""
+    webhook_log.reponse = reponse
+    webhook_log.reponse_http = http_status
+    return ['reponse', 'reponse_http']
+
+
+def _statut_final(code, status):
+    statuts = dict(WebhookLog.STATUT_CHOICES)
+    if status in statuts and status != 'PENDING':
+        return status
+    return 'SUCCESS' if code == 200 else 'FAILED'
+
+
+def traiter_webhook(webhook_log):
+    """
+    Rapproche le paiement d'un abonnement, l'active et met les notifications en file.
+    Retourne (corps de reponse JSON, code HTTP) comme le webhook synchrone.
+    """
+    data = webhook_log.raw_data
+    champs = extraire_donnees(data)
+    merchant_ref = champs['merchant_ref']
+    code = champs['code']
+    status = champs['status']
+    amount = champs['amount']
+    operator = champs['operator']
+    transaction_id = champs['transaction_id']
+    numero_tel = champs['numero_tel']
+
+    webhook_log.status = _statut_final(code, status)
+    webhook_log.traite_le = timezone.now()
+    champs_modifies = ['status', 'traite_le']
+
+    # Notification Telegram avec toutes les infos
+    message = f"""🔔 <b>WEBHOOK CYBERSCHOOL REÇU</b>
+
+📋 <b>Détails bruts:</b>
+• <b>merchantReferenceId:</b> <code>{merchant_ref}</code>
+• <b>reference:</b> <code>{data.get('reference')}</code>
+• <b>Code:</b> {code}
+• <b>Status:</b> {status}
+• <b>Montant:</b> {amount} FCFA
+• <b>Opérateur:</b> {operator}
+• <b>Transaction ID:</b> <code>{transaction_id or 'N/A'}</code>
+• <b>Téléphone:</b> {numero_tel or 'N/A'}
+• <b>customerID:</b> {data.get('customerID', 'N/A')}
+
+🕐 <b>Timestamp:</b> {data.get('timestamp', 'N/A')}
+"""
+    envoyer_notification_telegram(
+        message.strip(), webhook_log=webhook_log,
+        categorie='WEBHOOK_RECU', operateur=operator, montant=amount
+    )
+
+    reponse = ({
+        'status': 'received',
+        'message': 'Webhook reçu et traité',
+        'merchant_ref': merchant_ref,
+        'code': code
+    }, 200)
+
+    # === ACTIVATION AUTOMATIQUE DE L'ABONNEMENT ===
+    if code == 200 and (merchant_ref or numero_tel):
+        try:
+            with transaction.atomic():
+                # Reference marchand d'abord, puis telephone + montant ; l'abonnement est verrouille
+                resultat = rapprocher_paiement(merchant_ref, numero_tel, amount, webhook_log.created_at)
+                abonnement = resultat.abonnement
+                webhook_log.rapprochement = resultat.methode
+                webhook_log.candidats = [a.pk for a in resultat.candidats]
+                champs_modifies += ['rapprochement', 'candidats']
+                deja_actif = abonnement is not None and abonnement.statut == 'ACTIF'
+
+                if abonnement and not deja_actif:
+                    abonnement.statut = 'ACTIF'
+                    abonnement.date_debut = timezone.now()
+                    abonnement.methode_paiement = operator
+                    abonnement.montant_paye = amount
+                    abonnement.code_paiement = str(code)
+                    if abonnement.produit and abonnement.produit.date_expiration:
+                        abonnement.date_fin = datetime.combine(abonnement.produit.date_expiration, time.max)
+                    abonnement.save()
+
+                if abonnement:
+                    webhook_log.abonnement = abonnement
+                    webhook_log.activation_succes = True
+                    champs_modifies += ['abonnement', 'activation_succes']
+
+            if deja_actif:
+                logger.info(f"Abonnement {abonnement.pk} déjà actif (webhook {webhook_log.pk})")
+                reponse = ({
+                    'status': 'activated',
+                    'message': 'Abonnement déjà actif',
+                    'abonnement_id': abonnement.id
+                }, 200)
+            elif abonnement:
+                logger.info(f"Abonnement {abonnement.pk} activé par le webhook {webhook_log.pk} ({resultat.methode})")
+
+                profile = abonnement.user.profile if hasattr(abonnement.user, 'profile') else None
+                recommande_par = profile.get_recommande_par_display() if profile else 'N/A'
+
+                envoyer_notification_telegram(
+                    f"✅ <b>ABONNEMENT ACTIVÉ</b>\n"
+                    f"📚 Niveau: <b>{abonnement.niveau.nom if abonnement.niveau else 'N/A'}</b>\n"
+                    f"👤 Utilisateur: <b>{abonnement.user.username if abonnement.user else 'N/A'}</b>\n"
+                    f"💰 Montant: {amount} FCFA\n"
+                    f"📞 Téléphone: {numero_tel or 'N/A'} | Recommandé par: {recommande_par}",
+                    webhook_log=webhook_log,
+                    categorie='PAIEMENT_SUCCES',
+                    operateur=operator,
+                    montant=amount
+                )
+
+                reponse = ({
+                    'status': 'activated',
+                    'message': 'Abonnement activé avec succès',
+                    'abonnement_id': abonnement.id
+                }, 200)
+            elif resultat.ambigu:
+                logger.warning(
+                    f"Rapprochement ambigu pour le webhook {webhook_log.pk}: abonnements {webhook_log.candidats}"
+                )
+                # Toujours envoyee individuellement : une activation manuelle est necessaire
+                envoyer_notification_telegram(
+                    f"❓ <b>PAIEMENT AMBIGU</b>\n\n"
+                    f"Référence: <code>{merchant_ref}</code>\n"
+                    f"Téléphone: {numero_tel or 'N/A'} | Montant: {amount} FCFA\n"
+                    f"Abonnements possibles: {', '.join(f'#{a.pk} ({a.user.username})' for a in resultat.candidats)}\n"
+                    f"À activer manuellement depuis l'admin.",
+                    webhook_log=webhook_log
+                )
+                reponse = ({
+                    'status': 'ambiguous',
+                    'message': 'Plusieurs abonnements correspondent, activation manuelle requise',
+                }, 200)
+            else:
+                logger.warning(f"Aucun abonnement trouvé pour le webhook {webhook_log.pk} (ref: {merchant_ref})")
+                envoyer_notification_telegram(
+                    f"⚠️ <b>ABONNEMENT NON TROUVÉ</b>\n\n"
+                    f"Référence: <code>{merchant_ref}</code>\n"
+                    f"Paiement reçu mais aucun abonnement correspondant.",
+                    webhook_log=webhook_log,
+                    categorie='PAIEMENT_NON_TROUVE',
+                    operateur=operator,
+                    montant=amount
+                )
+
+        except Exception as e:
+            logger.error(f"Erreur lors de l'activation (webhook {webhook_log.pk}): {str(e)}", exc_info=True)
+            webhook_log.erreur_traitement = str(e)
+            champs_modifies.append('erreur_traitement')
+            envoyer_notification_telegram(f"❌ <b>ERREUR ACTIVATION</b>\n\n{str(e)}", webhook_log=webhook_log)
+
+    elif code != 200:
+        logger.warning(f"Paiement échoué (webhook {webhook_log.pk}, code: {code})")
+        envoyer_notification_telegram(
+            f"⚠️ <b>PAIEMENT ÉCHOUÉ</b>\n\n"
+            f"Code: {code}\n"
+            f"Status: {status}",
+            webhook_log=webhook_log,
+            categorie='PAIEMENT_ECHEC',
+            operateur=operator,
+            montant=amount
+        )
+
+    champs_modifies += memoriser_reponse(webhook_log, *reponse)
+    webhook_log.save(update_fields=champs_modifies)
+    return reponse
+
+
+def traiter_webhook_immediat(webhook_log):
+    """
+    Traite le webhook dans la requete (WEBHOOK_TRAITEMENT_DIFFERE desactive). La ligne est
+    reservee comme par process_webhooks (FOR UPDATE SKIP LOCKED, traite_le vide) : un worker
+    qui tourne quand meme ne la traite pas une seconde fois.
+    Retourne (corps de reponse JSON, code HTTP), ou None si un worker l'a deja prise.
+    """
+    with transaction.atomic():
+        reserve = (
+            WebhookLog.objects.select_for_update(skip_locked=True)
+            .filter(pk=webhook_log.pk, traite_le__isnull=True)
+            .first()
+        )
+        if reserve is None:
+            return None
+        return traiter_webhook(reserve)
+
+
+def traiter_webhooks_en_attente(limite=50):
+    """
+    Traite un lot de webhooks enregistres mais pas encore traites.
+    SELECT ... FOR UPDATE SKIP LOCKED : plusieurs workers peuvent tourner en parallele.
+    Retourne le nombre de webhooks traites.
+    """
+    with transaction.atomic():
+        lot = list(
+            WebhookLog.objects.select_for_update(skip_locked=True)
+            .filter(provider=PROVIDER_WEBHOOK, traite_le__isnull=True)
+            .order_by('created_at')[:limite]
+        )
+        for webhook_log in lot:
+            try:
+                with transaction.atomic():
+                    traiter_webhook(webhook_log)
+            except Exception as e:
+                logger.error(f"Erreur de traitement du webhook {webhook_log.pk}: {e}", exc_info=True)
+                WebhookLog.objects.filter(pk=webhook_log.pk).update(
+                    traite_le=timezone.now(), erreur_traitement=str(e)
+                )
+    return len(lot)
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -65,6 +66,24 @@ DATABASES = {
     }
 }
 
+# Cache partage entre les workers gunicorn (Redis si REDIS_URL est defini)
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+            'KEY_PREFIX': 'educalims',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'educalims',
+        }
+    }
+
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
     {'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator'},
@@ -102,3 +121,44 @@ LOGGING = {
         'level': 'INFO',
     },
 }
+
+# Notifications Telegram (envoyees par manage.py run_notifier)
+TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '8539115405:AAFxfimKuOeVKqYL5mQaclVsQ5Lh2hIcIok')
+TELEGRAM_CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID', '1646298746')
+# URL de l'API, remplacable par un serveur local (manage.py telegram_stub) pour les tests
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+TELEGRAM_MAX_TENTATIVES = 8
+# Limites de debit de l'API Telegram (bot / groupe)
+TELEGRAM_DEBIT_PAR_SECONDE = 30
+TELEGRAM_DEBIT_CHAT_PAR_MINUTE = 20
+# Mode resume : regroupe les notifications de paiement sur cette fenetre en secondes (0 = desactive)
+TELEGRAM_RESUME_FENETRE = int(os.environ.get('TELEGRAM_RESUME_FENETRE', 0))
+
+# Webhooks Cyberschool : si active, le webhook enregistre le payload et repond aussitot ;
+# le rapprochement et l'activation sont faits par manage.py process_webhooks
+WEBHOOK_TRAITEMENT_DIFFERE = os.environ.get('WEBHOOK_TRAITEMENT_DIFFERE', '0') == '1'
+
+# Abonnements en attente : s_abonner reutilise celui de moins de ABONNEMENT_ATTENTE_REUTILISATION
+# secondes ; manage.py reap_abonnements annule ceux de plus de ABONNEMENT_ATTENTE_DUREE secondes
+# et archive les abonnements termines depuis ABONNEMENT_ARCHIVAGE_MOIS mois
+ABONNEMENT_ATTENTE_REUTILISATION = int(os.environ.get('ABONNEMENT_ATTENTE_REUTILISATION', 30 * 60))
+ABONNEMENT_ATTENTE_DUREE = int(os.environ.get('ABONNEMENT_ATTENTE_DUREE', 24 * 60 * 60))
+ABONNEMENT_ARCHIVAGE_MOIS = int(os.environ.get('ABONNEMENT_ARCHIVAGE_MOIS', 6))
+
+# Cle de la permutation des references marchand (references.py) : ne plus la changer une fois en production
+MERCHANT_REFERENCE_CLE = os.environ.get('MERCHANT_REFERENCE_CLE', SECRET_KEY)
+
+# Appareils autorises par utilisateur (appareils.py) ; derniers acces ecrits toutes les
+# APPAREILS_ACCES_INTERVALLE secondes par chaque processus
+APPAREILS_MAX = int(os.environ.get('APPAREILS_MAX', 3))
+APPAREILS_ACCES_INTERVALLE = int(os.environ.get('APPAREILS_ACCES_INTERVALLE', 60))
+
+# Compteurs de telechargements (telechargements.py) : 'tampon' ecrit les increments par lots toutes
+# les TELECHARGEMENTS_INTERVALLE secondes, 'exact' fait un UPDATE atomique par telechargement
+TELECHARGEMENTS_MODE = os.environ.get('TELECHARGEMENTS_MODE', 'tampon')
+TELECHARGEMENTS_INTERVALLE = int(os.environ.get('TELECHARGEMENTS_INTERVALLE', 30))
+
+# Fichiers pedagogiques (medias.py) : derriere nginx, envoi par X-Accel-Redirect vers la location
+# interne MEDIAS_INTERNE ; sinon Django les sert lui-meme (developpement)
+MEDIAS_X_ACCEL = os.environ.get('MEDIAS_X_ACCEL', '0') == '1'
+MEDIAS_INTERNE = '/media-protege/'
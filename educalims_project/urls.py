@@ -18,58 +18,19 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
-from django.shortcuts import render
-from educalims.models import Abonnement
-
-
-# Vue admin dashboard pour les paiements
-def admin_payment_dashboard(request):
-    """Dashboard pour voir les paiements recus"""
-    if not request.user.is_superuser:
-        from django.http import HttpResponseForbidden
-        return HttpResponseForbidden("Accès réservé aux administrateurs")
-
-    # Derniers abonnements
-    derniers_abonnements = Abonnement.objects.all().order_by('-date_creation')[:20]
-
-    # Abonnements en attente
-    abonnements_attente = Abonnement.objects.filter(
-        statut='EN_ATTENTE'
-    ).order_by('-date_creation')[:10]
-
-    # Abonnements actifs
-    abonnements_actifs = Abonnement.objects.filter(
-        statut='ACTIF'
-    ).order_by('-date_debut')[:10]
-
-    # Abonnements echoues
-    abonnements_echoues = Abonnement.objects.filter(
-        statut='ECHOUE'
-    ).order_by('-date_creation')[:10]
-
-    context = {
-        'title': 'Dashboard Paiements',
-        'derniers_abonnements': derniers_abonnements,
-        'abonnements_attente': abonnements_attente,
-        'abonnements_actifs': abonnements_actifs,
-        'abonnements_echoues': abonnements_echoues,
-        'total_attente': Abonnement.objects.filter(statut='EN_ATTENTE').count(),
-        'total_actifs': Abonnement.objects.filter(statut='ACTIF').count(),
-        'total_echoues': Abonnement.objects.filter(statut='ECHOUE').count(),
-        'site_title': admin.site.site_title,
-        'site_header': admin.site.site_header,
-    }
-
-    return render(request, 'admin/educalims/payment_dashboard.html', context)
+from educalims.admin_dashboard import api_referral_leaderboard, payment_dashboard, referral_leaderboard
 
 
 urlpatterns = [
+    # Avant admin/ : sa vue "catch-all" renverrait 404 pour cette URL
+    path('admin/payment-dashboard/', admin.site.admin_view(payment_dashboard), name='admin_payment_dashboard'),
+    path('admin/referral-leaderboard/', admin.site.admin_view(referral_leaderboard), name='admin_referral_leaderboard'),
+    path('admin/referral-leaderboard/api/', admin.site.admin_view(api_referral_leaderboard),
+         name='admin_referral_leaderboard_api'),
     path('admin/', admin.site.urls),
-    path('admin/payment-dashboard/', admin_payment_dashboard, name='admin_payment_dashboard'),
     path('', include('educalims.urls')),
 ]
 
-# Servir les fichiers media et static en développement
+# Servir les fichiers static en développement (les media payants passent par fichier_telecharger)
 if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)